@@ -0,0 +1,56 @@
+"""Settings of ``gunicorn wsgi:app``, read from the working directory.
+
+The app is preloaded in the master and shared with the workers (see
+``src.prefork``) unless GUNICORN_PRELOAD is false, e.g. to reload the code
+on SIGHUP. Workers log how long they took to start, from the fork to being
+ready to accept requests, and warn when over WORKER_STARTUP_BUDGET
+milliseconds (500).
+
+Workers serve GUNICORN_THREADS requests (8) at once, each in a thread. The
+streams of watchlist events last minutes: they hold a thread rather than
+the whole worker, and the heartbeat of the worker goes on meanwhile, so
+its ``timeout`` does not kill it in the middle of one.
+"""
+import gc
+import os
+import time
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() \
+    not in ('0', 'false', 'no')
+
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+startup_budget = float(os.getenv('WORKER_STARTUP_BUDGET', 500))
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from src.prefork import warm_up
+        from wsgi import app
+
+        warm_up(app)
+        # the objects of the master are never collected in the workers;
+        # freezing them keeps the collector from writing to, and so
+        # copying, their pages
+        gc.freeze()
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from src.prefork import after_fork
+        from wsgi import app
+
+        after_fork(app)
+
+
+def post_worker_init(worker):
+    startup_ms = (time.monotonic() - worker.forked_at) * 1000
+    log = worker.log.warning if startup_ms > startup_budget \
+        else worker.log.info
+    log('Worker %s started in %.1f ms (budget %.0f ms)', worker.pid,
+        startup_ms, startup_budget)
@@ -0,0 +1,21 @@
+-- Let the database remove ownerships and sanctions of deleted companies and
+-- partners instead of the ORM loading and deleting them row by row.
+
+BEGIN;
+
+ALTER TABLE ownerships
+    DROP CONSTRAINT IF EXISTS ownerships_company_id_fkey,
+    ADD CONSTRAINT ownerships_company_id_fkey
+        FOREIGN KEY (company_id) REFERENCES companies (id) ON DELETE CASCADE;
+
+ALTER TABLE ownerships
+    DROP CONSTRAINT IF EXISTS ownerships_partner_id_fkey,
+    ADD CONSTRAINT ownerships_partner_id_fkey
+        FOREIGN KEY (partner_id) REFERENCES partners (id) ON DELETE CASCADE;
+
+ALTER TABLE sanctions
+    DROP CONSTRAINT IF EXISTS sanctions_company_id_fkey,
+    ADD CONSTRAINT sanctions_company_id_fkey
+        FOREIGN KEY (company_id) REFERENCES companies (id) ON DELETE CASCADE;
+
+COMMIT;
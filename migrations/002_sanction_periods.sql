@@ -0,0 +1,16 @@
+-- Validity periods of sanctions. A missing date leaves the period open on
+-- that side, so existing sanctions stay in force.
+
+BEGIN;
+
+ALTER TABLE sanctions
+    ADD COLUMN IF NOT EXISTS start_date date,
+    ADD COLUMN IF NOT EXISTS end_date date;
+
+CREATE INDEX IF NOT EXISTS ix_sanctions_company_id_period
+    ON sanctions (company_id, start_date, end_date);
+
+CREATE INDEX IF NOT EXISTS ix_sanctions_period
+    ON sanctions (start_date, end_date);
+
+COMMIT;
@@ -0,0 +1,30 @@
+-- Store CNPJ and CPF documents as integers. Partners get a person_type
+-- ('F' for CPF, 'J' for CNPJ) since both kinds share the document column.
+--
+-- Documents that become equal once punctuation is stripped make the unique
+-- constraints fail: merge those rows before running this script. Check
+-- digits are validated by the API on new writes only.
+
+BEGIN;
+
+ALTER TABLE companies
+    ALTER COLUMN fiscal_number TYPE bigint
+        USING regexp_replace(fiscal_number, '\D', '', 'g')::bigint;
+
+ALTER TABLE partners ADD COLUMN IF NOT EXISTS person_type varchar(1);
+
+UPDATE partners
+   SET person_type = CASE
+       WHEN length(regexp_replace(document, '\D', '', 'g')) = 14 THEN 'J'
+       ELSE 'F'
+   END;
+
+ALTER TABLE partners
+    ALTER COLUMN person_type SET NOT NULL,
+    DROP CONSTRAINT IF EXISTS partners_document_key,
+    ALTER COLUMN document TYPE bigint
+        USING regexp_replace(document, '\D', '', 'g')::bigint,
+    ADD CONSTRAINT partners_document_person_type_key
+        UNIQUE (document, person_type);
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- Queue of background jobs run by `flask worker`.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id serial PRIMARY KEY,
+    kind varchar NOT NULL,
+    params json NOT NULL,
+    status varchar NOT NULL,
+    progress integer NOT NULL,
+    total integer,
+    result json,
+    error varchar,
+    worker varchar,
+    created_at timestamp NOT NULL,
+    started_at timestamp,
+    finished_at timestamp
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_status_id ON jobs (status, id);
+
+COMMIT;
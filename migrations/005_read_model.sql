@@ -0,0 +1,81 @@
+-- Read model: the JSON documents sent by /companies and /partners, in the
+-- format of Company.format() and Partner.format(). The documents of the
+-- existing rows are built here; a `rebuild_documents` job rewrites them
+-- all should they ever drift.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS company_documents (
+    company_id integer PRIMARY KEY
+        REFERENCES companies (id) ON DELETE CASCADE,
+    document text NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS partner_documents (
+    partner_id integer PRIMARY KEY
+        REFERENCES partners (id) ON DELETE CASCADE,
+    document text NOT NULL
+);
+
+CREATE TEMPORARY VIEW sanction_lists AS
+SELECT company_id,
+       json_agg(json_build_object(
+           'id', id,
+           'organization', organization,
+           'start_date', start_date,
+           'end_date', end_date
+       ) ORDER BY id) AS sanctions
+FROM sanctions
+GROUP BY company_id;
+
+INSERT INTO company_documents (company_id, document)
+SELECT c.id,
+       json_build_object(
+           'id', c.id,
+           'fiscal_number', lpad(c.fiscal_number::text, 14, '0'),
+           'name', c.name,
+           'partners', COALESCE((
+               SELECT json_agg(json_build_object(
+                   'id', p.id,
+                   'document', lpad(p.document::text,
+                                    CASE p.person_type WHEN 'J' THEN 14
+                                                       ELSE 11 END, '0'),
+                   'name', p.name
+               ) ORDER BY p.id)
+               FROM ownerships o
+               JOIN partners p ON p.id = o.partner_id
+               WHERE o.company_id = c.id
+           ), '[]'),
+           'sanctions', COALESCE(s.sanctions, '[]')
+       )::text
+FROM companies c
+LEFT JOIN sanction_lists s ON s.company_id = c.id
+ON CONFLICT (company_id) DO NOTHING;
+
+INSERT INTO partner_documents (partner_id, document)
+SELECT p.id,
+       json_build_object(
+           'id', p.id,
+           'document', lpad(p.document::text,
+                            CASE p.person_type WHEN 'J' THEN 14 ELSE 11 END,
+                            '0'),
+           'name', p.name,
+           'companies', COALESCE((
+               SELECT json_agg(json_build_object(
+                   'id', c.id,
+                   'fiscal_number', lpad(c.fiscal_number::text, 14, '0'),
+                   'name', c.name,
+                   'sanctions', COALESCE(s.sanctions, '[]')
+               ) ORDER BY c.id)
+               FROM ownerships o
+               JOIN companies c ON c.id = o.company_id
+               LEFT JOIN sanction_lists s ON s.company_id = c.id
+               WHERE o.partner_id = p.id
+           ), '[]')
+       )::text
+FROM partners p
+ON CONFLICT (partner_id) DO NOTHING;
+
+DROP VIEW sanction_lists;
+
+COMMIT;
@@ -0,0 +1,262 @@
+-- System-versioned history of companies, partners, ownerships and
+-- sanctions. Triggers record every write in the *_history tables, one row
+-- per version valid from valid_from until valid_to (NULL while current),
+-- so `?as_of=` reads find the versions valid at a moment with an index
+-- range scan. The history starts with the rows present when migrating.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS companies_history (
+    version bigserial PRIMARY KEY,
+    id integer,
+    fiscal_number bigint,
+    name varchar,
+    valid_from timestamp NOT NULL,
+    valid_to timestamp
+);
+
+CREATE INDEX IF NOT EXISTS ix_companies_history_id_valid_from
+    ON companies_history (id, valid_from);
+
+CREATE OR REPLACE FUNCTION companies_insert_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO companies_history (id, fiscal_number, name, valid_from)
+    SELECT n.id, n.fiscal_number, n.name, now() AT TIME ZONE 'UTC'
+    FROM new_rows n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION companies_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE companies_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o JOIN new_rows n ON n.id = o.id
+    WHERE h.id = o.id AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    INSERT INTO companies_history (id, fiscal_number, name, valid_from)
+    SELECT n.id, n.fiscal_number, n.name, now() AT TIME ZONE 'UTC'
+    FROM new_rows n JOIN old_rows o ON n.id = o.id
+    WHERE o IS DISTINCT FROM n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION companies_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE companies_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o
+    WHERE h.id = o.id AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS companies_insert_versions ON companies;
+CREATE TRIGGER companies_insert_versions AFTER INSERT ON companies
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION companies_insert_versions();
+
+DROP TRIGGER IF EXISTS companies_update_versions ON companies;
+CREATE TRIGGER companies_update_versions AFTER UPDATE ON companies
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION companies_update_versions();
+
+DROP TRIGGER IF EXISTS companies_delete_versions ON companies;
+CREATE TRIGGER companies_delete_versions AFTER DELETE ON companies
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION companies_delete_versions();
+
+INSERT INTO companies_history (id, fiscal_number, name, valid_from)
+    SELECT n.id, n.fiscal_number, n.name, now() AT TIME ZONE 'UTC'
+    FROM companies n
+    WHERE NOT EXISTS (SELECT 1 FROM companies_history);
+
+CREATE TABLE IF NOT EXISTS partners_history (
+    version bigserial PRIMARY KEY,
+    id integer,
+    document bigint,
+    person_type varchar(1),
+    name varchar,
+    valid_from timestamp NOT NULL,
+    valid_to timestamp
+);
+
+CREATE INDEX IF NOT EXISTS ix_partners_history_id_valid_from
+    ON partners_history (id, valid_from);
+
+CREATE OR REPLACE FUNCTION partners_insert_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO partners_history (id, document, person_type, name, valid_from)
+    SELECT n.id, n.document, n.person_type, n.name, now() AT TIME ZONE 'UTC'
+    FROM new_rows n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION partners_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE partners_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o JOIN new_rows n ON n.id = o.id
+    WHERE h.id = o.id AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    INSERT INTO partners_history (id, document, person_type, name, valid_from)
+    SELECT n.id, n.document, n.person_type, n.name, now() AT TIME ZONE 'UTC'
+    FROM new_rows n JOIN old_rows o ON n.id = o.id
+    WHERE o IS DISTINCT FROM n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION partners_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE partners_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o
+    WHERE h.id = o.id AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS partners_insert_versions ON partners;
+CREATE TRIGGER partners_insert_versions AFTER INSERT ON partners
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION partners_insert_versions();
+
+DROP TRIGGER IF EXISTS partners_update_versions ON partners;
+CREATE TRIGGER partners_update_versions AFTER UPDATE ON partners
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION partners_update_versions();
+
+DROP TRIGGER IF EXISTS partners_delete_versions ON partners;
+CREATE TRIGGER partners_delete_versions AFTER DELETE ON partners
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION partners_delete_versions();
+
+INSERT INTO partners_history (id, document, person_type, name, valid_from)
+    SELECT n.id, n.document, n.person_type, n.name, now() AT TIME ZONE 'UTC'
+    FROM partners n
+    WHERE NOT EXISTS (SELECT 1 FROM partners_history);
+
+CREATE TABLE IF NOT EXISTS ownerships_history (
+    version bigserial PRIMARY KEY,
+    company_id integer,
+    partner_id integer,
+    valid_from timestamp NOT NULL,
+    valid_to timestamp
+);
+
+CREATE INDEX IF NOT EXISTS ix_ownerships_history_company_id_partner_id_valid_from
+    ON ownerships_history (company_id, partner_id, valid_from);
+
+CREATE INDEX IF NOT EXISTS ix_ownerships_history_partner_id_valid_from
+    ON ownerships_history (partner_id, valid_from);
+
+CREATE OR REPLACE FUNCTION ownerships_insert_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO ownerships_history (company_id, partner_id, valid_from)
+    SELECT n.company_id, n.partner_id, now() AT TIME ZONE 'UTC'
+    FROM new_rows n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ownerships_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE ownerships_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o JOIN new_rows n ON n.company_id = o.company_id AND n.partner_id = o.partner_id
+    WHERE h.company_id = o.company_id AND h.partner_id = o.partner_id AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    INSERT INTO ownerships_history (company_id, partner_id, valid_from)
+    SELECT n.company_id, n.partner_id, now() AT TIME ZONE 'UTC'
+    FROM new_rows n JOIN old_rows o ON n.company_id = o.company_id AND n.partner_id = o.partner_id
+    WHERE o IS DISTINCT FROM n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ownerships_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE ownerships_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o
+    WHERE h.company_id = o.company_id AND h.partner_id = o.partner_id AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ownerships_insert_versions ON ownerships;
+CREATE TRIGGER ownerships_insert_versions AFTER INSERT ON ownerships
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ownerships_insert_versions();
+
+DROP TRIGGER IF EXISTS ownerships_update_versions ON ownerships;
+CREATE TRIGGER ownerships_update_versions AFTER UPDATE ON ownerships
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ownerships_update_versions();
+
+DROP TRIGGER IF EXISTS ownerships_delete_versions ON ownerships;
+CREATE TRIGGER ownerships_delete_versions AFTER DELETE ON ownerships
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ownerships_delete_versions();
+
+INSERT INTO ownerships_history (company_id, partner_id, valid_from)
+    SELECT n.company_id, n.partner_id, now() AT TIME ZONE 'UTC'
+    FROM ownerships n
+    WHERE NOT EXISTS (SELECT 1 FROM ownerships_history);
+
+CREATE TABLE IF NOT EXISTS sanctions_history (
+    version bigserial PRIMARY KEY,
+    id integer,
+    name varchar,
+    organization varchar,
+    company_id integer,
+    start_date date,
+    end_date date,
+    valid_from timestamp NOT NULL,
+    valid_to timestamp
+);
+
+CREATE INDEX IF NOT EXISTS ix_sanctions_history_company_id_valid_from
+    ON sanctions_history (company_id, valid_from);
+
+CREATE INDEX IF NOT EXISTS ix_sanctions_history_id_valid_from
+    ON sanctions_history (id, valid_from);
+
+CREATE OR REPLACE FUNCTION sanctions_insert_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sanctions_history (id, name, organization, company_id, start_date, end_date, valid_from)
+    SELECT n.id, n.name, n.organization, n.company_id, n.start_date, n.end_date, now() AT TIME ZONE 'UTC'
+    FROM new_rows n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sanctions_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE sanctions_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o JOIN new_rows n ON n.id = o.id
+    WHERE h.id = o.id AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    INSERT INTO sanctions_history (id, name, organization, company_id, start_date, end_date, valid_from)
+    SELECT n.id, n.name, n.organization, n.company_id, n.start_date, n.end_date, now() AT TIME ZONE 'UTC'
+    FROM new_rows n JOIN old_rows o ON n.id = o.id
+    WHERE o IS DISTINCT FROM n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sanctions_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE sanctions_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o
+    WHERE h.id = o.id AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sanctions_insert_versions ON sanctions;
+CREATE TRIGGER sanctions_insert_versions AFTER INSERT ON sanctions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_insert_versions();
+
+DROP TRIGGER IF EXISTS sanctions_update_versions ON sanctions;
+CREATE TRIGGER sanctions_update_versions AFTER UPDATE ON sanctions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_update_versions();
+
+DROP TRIGGER IF EXISTS sanctions_delete_versions ON sanctions;
+CREATE TRIGGER sanctions_delete_versions AFTER DELETE ON sanctions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_delete_versions();
+
+INSERT INTO sanctions_history (id, name, organization, company_id, start_date, end_date, valid_from)
+    SELECT n.id, n.name, n.organization, n.company_id, n.start_date, n.end_date, now() AT TIME ZONE 'UTC'
+    FROM sanctions n
+    WHERE NOT EXISTS (SELECT 1 FROM sanctions_history);
+
+COMMIT;
@@ -0,0 +1,43 @@
+-- Watchlists of fiscal numbers and the notifications of the ones found
+-- ineligible, streamed by /watchlists/{id}/events and posted to webhooks.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS watchlists (
+    id serial PRIMARY KEY,
+    client varchar NOT NULL,
+    name varchar NOT NULL,
+    webhook_url varchar,
+    webhook_secret varchar,
+    created_at timestamp NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_watchlists_client ON watchlists (client);
+
+CREATE TABLE IF NOT EXISTS watchlist_entries (
+    watchlist_id integer REFERENCES watchlists (id) ON DELETE CASCADE,
+    fiscal_number bigint,
+    PRIMARY KEY (watchlist_id, fiscal_number)
+);
+
+CREATE INDEX IF NOT EXISTS ix_watchlist_entries_fiscal_number
+    ON watchlist_entries (fiscal_number);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id serial PRIMARY KEY,
+    watchlist_id integer NOT NULL
+        REFERENCES watchlists (id) ON DELETE CASCADE,
+    event varchar NOT NULL,
+    company_id integer NOT NULL,
+    fiscal_number bigint NOT NULL,
+    eligibility json NOT NULL,
+    created_at timestamp NOT NULL,
+    delivered_at timestamp,
+    attempts integer NOT NULL,
+    error varchar
+);
+
+CREATE INDEX IF NOT EXISTS ix_notifications_watchlist_id_id
+    ON notifications (watchlist_id, id);
+
+COMMIT;
@@ -0,0 +1,52 @@
+-- Shares of the ownerships and the beneficial owners computed from them.
+-- The versioning functions of ownerships are replaced to record shares.
+
+BEGIN;
+
+ALTER TABLE ownerships ADD COLUMN IF NOT EXISTS share numeric(7, 4);
+
+ALTER TABLE ownerships DROP CONSTRAINT IF EXISTS ownerships_share_check;
+ALTER TABLE ownerships ADD CONSTRAINT ownerships_share_check
+    CHECK (share > 0 AND share <= 100);
+
+ALTER TABLE ownerships_history ADD COLUMN IF NOT EXISTS share numeric(7, 4);
+
+CREATE OR REPLACE FUNCTION ownerships_insert_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO ownerships_history (company_id, partner_id, share, valid_from)
+    SELECT n.company_id, n.partner_id, n.share, now() AT TIME ZONE 'UTC'
+    FROM new_rows n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ownerships_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE ownerships_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o JOIN new_rows n ON n.company_id = o.company_id AND n.partner_id = o.partner_id
+    WHERE h.company_id = o.company_id AND h.partner_id = o.partner_id AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    INSERT INTO ownerships_history (company_id, partner_id, share, valid_from)
+    SELECT n.company_id, n.partner_id, n.share, now() AT TIME ZONE 'UTC'
+    FROM new_rows n JOIN old_rows o ON n.company_id = o.company_id AND n.partner_id = o.partner_id
+    WHERE o IS DISTINCT FROM n;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION ownerships_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE ownerships_history h SET valid_to = now() AT TIME ZONE 'UTC'
+    FROM old_rows o
+    WHERE h.company_id = o.company_id AND h.partner_id = o.partner_id AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE TABLE IF NOT EXISTS beneficial_owners (
+    company_id integer REFERENCES companies (id) ON DELETE CASCADE,
+    partner_id integer REFERENCES partners (id) ON DELETE CASCADE,
+    share double precision NOT NULL,
+    direct_share double precision,
+    computed_at timestamp NOT NULL,
+    PRIMARY KEY (company_id, partner_id)
+);
+
+COMMIT;
@@ -0,0 +1,22 @@
+-- Economic groups of companies and partners. The tables start empty: queue
+-- a rebuild_groups job after running this migration to fill them.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS company_groups (
+    company_id integer PRIMARY KEY REFERENCES companies (id) ON DELETE CASCADE,
+    group_id integer NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_company_groups_group_id_company_id
+    ON company_groups (group_id, company_id);
+
+CREATE TABLE IF NOT EXISTS partner_groups (
+    partner_id integer PRIMARY KEY REFERENCES partners (id) ON DELETE CASCADE,
+    group_id integer NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_partner_groups_group_id_partner_id
+    ON partner_groups (group_id, partner_id);
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Duplicated partners found by the resolve_partners job, and the index the
+-- imports look people with a masked CPF up with.
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS ix_partners_cpf_middle
+    ON partners (((document / 100) % 1000000)) WHERE person_type = 'F';
+
+CREATE TABLE IF NOT EXISTS partner_merges (
+    partner_id integer PRIMARY KEY REFERENCES partners (id) ON DELETE CASCADE,
+    canonical_id integer NOT NULL REFERENCES partners (id) ON DELETE CASCADE,
+    score double precision NOT NULL,
+    resolved_at timestamp NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_partner_merges_canonical_id
+    ON partner_merges (canonical_id);
+
+COMMIT;
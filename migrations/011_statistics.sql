@@ -0,0 +1,287 @@
+-- Statistics of /stats. Triggers keep the counters in the transaction of
+-- every write to companies, partners, ownerships and sanctions, each count
+-- spread over 16 shards; the counts start with the rows present when
+-- migrating. top_companies is filled by the refresh_stats job.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS stat_counters (
+    name varchar,
+    key varchar,
+    shard smallint,
+    value bigint NOT NULL,
+    PRIMARY KEY (name, key, shard)
+);
+
+CREATE TABLE IF NOT EXISTS company_stats (
+    company_id integer PRIMARY KEY,
+    partners integer NOT NULL,
+    sanctions integer NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_company_stats_partners
+    ON company_stats (partners DESC, company_id);
+
+CREATE TABLE IF NOT EXISTS top_companies (
+    rank integer PRIMARY KEY,
+    company_id integer NOT NULL REFERENCES companies (id) ON DELETE CASCADE,
+    partners integer NOT NULL,
+    refreshed_at timestamp NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION bump_stat(stat_name varchar, stat_key varchar,
+                                     delta bigint) RETURNS void AS $$
+BEGIN
+    IF delta <> 0 THEN
+        INSERT INTO stat_counters (name, key, shard, value)
+        VALUES (stat_name, stat_key, mod(pg_backend_pid(), 16),
+                delta)
+        ON CONFLICT (name, key, shard)
+        DO UPDATE SET value = stat_counters.value + excluded.value;
+    END IF;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rebuild_stat_counters() RETURNS void AS $$
+BEGIN
+    LOCK TABLE companies, partners, ownerships, sanctions IN SHARE MODE;
+    DELETE FROM stat_counters;
+    DELETE FROM company_stats;
+    INSERT INTO company_stats (company_id, partners, sanctions)
+    SELECT company_id, sum(partners), sum(sanctions) FROM (
+        SELECT company_id, count(*) AS partners, 0 AS sanctions
+        FROM ownerships GROUP BY company_id
+        UNION ALL
+        SELECT company_id, 0, count(*) FROM sanctions GROUP BY company_id
+    ) counts
+    GROUP BY company_id;
+    INSERT INTO stat_counters (name, key, shard, value)
+    SELECT 'companies', '', 0, count(*) FROM companies
+    UNION ALL SELECT 'partners', '', 0, count(*) FROM partners
+    UNION ALL SELECT 'ownerships', '', 0, count(*) FROM ownerships
+    UNION ALL SELECT 'sanctions', '', 0, count(*) FROM sanctions
+    UNION ALL SELECT 'sanctioned_companies', '', 0, count(*)
+    FROM company_stats WHERE sanctions > 0
+    UNION ALL SELECT 'sanctions_by_organization', organization, 0, count(*)
+    FROM sanctions GROUP BY organization;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION companies_insert_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('companies', '', 1 * (SELECT count(*) FROM new_rows));
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS companies_insert_stats ON companies;
+CREATE TRIGGER companies_insert_stats AFTER INSERT ON companies
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION companies_insert_stats();
+
+CREATE OR REPLACE FUNCTION companies_delete_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('companies', '', -1 * (SELECT count(*) FROM old_rows));
+    WITH deleted AS (
+        DELETE FROM company_stats s USING old_rows o
+        WHERE s.company_id = o.id
+        RETURNING s.sanctions
+    )
+    SELECT count(*) FILTER (WHERE sanctions > 0) INTO changed FROM deleted;
+    PERFORM bump_stat('sanctioned_companies', '', -changed);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS companies_delete_stats ON companies;
+CREATE TRIGGER companies_delete_stats AFTER DELETE ON companies
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION companies_delete_stats();
+
+CREATE OR REPLACE FUNCTION partners_insert_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('partners', '', 1 * (SELECT count(*) FROM new_rows));
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS partners_insert_stats ON partners;
+CREATE TRIGGER partners_insert_stats AFTER INSERT ON partners
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION partners_insert_stats();
+
+CREATE OR REPLACE FUNCTION partners_delete_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('partners', '', -1 * (SELECT count(*) FROM old_rows));
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS partners_delete_stats ON partners;
+CREATE TRIGGER partners_delete_stats AFTER DELETE ON partners
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION partners_delete_stats();
+
+CREATE OR REPLACE FUNCTION ownerships_insert_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('ownerships', '', 1 * (SELECT count(*) FROM new_rows));
+    INSERT INTO company_stats (company_id, partners, sanctions)
+    SELECT r.company_id, 1 * count(*), 0
+    FROM new_rows r JOIN companies c ON c.id = r.company_id
+    GROUP BY r.company_id
+    ON CONFLICT (company_id) DO UPDATE
+    SET partners = company_stats.partners + excluded.partners;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ownerships_insert_stats ON ownerships;
+CREATE TRIGGER ownerships_insert_stats AFTER INSERT ON ownerships
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ownerships_insert_stats();
+
+CREATE OR REPLACE FUNCTION ownerships_delete_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('ownerships', '', -1 * (SELECT count(*) FROM old_rows));
+    INSERT INTO company_stats (company_id, partners, sanctions)
+    SELECT r.company_id, -1 * count(*), 0
+    FROM old_rows r JOIN companies c ON c.id = r.company_id
+    GROUP BY r.company_id
+    ON CONFLICT (company_id) DO UPDATE
+    SET partners = company_stats.partners + excluded.partners;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ownerships_delete_stats ON ownerships;
+CREATE TRIGGER ownerships_delete_stats AFTER DELETE ON ownerships
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION ownerships_delete_stats();
+
+CREATE OR REPLACE FUNCTION sanctions_insert_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('sanctions', '', 1 * (SELECT count(*) FROM new_rows));
+    PERFORM bump_stat('sanctions_by_organization', organization, sanctions)
+    FROM (SELECT organization, 1 * count(*) AS sanctions
+          FROM new_rows GROUP BY organization) organizations;
+    WITH delta AS (
+        SELECT r.company_id, 1 * count(*) AS sanctions
+        FROM new_rows r JOIN companies c ON c.id = r.company_id
+        GROUP BY r.company_id
+    ), previous AS (
+        SELECT d.company_id, d.sanctions, coalesce(s.sanctions, 0) AS before
+        FROM delta d LEFT JOIN company_stats s USING (company_id)
+    ), upserted AS (
+        INSERT INTO company_stats (company_id, partners, sanctions)
+        SELECT company_id, 0, sanctions FROM delta
+        ON CONFLICT (company_id) DO UPDATE
+        SET sanctions = company_stats.sanctions + excluded.sanctions
+    )
+    SELECT count(*) FILTER (WHERE before = 0 AND before + sanctions > 0)
+         - count(*) FILTER (WHERE before > 0 AND before + sanctions = 0)
+    INTO changed FROM previous;
+    PERFORM bump_stat('sanctioned_companies', '', changed);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sanctions_insert_stats ON sanctions;
+CREATE TRIGGER sanctions_insert_stats AFTER INSERT ON sanctions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_insert_stats();
+
+CREATE OR REPLACE FUNCTION sanctions_update_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('sanctions', '', -1 * (SELECT count(*) FROM old_rows));
+    PERFORM bump_stat('sanctions_by_organization', organization, sanctions)
+    FROM (SELECT organization, -1 * count(*) AS sanctions
+          FROM old_rows GROUP BY organization) organizations;
+    WITH delta AS (
+        SELECT r.company_id, -1 * count(*) AS sanctions
+        FROM old_rows r JOIN companies c ON c.id = r.company_id
+        GROUP BY r.company_id
+    ), previous AS (
+        SELECT d.company_id, d.sanctions, coalesce(s.sanctions, 0) AS before
+        FROM delta d LEFT JOIN company_stats s USING (company_id)
+    ), upserted AS (
+        INSERT INTO company_stats (company_id, partners, sanctions)
+        SELECT company_id, 0, sanctions FROM delta
+        ON CONFLICT (company_id) DO UPDATE
+        SET sanctions = company_stats.sanctions + excluded.sanctions
+    )
+    SELECT count(*) FILTER (WHERE before = 0 AND before + sanctions > 0)
+         - count(*) FILTER (WHERE before > 0 AND before + sanctions = 0)
+    INTO changed FROM previous;
+    PERFORM bump_stat('sanctioned_companies', '', changed);
+    PERFORM bump_stat('sanctions', '', 1 * (SELECT count(*) FROM new_rows));
+    PERFORM bump_stat('sanctions_by_organization', organization, sanctions)
+    FROM (SELECT organization, 1 * count(*) AS sanctions
+          FROM new_rows GROUP BY organization) organizations;
+    WITH delta AS (
+        SELECT r.company_id, 1 * count(*) AS sanctions
+        FROM new_rows r JOIN companies c ON c.id = r.company_id
+        GROUP BY r.company_id
+    ), previous AS (
+        SELECT d.company_id, d.sanctions, coalesce(s.sanctions, 0) AS before
+        FROM delta d LEFT JOIN company_stats s USING (company_id)
+    ), upserted AS (
+        INSERT INTO company_stats (company_id, partners, sanctions)
+        SELECT company_id, 0, sanctions FROM delta
+        ON CONFLICT (company_id) DO UPDATE
+        SET sanctions = company_stats.sanctions + excluded.sanctions
+    )
+    SELECT count(*) FILTER (WHERE before = 0 AND before + sanctions > 0)
+         - count(*) FILTER (WHERE before > 0 AND before + sanctions = 0)
+    INTO changed FROM previous;
+    PERFORM bump_stat('sanctioned_companies', '', changed);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sanctions_update_stats ON sanctions;
+CREATE TRIGGER sanctions_update_stats AFTER UPDATE ON sanctions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_update_stats();
+
+CREATE OR REPLACE FUNCTION sanctions_delete_stats() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    PERFORM bump_stat('sanctions', '', -1 * (SELECT count(*) FROM old_rows));
+    PERFORM bump_stat('sanctions_by_organization', organization, sanctions)
+    FROM (SELECT organization, -1 * count(*) AS sanctions
+          FROM old_rows GROUP BY organization) organizations;
+    WITH delta AS (
+        SELECT r.company_id, -1 * count(*) AS sanctions
+        FROM old_rows r JOIN companies c ON c.id = r.company_id
+        GROUP BY r.company_id
+    ), previous AS (
+        SELECT d.company_id, d.sanctions, coalesce(s.sanctions, 0) AS before
+        FROM delta d LEFT JOIN company_stats s USING (company_id)
+    ), upserted AS (
+        INSERT INTO company_stats (company_id, partners, sanctions)
+        SELECT company_id, 0, sanctions FROM delta
+        ON CONFLICT (company_id) DO UPDATE
+        SET sanctions = company_stats.sanctions + excluded.sanctions
+    )
+    SELECT count(*) FILTER (WHERE before = 0 AND before + sanctions > 0)
+         - count(*) FILTER (WHERE before > 0 AND before + sanctions = 0)
+    INTO changed FROM previous;
+    PERFORM bump_stat('sanctioned_companies', '', changed);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS sanctions_delete_stats ON sanctions;
+CREATE TRIGGER sanctions_delete_stats AFTER DELETE ON sanctions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sanctions_delete_stats();
+
+SELECT rebuild_stat_counters() WHERE NOT EXISTS (SELECT 1 FROM stat_counters);
+
+COMMIT;
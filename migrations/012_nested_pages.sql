@@ -0,0 +1,11 @@
+-- Pages of the companies of a partner, read from the cursor on with a
+-- range scan of this index. Queue a rebuild_documents job afterwards so
+-- the stored documents embed at most 100 partners or companies, with their
+-- totals and cursors.
+
+BEGIN;
+
+CREATE INDEX IF NOT EXISTS ix_ownerships_partner_id_company_id
+    ON ownerships (partner_id, company_id);
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Heartbeat of running jobs: a job whose worker stopped renewing it for
+-- JOBS_STALE_AFTER seconds is claimed again by another worker.
+
+BEGIN;
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at timestamp;
+
+COMMIT;
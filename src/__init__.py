@@ -1,7 +1,9 @@
 import os
 
+import sqlalchemy as sa
 from flask import (
     Flask,
+    g,
     jsonify,
     render_template
 )
@@ -9,9 +11,76 @@ from flask import (
 from .companies import companies_blueprint
 from .partners import partners_blueprint
 from .sanctions import sanctions_blueprint
+from .screening import screening_blueprint
+from .jobs import jobs_blueprint
+from .watchlists import watchlists_blueprint
+from .stats import stats_blueprint
 
 from .database.models import setup_db
+from .database.timeouts import RequestTimeout
+from .log import setup_logging
+from .read_model import setup_read_model
+from .exposure import setup_exposure_cache
+from .notifications import setup_notifications
+from .ubo import setup_beneficial_owners
+from .groups import setup_groups
+from .statistics import setup_statistics
+from .index import setup_screening_filter
 from .auth.auth import AuthError
+from .auth.ratelimit import RateLimitError, setup_rate_limiting
+
+# optional settings, read from the environment only when they are set
+ENV_SETTINGS = (
+    'EXPOSURE_CACHE_SIZE',
+    'EXPOSURE_CACHE_TTL',
+    'EXPOSURE_MAX_DEPTH',
+    'RATELIMIT_ENABLED',
+    'RATELIMIT_STORAGE',
+    'RATELIMIT_CAPACITY',
+    'RATELIMIT_REFILL_RATE',
+    'CONCURRENCY_LIMIT',
+    'CONCURRENCY_LOCK_DIR',
+    'CONCURRENCY_RETRY_AFTER',
+    'SCREENING_FILTER_PATH',
+    'SCREENING_FILTER_FPR',
+    'SCREENING_INDEX_PATH',
+    'JOBS_DIR',
+    'JOBS_WORKER_PROCESSES',
+    'JOBS_POLL_INTERVAL',
+    'JOBS_STALE_AFTER',
+    'DB_POOL_SIZE',
+    'DB_MAX_OVERFLOW',
+    'DB_POOL_TIMEOUT',
+    'DB_POOL_RECYCLE',
+    'DB_POOL_PRE_PING',
+    'LOOKUP_STATEMENT_TIMEOUT',
+    'WRITE_STATEMENT_TIMEOUT',
+    'LIST_STATEMENT_TIMEOUT',
+    'EXPORT_STATEMENT_TIMEOUT',
+    'REQUEST_DEADLINE',
+    'SQLALCHEMY_REPLICA_URIS',
+    'REPLICA_SELECTION',
+    'REPLICA_MAX_LAG',
+    'REPLICA_LAG_CHECK_INTERVAL',
+    'REPLICA_PIN_SECONDS',
+    'REPLICA_PIN_STORAGE',
+    'LOG_LEVEL',
+    'LOG_QUEUE_SIZE',
+    'LOG_REPEAT_LIMIT',
+    'LOG_REPEAT_INTERVAL',
+    'WATCHLIST_POLL_INTERVAL',
+    'WATCHLIST_STREAM_TIMEOUT',
+    'WATCHLIST_MAX_STREAMS',
+    'WEBHOOK_TIMEOUT',
+    'WEBHOOK_MAX_ATTEMPTS',
+    'WEBHOOK_ALLOW_PRIVATE',
+    'UBO_TOLERANCE',
+    'UBO_MAX_ITERATIONS',
+    'GROUPS_MERGE_LIMIT',
+    'RESOLUTION_THRESHOLD',
+    'RESOLUTION_PROCESSES',
+    'STATS_TOP_K',
+)
 
 
 def create_app(test_config=None):
@@ -20,6 +89,10 @@ def create_app(test_config=None):
     app.register_blueprint(companies_blueprint)
     app.register_blueprint(partners_blueprint)
     app.register_blueprint(sanctions_blueprint)
+    app.register_blueprint(screening_blueprint)
+    app.register_blueprint(jobs_blueprint)
+    app.register_blueprint(watchlists_blueprint)
+    app.register_blueprint(stats_blueprint)
 
     if test_config:
         app.config.from_mapping(test_config)
@@ -29,7 +102,20 @@ def create_app(test_config=None):
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = \
             os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
 
+        for key in ENV_SETTINGS:
+            if key in os.environ:
+                app.config[key] = os.environ[key]
+
     setup_db(app)
+    setup_logging(app)
+    setup_read_model(app)
+    setup_exposure_cache(app)
+    setup_rate_limiting(app)
+    setup_screening_filter(app)
+    setup_notifications(app)
+    setup_beneficial_owners(app)
+    setup_groups(app)
+    setup_statistics(app)
 
     @app.route('/', methods=['GET'])
     def index():
@@ -52,6 +138,37 @@ def create_app(test_config=None):
             "message": error.error['description']
         }), error.status_code
 
+    @app.errorhandler(RateLimitError)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": error.description
+        })
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(sa.exc.TimeoutError)
+    def pool_exhausted(error):
+        # no connection was freed within DB_POOL_TIMEOUT
+        g.timed_out = 'pool'
+        app.logger.warning('database pool exhausted')
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "database busy, please retry later"
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    @app.errorhandler(RequestTimeout)
+    def gateway_timeout(error):
+        return jsonify({
+            "success": False,
+            "error": 504,
+            "message": error.description
+        }), 504
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
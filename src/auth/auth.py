@@ -1,9 +1,9 @@
 import json
 from functools import wraps
 import os
+import time
 
-from flask import request
-from jose import jwt
+from flask import current_app, g, request
 from urllib.request import urlopen
 
 
@@ -11,6 +11,15 @@ AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = os.getenv('ALGORITHMS')
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+# an unknown kid fetches the keys again, as after a rotation, at most this
+# often (seconds)
+JWKS_REFRESH_INTERVAL = 60
+
+# signing keys of AUTH0_DOMAIN by kid, fetched once per process, or in the
+# gunicorn master before the workers are forked (see src.prefork)
+_jwks = None
+_jwks_fetched_at = float('-inf')
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -67,16 +76,42 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
+def load_jwks():
+    """Fetch the public keys of AUTH0_DOMAIN."""
+    global _jwks, _jwks_fetched_at
+
     json_keys = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(json_keys.read())
+    _jwks = {key['kid']: {
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key['use'],
+        'n': key['n'],
+        'e': key['e']
+    } for key in json.loads(json_keys.read())['keys']}
+    _jwks_fetched_at = time.monotonic()
+
+    return _jwks
+
+
+def signing_key(kid):
+    """The public key ``kid``, or None when AUTH0_DOMAIN has none."""
+    jwks = _jwks
+    if jwks is None or kid not in jwks and \
+            time.monotonic() - _jwks_fetched_at >= JWKS_REFRESH_INTERVAL:
+        jwks = load_jwks()
+
+    return jwks.get(kid)
+
+
+def verify_decode_jwt(token):
+    # python-jose loads its crypto backends on import, deferred to the first
+    # token verified or done once in the gunicorn master (see src.prefork)
+    from jose import jwt
 
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # VALIDATE IF kid IS PRESENT IN JWT TOKEN HEADER
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
@@ -84,15 +119,7 @@ def verify_decode_jwt(token):
         }, 401)
 
     # CHOOSE WHICH KEY TO USE
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = signing_key(unverified_header['kid'])
     # IF THE CORRESPONDENT KEY IS FOUND, USE IT TO DECODE THE PAYLOAD
     if rsa_key:
         try:
@@ -130,13 +157,34 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def client_of(payload):
+    """The client making the request: the subject of its token."""
+    return payload.get('sub') or request.remote_addr
+
+
+def rate_limit(permission, payload, cost=None):
+    # the bucket is keyed on the subject of the token, so every integration
+    # is throttled on its own whatever the worker serving it
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return
+
+    limiter.hit(client_of(payload), permission, cost)
+
+
+def requires_auth(permission='', cost=None, budget=None):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
+            rate_limit(permission, payload, cost)
+            # read by the database routing to pin the client's reads
+            g.client = client_of(payload)
+            # read by the database timeouts to set the statement_timeout
+            if budget:
+                g.budget = budget
             return f(payload, *args, **kwargs)
 
         return wrapper
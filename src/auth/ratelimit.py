@@ -0,0 +1,235 @@
+import fcntl
+import os
+import random
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app
+
+
+# cost of a request by the permission it requires; anything not listed
+# costs one token. Routes that list whole tables declare LIST_COST instead.
+DEFAULT_COSTS = {
+    'delete:companies': 2,
+    'delete:partners': 2,
+}
+LIST_COST = 10
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after, description):
+        self.retry_after = retry_after
+        self.description = description
+
+
+class MemoryBuckets:
+    """Token buckets held by the worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key, cost, capacity, rate):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = _refill_and_take(tokens, updated, now,
+                                                   cost, capacity, rate)
+            self._buckets[key] = (tokens, now)
+
+        return retry_after
+
+
+class SharedBuckets:
+    """Token buckets in a SQLite file shared by every gunicorn worker.
+
+    Placed on a tmpfs such as ``/dev/shm`` the file never touches the disk,
+    and ``BEGIN IMMEDIATE`` serializes the read-modify-write of a bucket
+    across processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connect()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL, updated REAL)'
+        )
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=1, isolation_level=None)
+
+    @property
+    def connection(self):
+        # sqlite connections must not be shared between threads, and a
+        # forked worker must not reuse the connection of its parent
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def consume(self, key, cost, capacity, rate):
+        connection = self.connection
+        now = time.time()
+
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?', (key,)
+            ).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, retry_after = _refill_and_take(tokens, updated, now,
+                                                   cost, capacity, rate)
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets (key, tokens, updated) '
+                'VALUES (?, ?, ?)', (key, tokens, now)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return retry_after
+
+
+def _refill_and_take(tokens, updated, now, cost, capacity, rate):
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0
+
+    return tokens, (cost - tokens) / rate
+
+
+class MemorySlots:
+    """Concurrency cap for the threads of the worker process."""
+
+    def __init__(self, limit):
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        return self._semaphore.acquire(blocking=False) or None
+
+    def release(self, slot):
+        self._semaphore.release()
+
+
+class FileSlots:
+    """Concurrency cap shared by every gunicorn worker.
+
+    Each slot is a lock file; holding its ``flock`` holds the slot. The
+    kernel drops the lock when a worker dies, so slots are never leaked.
+    """
+
+    def __init__(self, directory, limit):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f'slot-{i}.lock')
+                      for i in range(limit)]
+
+    def acquire(self):
+        # starting anywhere avoids every request fighting for slot 0
+        start = random.randrange(len(self.paths))
+        for path in self.paths[start:] + self.paths[:start]:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+
+        return None
+
+    def release(self, slot):
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        os.close(slot)
+
+
+class RateLimiter:
+    def __init__(self, buckets, slots, capacity, rate, costs,
+                 concurrency_retry_after):
+        self.buckets = buckets
+        self.slots = slots
+        self.capacity = capacity
+        self.rate = rate
+        self.costs = costs
+        self.concurrency_retry_after = concurrency_retry_after
+
+    def hit(self, subject, permission, cost=None):
+        """Take the cost of a request from the bucket of ``subject``.
+
+        Raises:
+            RateLimitError: when the bucket does not hold enough tokens.
+        """
+        if cost is None:
+            cost = self.costs.get(permission, 1)
+
+        try:
+            retry_after = self.buckets.consume(subject, cost, self.capacity,
+                                               self.rate)
+        except sqlite3.Error:
+            # an unavailable limiter must not take the API down with it
+            return
+
+        if retry_after:
+            raise RateLimitError(max(1, round(retry_after)),
+                                 'Rate limit exceeded.')
+
+
+def setup_rate_limiting(app):
+    enabled = str(app.config.get('RATELIMIT_ENABLED', True)).lower()
+    if enabled in ('0', 'false', 'no'):
+        return None
+
+    storage = app.config.get('RATELIMIT_STORAGE', 'memory')
+    if storage == 'memory':
+        buckets = MemoryBuckets()
+    else:
+        buckets = SharedBuckets(storage)
+
+    concurrency = int(app.config.get('CONCURRENCY_LIMIT', 4))
+    lock_dir = app.config.get('CONCURRENCY_LOCK_DIR')
+    if lock_dir:
+        slots = FileSlots(lock_dir, concurrency)
+    else:
+        slots = MemorySlots(concurrency)
+
+    limiter = RateLimiter(
+        buckets,
+        slots,
+        capacity=float(app.config.get('RATELIMIT_CAPACITY', 60)),
+        rate=float(app.config.get('RATELIMIT_REFILL_RATE', 1)),
+        costs=dict(DEFAULT_COSTS, **app.config.get('RATELIMIT_COSTS', {})),
+        concurrency_retry_after=int(
+            app.config.get('CONCURRENCY_RETRY_AFTER', 1))
+    )
+    app.extensions['rate_limiter'] = limiter
+
+    return limiter
+
+
+def admission_control(f):
+    """Shed requests to an expensive route once the concurrency cap is hit.
+
+    Must be placed below ``requires_auth`` so unauthenticated requests never
+    take a slot.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        limiter = current_app.extensions.get('rate_limiter')
+        if limiter is None:
+            return f(*args, **kwargs)
+
+        slot = limiter.slots.acquire()
+        if slot is None:
+            raise RateLimitError(limiter.concurrency_retry_after,
+                                 'Server busy, please retry later.')
+        try:
+            return f(*args, **kwargs)
+        finally:
+            limiter.slots.release(slot)
+
+    return wrapper
@@ -1,25 +1,54 @@
-import sys
+from datetime import date
 
 from flask import (
     Blueprint,
     abort,
+    current_app,
     jsonify,
     request
 )
 
-from .database.models import Company, Partner
+from .database.models import (
+    db,
+    unit_of_work,
+    NESTED_LIMIT,
+    Company,
+    CompanyDocument,
+    Partner,
+    ownerships
+)
+from .database.timeouts import LIST_BUDGET, TIMEOUTS
 from .auth.auth import requires_auth
+from .auth.ratelimit import LIST_COST, admission_control
+from .encoding import respond, respond_document, respond_documents
+from .groups import company_group
+from .history import companies_as_of, company_as_of
+from .nested import MAX_PAGE_SIZE, ownership_page
+from .read_model import company_documents, mark_companies
+from .ubo import beneficial_owners
+from .utils import (
+    get_as_of_arg,
+    get_date_arg,
+    get_float_arg,
+    get_int_arg,
+    parse_share
+)
+from . import signals
 
 companies_blueprint = Blueprint('companies_blueprint', __name__)
 
 
 @companies_blueprint.route('/companies', methods=['GET'])
-@requires_auth('get:companies')
+@requires_auth('get:companies', cost=LIST_COST,
+               budget=LIST_BUDGET)
+@admission_control
 def companies(jwt):
     """Retrieves a list of all companies from the database.
 
     Args:
         jwt (str): the JSON Web Token used by the user.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to list the companies as they were then.
 
     Returns:
         JSON: A JSON with the following keys:
@@ -37,21 +66,250 @@ def companies(jwt):
                 - sanctions (list): list of sanctions the company received
                     - id (int)
                     - organization (str)
+                    - start_date (str)
+                    - end_date (str)
     """
+    as_of = get_as_of_arg()
+
     try:
-        companies = Company.query.all()
+        if as_of:
+            companies_lst = [company.format()
+                             for company in companies_as_of(as_of)]
+        else:
+            documents = company_documents()
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    if as_of:
+        return respond({
+            'success': True,
+            'companies': companies_lst
+        }, table='companies')
+
+    return respond_documents('companies', documents)
+
+
+@companies_blueprint.route('/companies/<int:id>', methods=['GET'])
+@requires_auth('get:companies')
+def company(jwt, id):
+    """Retrieves a company, with its partners and sanctions.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to get the company as it was then.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - company (dict): the company in the format of /companies.
+    """
+    as_of = get_as_of_arg()
+    if as_of:
+        company = company_as_of(id, as_of)
+        if company is None:
+            abort(404)
+
+        return respond({
+            'success': True,
+            'company': company.format()
+        })
+
+    document = CompanyDocument.query.get_or_404(id)
+
+    return respond_document('company', document.document)
+
+
+@companies_blueprint.route('/companies/<int:id>/partners', methods=['GET'])
+@requires_auth('get:companies')
+def company_partners(jwt, id):
+    """Retrieves a page of the partners of a company.
+
+    A company embeds its first partners only; the others are read from
+    its ``partners_cursor``, one page after the other.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        cursor (int): optional ``next_cursor`` of the previous page, or
+            ``partners_cursor`` of the company, in the query string.
+            Defaults to the first page.
+        limit (int): optional number of partners of the page, up to 1000.
+            Defaults to 100.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - partners (list): the partners ordered by id, in the format
+              of the partners of /companies.
+            - total (int): number of partners of the company.
+            - next_cursor (int): cursor of the next page, None on the
+              last one.
+    """
+    Company.query.get_or_404(id)
+    cursor = get_int_arg('cursor', 0, min_value=0)
+    limit = get_int_arg('limit', NESTED_LIMIT, min_value=1,
+                        max_value=MAX_PAGE_SIZE)
+
+    partners, total, next_cursor = ownership_page(Partner, id, cursor, limit)
+
+    return respond({
+        'success': True,
+        'partners': [partner.format(companies_info=False)
+                     for partner in partners],
+        'total': total,
+        'next_cursor': next_cursor
+    }, table='partners')
+
+
+@companies_blueprint.route('/companies/<int:id>/eligibility',
+                           methods=['GET'])
+@requires_auth('get:companies')
+def company_eligibility(jwt, id):
+    """Check whether a company may be contracted on a given date.
+
+    A company is not eligible when it has a sanction in force or when one of
+    its partners owns another company with a sanction in force.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        active_at (str): optional date (YYYY-MM-DD) in the query string,
+            usually the contract date. Defaults to the date of ``as_of``,
+            or today.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string. The check uses the sanctions and ownerships
+            recorded at that moment instead of the current ones.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - eligibility (dict): eligibility of the company:
+                - id (int)
+                - active_at (str)
+                - as_of (str): only when it was given
+                - eligible (bool)
+                - sanctions (list): sanctions of the company in force
+                - partners_sanctions (list): sanctions in force of other
+                  companies owned by the company's partners:
+                    - partner_id (int)
+                    - company_id (int)
+                    - sanction (dict)
+    """
+    as_of = get_as_of_arg()
+    if as_of:
+        company = company_as_of(id, as_of)
+        if company is None:
+            abort(404)
+    else:
+        company = Company.query.get_or_404(id)
+    active_at = get_date_arg('active_at',
+                             as_of.date() if as_of else date.today())
 
-        companies_lst = [company.format() for company in companies]
+    try:
+        eligibility = company.eligibility(active_at, as_of)
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
     return jsonify({
         'success': True,
-        'companies': companies_lst
+        'eligibility': eligibility
     }), 200
 
 
+@companies_blueprint.route('/companies/<int:id>/beneficial-owners',
+                           methods=['GET'])
+@requires_auth('get:companies')
+def company_beneficial_owners(jwt, id):
+    """Retrieves the partners holding a company in the end.
+
+    Shares held through holding companies are added up along every chain
+    by the ``compute_beneficial_owners`` job, which runs after ownerships,
+    companies or partners change; this is a lookup of its last result.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        min_share (float): optional smallest share (percentage) in the
+            query string. Defaults to 25.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - beneficial_owners (dict):
+                - id (int)
+                - min_share (float)
+                - computed_at (str): when the shares were computed, None
+                  when the company has none
+                - owners (list): the largest shares first:
+                    - partner (dict)
+                    - share (float): percentage held in the end
+                    - direct_share (float): percentage held directly, None
+                      when held only through holdings
+    """
+    Company.query.get_or_404(id)
+    min_share = get_float_arg('min_share', 25, min_value=0, max_value=100)
+
+    owners = beneficial_owners(id, min_share)
+
+    return respond({
+        'success': True,
+        'beneficial_owners': {
+            'id': id,
+            'min_share': min_share,
+            'computed_at': owners[0].computed_at.isoformat()
+            if owners else None,
+            'owners': [owner.format() for owner in owners]
+        }
+    })
+
+
+@companies_blueprint.route('/companies/<int:id>/group', methods=['GET'])
+@requires_auth('get:companies', budget=LIST_BUDGET)
+def company_economic_group(jwt, id):
+    """Retrieves the economic group of a company.
+
+    The group gathers every company and partner linked to the company
+    through chains of ownerships, partners that are companies included.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        active_at (str): optional date (YYYY-MM-DD) in the query string the
+            sanctions must be in force on. Defaults to today.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - group (dict):
+                - id (int): Id of the group, one of its company ids
+                - active_at (str)
+                - sanctioned (bool): whether a company of the group has a
+                  sanction in force
+                - companies (list): companies of the group, ordered by id
+                - partners (list): partners of the group, ordered by id
+    """
+    Company.query.get_or_404(id)
+    active_at = get_date_arg('active_at', date.today())
+
+    group = company_group(id, active_at)
+    if group is None:
+        # groups of companies loaded since the last rebuild_groups job
+        abort(404)
+
+    return respond({
+        'success': True,
+        'group': group
+    })
+
+
 @companies_blueprint.route('/companies', methods=['POST'])
 @requires_auth('post:companies')
 def new_company(jwt):
@@ -59,7 +317,8 @@ def new_company(jwt):
 
     Args:
         jwt (str): the JSON Web Token used by the user.
-        fiscal_number (str): Fiscal number of the company.
+        fiscal_number (str): Fiscal number (CNPJ) of the company, with or
+            without punctuation. Its check digits must be valid.
         name (str): Name of the company.
 
     Returns:
@@ -68,18 +327,25 @@ def new_company(jwt):
             - created (int): Id of the created company.
     """
     try:
-        data = request.get_json()
+        with unit_of_work():
+            data = request.get_json()
 
-        fiscal_number = data.get('fiscal_number')
-        name = data.get('name')
+            fiscal_number = data.get('fiscal_number')
+            name = data.get('name')
 
-        company = Company(fiscal_number=fiscal_number, name=name)
+            company = Company(fiscal_number=fiscal_number, name=name)
 
-        company.insert()
+            company.insert()
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.companies_changed.send(current_app._get_current_object(),
+                                   company_ids={company.id},
+                                   action='created')
+
     return jsonify({
         'success': True,
         'created': company.id
@@ -104,20 +370,30 @@ def update_company(jwt, id):
     """
     company = Company.query.get_or_404(id)
     try:
-        data = request.get_json()
-        fiscal_number = data.get('fiscal_number')
-        name = data.get('name')
-
-        if fiscal_number:
-            company.fiscal_number = fiscal_number
-        if name:
-            company.name = name
-
-        company.update()
+        with unit_of_work():
+            data = request.get_json()
+            fiscal_number = data.get('fiscal_number')
+            name = data.get('name')
+
+            columns = set()
+            if fiscal_number:
+                company.fiscal_number = fiscal_number
+                columns.add('fiscal_number')
+            if name:
+                company.name = name
+                columns.add('name')
+
+            company.update()
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.companies_changed.send(current_app._get_current_object(),
+                                   company_ids={company.id},
+                                   action='updated', columns=columns)
+
     return jsonify({
         'success': True,
         'updated': company.id
@@ -141,18 +417,72 @@ def delete_company(jwt, id):
     company = Company.query.get_or_404(id)
 
     try:
-        company.delete()
+        with unit_of_work():
+            company.delete()
 
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.companies_changed.send(current_app._get_current_object(),
+                                   company_ids={id},
+                                   action='deleted')
+
     return jsonify({
         'success': True,
         'deleted': id
     }), 200
 
 
+@companies_blueprint.route('/companies', methods=['DELETE'])
+@requires_auth('delete:companies')
+def delete_companies(jwt):
+    """Delete several companies from the database at once.
+
+    Partners' ownerships and sanctions of the deleted companies are removed
+    by the database itself, so the whole operation is a single statement.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        ids (str): comma separated list of the ids of the companies to be
+            deleted (query string).
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - deleted (list): Ids of the deleted companies.
+    """
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',')]
+    except ValueError:
+        abort(400)
+
+    try:
+        with unit_of_work():
+            # the documents of their partners embed the companies
+            mark_companies(ids)
+            deleted = Company.bulk_delete(ids)
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    if not deleted:
+        abort(404)
+
+    signals.companies_changed.send(current_app._get_current_object(),
+                                   company_ids=set(deleted),
+                                   action='deleted')
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted
+    }), 200
+
+
 @companies_blueprint.route(
     '/companies/<int:company_id>/partners/<int:partner_id>',
     methods=['PUT']
@@ -161,24 +491,50 @@ def delete_company(jwt, id):
 def add_partner_to_company(jwt, company_id, partner_id):
     """Associate a partner with its company.
 
+    Associating them again only updates the share.
+
     Args:
         jwt (str): the JSON Web Token used by the user.
         company_id (int): Id of the company we want to add a partner.
         partner_id (int): Id of the partner we want to add to the company.
+        share (float): optional percentage of the company held by the
+            partner, above 0 up to 100.
 
     Returns:
         JSON: A JSON with the following key:
             - success (bool): Indicates if the request was successful.
     """
-    company = Company.query.get_or_404(company_id)
-    partner = Partner.query.get_or_404(partner_id)
+    Company.query.get_or_404(company_id)
+    Partner.query.get_or_404(partner_id)
+    edge = db.and_(ownerships.c.company_id == company_id,
+                   ownerships.c.partner_id == partner_id)
+    # the primary key of ownerships answers, whatever the number of partners
+    created = not db.session.scalar(
+        db.select(db.select(ownerships).where(edge).exists()))
     try:
-        company.partners.append(partner)
-        company.update()
+        with unit_of_work():
+            data = request.get_json(silent=True) or {}
+            share = parse_share(data.get('share'))
+
+            if created:
+                db.session.execute(db.insert(ownerships).values(
+                    company_id=company_id, partner_id=partner_id,
+                    share=share))
+                mark_companies({company_id})
+            elif share is not None:
+                db.session.execute(
+                    db.update(ownerships).where(edge).values(share=share))
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.ownerships_changed.send(current_app._get_current_object(),
+                                    edges={(company_id, partner_id)},
+                                    action='created' if created
+                                    else 'updated')
+
     return jsonify({
         'success': True
     }), 200
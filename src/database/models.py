@@ -1,64 +1,247 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ..documents import (
+    LEGAL_ENTITY,
+    NATURAL_PERSON,
+    format_cnpj,
+    format_document,
+    parse_cnpj,
+    parse_document
+)
+from .routing import RoutingSession, setup_replicas
+from .timeouts import engine_options, setup_timeouts
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 def setup_db(app):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
     db.app = app
     db.init_app(app)
+    router = setup_replicas(app)
+    replicas = router.replicas if router else []
 
     with app.app_context():
+        setup_timeouts(app, [db.engine] + [replica.engine
+                                           for replica in replicas])
         db.create_all()
 
 
+# partners of a company, or companies of a partner, embedded in its
+# document; the others are read a page at a time (see src.nested)
+NESTED_LIMIT = 100
+
+
+def nested_cursor(rows, limit):
+    """Cursor of the rows after the first ``limit`` ones, None if none."""
+    return rows[limit - 1].id if limit is not None and len(rows) > limit \
+        else None
+
+
+def _nested(instance, key, model, limit):
+    """The first ``limit`` rows of the collection ``key`` of ``instance``,
+    their total and cursor.
+
+    A loaded collection, such as those of the past versions read by
+    ``src.history``, is sliced; otherwise only the page is read, unless
+    ``limit`` is None.
+    """
+    if limit is None or key not in db.inspect(instance).unloaded:
+        rows = getattr(instance, key)
+        return rows[:limit], len(rows), nested_cursor(rows, limit)
+
+    # src.nested reads the models of this module
+    from ..nested import ownership_page
+
+    return ownership_page(model, instance.id, limit=limit)
+
+
 ownerships = db.Table(
     'ownerships',
-    db.Column('company_id', db.Integer, db.ForeignKey('companies.id'),
+    db.Column('company_id', db.Integer,
+              db.ForeignKey('companies.id', ondelete='CASCADE'),
               primary_key=True),
-    db.Column('partner_id', db.Integer, db.ForeignKey('partners.id'),
-              primary_key=True)
+    db.Column('partner_id', db.Integer,
+              db.ForeignKey('partners.id', ondelete='CASCADE'),
+              primary_key=True),
+    # percentage of the company held by the partner, NULL when unknown
+    db.Column('share', db.Numeric(7, 4)),
+    db.CheckConstraint('share > 0 AND share <= 100',
+                       name='ownerships_share_check'),
+    # the companies of a partner; those of a company use the primary key
+    db.Index('ix_ownerships_partner_id_company_id',
+             'partner_id', 'company_id')
 )
 
 
+class UnitOfWork:
+    """Writes of several rows committed as a single transaction.
+
+    While a unit of work is active, ``insert``, ``update``, ``delete`` and
+    ``bulk_delete`` of the models only stage their changes in the session.
+    They are flushed together when the block ends, so SQLAlchemy batches the
+    statements of each table (executemany, or one multi-row INSERT ...
+    RETURNING), and committed once. An exception rolls every change back.
+    """
+
+    def __init__(self):
+        self._before_commit = []
+        self._after_commit = []
+
+    def before_commit(self, fn, *args, **kwargs):
+        """Call ``fn`` in the transaction, right before it is committed."""
+        self._before_commit.append((fn, args, kwargs))
+
+    def after_commit(self, fn, *args, **kwargs):
+        """Call ``fn`` once the transaction is committed, e.g. to send the
+        signals of the changes. Nothing is called on a rollback."""
+        self._after_commit.append((fn, args, kwargs))
+
+    def _commit(self):
+        db.session.flush()
+        for fn, args, kwargs in self._before_commit:
+            fn(*args, **kwargs)
+        db.session.commit()
+
+
+_unit_of_work = ContextVar('unit_of_work', default=None)
+
+
+@contextmanager
+def unit_of_work():
+    """Run the writes of the block as one transaction.
+
+    A block nested in another one joins the enclosing unit of work.
+
+    Yields:
+        UnitOfWork: the active unit of work, to register commit hooks.
+    """
+    active = _unit_of_work.get()
+    if active is not None:
+        yield active
+        return
+
+    uow = UnitOfWork()
+    token = _unit_of_work.set(uow)
+    try:
+        yield uow
+        uow._commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        _unit_of_work.reset(token)
+
+    for fn, args, kwargs in uow._after_commit:
+        fn(*args, **kwargs)
+
+
+def _commit():
+    # inside a unit of work, the commit happens once at the end of its block
+    if _unit_of_work.get() is None:
+        db.session.commit()
+
+
 class DBModelInterface(db.Model):
     __abstract__ = True
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        _commit()
 
     def update(self):
-        db.session.commit()
+        _commit()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        _commit()
+
+    @classmethod
+    def from_row(cls, row):
+        """Detached instance holding the columns of ``row``.
+
+        The values are set as loaded ones, without validation, e.g. to
+        format rows of the history tables.
+        """
+        instance = cls()
+        for column in cls.__table__.columns:
+            set_committed_value(instance, column.name,
+                                row._mapping[column.name])
+
+        return instance
+
+    @classmethod
+    def bulk_delete(cls, ids):
+        """Delete every row whose id is in ``ids`` with a single statement.
+
+        Child rows are removed by the ``ON DELETE CASCADE`` foreign keys, so
+        nothing is loaded into the session.
+
+        Returns:
+            list: ids of the rows that were actually deleted.
+        """
+        deleted = db.session.execute(
+            db.delete(cls).where(cls.id.in_(ids)).returning(cls.id)
+        ).scalars().all()
+        _commit()
+
+        return deleted
 
 
 class Company(DBModelInterface):
     __tablename__ = "companies"
 
     id = db.Column(db.Integer, primary_key=True)
-    fiscal_number = db.Column(db.String, nullable=False, unique=True)
+    # CNPJ stored as an integer; format() pads it back to 14 digits
+    fiscal_number = db.Column(db.BigInteger, nullable=False, unique=True)
     name = db.Column(db.String, nullable=False)
 
+    # passive_deletes leaves the removal of ownerships and sanctions to the
+    # ON DELETE CASCADE foreign keys instead of loading the collections
+    # ordered by id, so formatting a company always gives the same document
     partners = db.relationship('Partner', secondary=ownerships, lazy=True,
-                               backref=db.backref('companies', lazy=True))
-    sanctions = db.relationship('Sanction', lazy=True,
+                               passive_deletes=True, order_by='Partner.id',
+                               backref=db.backref('companies', lazy=True,
+                                                  passive_deletes=True,
+                                                  order_by='Company.id'))
+    sanctions = db.relationship('Sanction', lazy=True, passive_deletes=True,
+                                order_by='Sanction.id',
                                 backref=db.backref('company', lazy=False))
 
-    def format(self, partners_info=True, sanctions_info=True):
+    def format(self, partners_info=True, sanctions_info=True,
+               limit=NESTED_LIMIT, page=None):
+        """The company as a dict.
+
+        Args:
+            partners_info (bool): include the partners, the first ``limit``
+                ones with their total and the cursor of the others, or all
+                of them when ``limit`` is None.
+            sanctions_info (bool): include the sanctions.
+            limit (int): most partners included.
+            page (tuple): the first page of partners, their total and
+                cursor, when read beforehand (see ``src.nested``).
+        """
         company_dict = {
             'id': self.id,
-            'fiscal_number': self.fiscal_number,
+            'fiscal_number': format_cnpj(self.fiscal_number),
             'name': self.name
         }
 
         if partners_info:
+            partners, total, cursor = page or _nested(self, 'partners',
+                                                      Partner, limit)
             partners_lst = [partner.format(companies_info=False)
-                            for partner in self.partners]
+                            for partner in partners]
 
             company_dict['partners'] = partners_lst
+            if limit is not None:
+                company_dict['partners_total'] = total
+                company_dict['partners_cursor'] = cursor
 
         if sanctions_info:
             sanctions_lst = [sanction.format() for sanction in self.sanctions]
@@ -67,41 +250,813 @@ class Company(DBModelInterface):
 
         return company_dict
 
+    @db.validates('fiscal_number')
+    def validate_fiscal_number(self, key, fiscal_number):
+        return parse_cnpj(fiscal_number)
+
+    def eligibility(self, active_at, as_of=None):
+        """Check whether the company may be contracted on ``active_at``.
+
+        A company is not eligible when it has a sanction in force or when
+        one of its partners owns another company with a sanction in force.
+
+        Args:
+            active_at (date): the date the sanctions must be in force.
+            as_of (datetime): optional moment (UTC) whose sanctions and
+                ownerships are used, read from the history tables.
+                Defaults to the current ones.
+
+        Returns:
+            dict: eligibility of the company with the sanctions found.
+        """
+        ours = rows_at(ownerships, ownerships_history, as_of, 'ours')
+        theirs = rows_at(ownerships, ownerships_history, as_of, 'theirs')
+        own = rows_at(Sanction.__table__, sanctions_history, as_of, 'own')
+        other = rows_at(Sanction.__table__, sanctions_history, as_of,
+                        'other')
+
+        sanctions = db.session.execute(
+            db.select(own)
+            .where(own.c.company_id == self.id,
+                   Sanction.active_at(active_at, own))
+            .order_by(own.c.id)
+        ).all()
+
+        related = db.session.execute(
+            db.select(other, theirs.c.partner_id)
+            .join(theirs, theirs.c.company_id == other.c.company_id)
+            .join(ours, ours.c.partner_id == theirs.c.partner_id)
+            .where(ours.c.company_id == self.id,
+                   other.c.company_id != self.id,
+                   Sanction.active_at(active_at, other))
+            .order_by(theirs.c.partner_id, other.c.id)
+        ).all()
+
+        result = {
+            'id': self.id,
+            'active_at': active_at.isoformat(),
+            'eligible': not sanctions and not related,
+            'sanctions': [Sanction.from_row(row).format()
+                          for row in sanctions],
+            'partners_sanctions': [
+                {
+                    'partner_id': row.partner_id,
+                    'company_id': row.company_id,
+                    'sanction': Sanction.from_row(row).format()
+                }
+                for row in related
+            ]
+        }
+        if as_of is not None:
+            result['as_of'] = as_of.isoformat()
+
+        return result
+
 
 class Partner(DBModelInterface):
     __tablename__ = "partners"
+    __table_args__ = (
+        db.UniqueConstraint('document', 'person_type',
+                            name='partners_document_person_type_key'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    document = db.Column(db.String, nullable=False, unique=True)
+    # CPF or CNPJ stored as an integer; person_type tells them apart
+    document = db.Column(db.BigInteger, nullable=False)
+    person_type = db.Column(db.String(1), nullable=False)
     name = db.Column(db.String, nullable=False)
 
-    def format(self, companies_info=True):
+    @db.validates('document')
+    def validate_document(self, key, document):
+        document, self.person_type = parse_document(document)
+        return document
+
+    @classmethod
+    def is_company(cls, company):
+        """SQL criterion matching a partner with the company it is."""
+        return db.and_(cls.person_type == LEGAL_ENTITY,
+                       cls.document == company.fiscal_number)
+
+    @classmethod
+    def cpf_middle(cls):
+        """SQL expression of the middle digits of the CPF of a person, as
+        ``documents.cpf_middle``."""
+        return cls.document // 100 % 1_000_000
+
+    def format(self, companies_info=True, limit=NESTED_LIMIT, page=None):
+        """The partner as a dict, with the first ``limit`` companies it
+        owns, their total and the cursor of the others, or all of them when
+        ``limit`` is None. ``page`` holds the first page of companies, when
+        read beforehand."""
         partner_dict = {
             'id': self.id,
-            'document': self.document,
+            'document': format_document(self.document, self.person_type),
             'name': self.name
         }
 
         if companies_info:
+            companies, total, cursor = page or _nested(self, 'companies',
+                                                       Company, limit)
             companies_lst = [
                 company.format(partners_info=False)
-                for company in self.companies
+                for company in companies
             ]
             partner_dict['companies'] = companies_lst
+            if limit is not None:
+                partner_dict['companies_total'] = total
+                partner_dict['companies_cursor'] = cursor
 
         return partner_dict
 
 
+# people known by a masked CPF are looked up by its middle digits
+db.Index('ix_partners_cpf_middle', Partner.cpf_middle(),
+         postgresql_where=Partner.person_type == NATURAL_PERSON)
+
+
 class Sanction(DBModelInterface):
     __tablename__ = "sanctions"
+    # validity periods are looked up by date, either for a set of companies
+    # or for the whole table, so both are served by an index range scan
+    __table_args__ = (
+        db.Index('ix_sanctions_company_id_period',
+                 'company_id', 'start_date', 'end_date'),
+        db.Index('ix_sanctions_period', 'start_date', 'end_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     organization = db.Column(db.String, nullable=False)
-    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'))
+    company_id = db.Column(db.Integer,
+                           db.ForeignKey('companies.id', ondelete='CASCADE'))
+    # a missing start or end date means the period is open on that side
+    start_date = db.Column(db.Date)
+    end_date = db.Column(db.Date)
+
+    @classmethod
+    def active_at(cls, date, sanctions=None):
+        """SQL criterion selecting the sanctions in force on ``date``.
+
+        Args:
+            date (date): the date the sanctions must be in force.
+            sanctions: selectable of sanctions to filter, such as the one
+                of ``as_of``. Defaults to the sanctions table.
+        """
+        columns = cls if sanctions is None else sanctions.c
+        return db.and_(
+            db.or_(columns.start_date.is_(None), columns.start_date <= date),
+            db.or_(columns.end_date.is_(None), columns.end_date >= date)
+        )
+
+    def format(self):
+        return {
+            'id': self.id,
+            'organization': self.organization,
+            'start_date': self.start_date and self.start_date.isoformat(),
+            'end_date': self.end_date and self.end_date.isoformat()
+        }
+
+
+def _history(table, *keys):
+    """Table of the versions of the rows of ``table``.
+
+    A version holds the values of the row from ``valid_from`` until
+    ``valid_to``, NULL while it is the current one. Each of ``keys`` is
+    indexed together with ``valid_from``, so the versions of a row, or of
+    the edges of a node, at a point in time are found by a range scan.
+    """
+    name = f'{table.name}_history'
+    history = db.Table(
+        name,
+        db.Column('version', db.BigInteger, primary_key=True),
+        *[db.Column(column.name, column.type) for column in table.columns],
+        db.Column('valid_from', db.DateTime, nullable=False),
+        db.Column('valid_to', db.DateTime),
+        *[db.Index(f'ix_{name}_{"_".join(key)}_valid_from',
+                   *key, 'valid_from')
+          for key in keys]
+    )
+    # created after ``table``, which its triggers are attached to
+    history.add_is_dependent_on(table)
+    db.event.listen(history, 'after_create', db.DDL(
+        versioning_ddl(table, keys[0])).execute_if(dialect='postgresql'))
+
+    return history
+
+
+def versioning_ddl(table, key):
+    """Triggers recording the writes to ``table`` in its history table.
+
+    The triggers are statement level, so a bulk write adds its versions
+    with a single statement. The history starts with the rows present when
+    the triggers are created. Keys are never updated.
+    """
+    name = table.name
+    columns = ', '.join(column.name for column in table.columns)
+    values = ', '.join('n.' + column.name for column in table.columns)
+    now = "now() AT TIME ZONE 'UTC'"
+    join = ' AND '.join(f'n.{column} = o.{column}' for column in key)
+    current = ' AND '.join(f'h.{column} = o.{column}' for column in key)
+
+    changed = f'FROM new_rows n JOIN old_rows o ON {join}\n' \
+        '    WHERE o IS DISTINCT FROM n'
+
+    existing = f'FROM {name} n\n' \
+        f'    WHERE NOT EXISTS (SELECT 1 FROM {name}_history)'
+
+    def insert(source):
+        return f"""INSERT INTO {name}_history ({columns}, valid_from)
+    SELECT {values}, {now}
+    {source};"""
+
+    return f"""
+CREATE OR REPLACE FUNCTION {name}_insert_versions() RETURNS trigger AS $$
+BEGIN
+    {insert('FROM new_rows n')}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {name}_update_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE {name}_history h SET valid_to = {now}
+    FROM old_rows o JOIN new_rows n ON {join}
+    WHERE {current} AND h.valid_to IS NULL
+      AND o IS DISTINCT FROM n;
+    {insert(changed)}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION {name}_delete_versions() RETURNS trigger AS $$
+BEGIN
+    UPDATE {name}_history h SET valid_to = {now}
+    FROM old_rows o
+    WHERE {current} AND h.valid_to IS NULL;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {name}_insert_versions ON {name};
+CREATE TRIGGER {name}_insert_versions AFTER INSERT ON {name}
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {name}_insert_versions();
+
+DROP TRIGGER IF EXISTS {name}_update_versions ON {name};
+CREATE TRIGGER {name}_update_versions AFTER UPDATE ON {name}
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {name}_update_versions();
+
+DROP TRIGGER IF EXISTS {name}_delete_versions ON {name};
+CREATE TRIGGER {name}_delete_versions AFTER DELETE ON {name}
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {name}_delete_versions();
+
+{insert(existing)}
+"""
+
+
+# system-versioned history of the tables above, written by triggers
+companies_history = _history(Company.__table__, ('id',))
+partners_history = _history(Partner.__table__, ('id',))
+ownerships_history = _history(ownerships, ('company_id', 'partner_id'),
+                              ('partner_id',))
+sanctions_history = _history(Sanction.__table__, ('id',), ('company_id',))
+
+
+def valid_at(history, as_of):
+    """SQL criterion selecting the versions valid at ``as_of``."""
+    return db.and_(history.c.valid_from <= as_of,
+                   db.or_(history.c.valid_to.is_(None),
+                          history.c.valid_to > as_of))
+
+
+def rows_at(table, history, as_of, name=None):
+    """Selectable of the rows of ``table`` as they were at ``as_of``.
+
+    Returns ``table`` itself, aliased when ``name`` is given, when
+    ``as_of`` is None, so a query reads current and past rows alike.
+    """
+    if as_of is None:
+        return table.alias(name) if name else table
+
+    return db.select(*[history.c[column.name] for column in table.columns]) \
+        .where(valid_at(history, as_of)) \
+        .subquery(name)
+
+
+class CompanyDocument(db.Model):
+    """Read model: the JSON of ``Company.format()``, ready to be sent.
+
+    Kept up to date by ``src.read_model`` in the transaction that changes
+    the company, its partners or its sanctions.
+    """
+    __tablename__ = "company_documents"
+
+    company_id = db.Column(db.Integer,
+                           db.ForeignKey('companies.id', ondelete='CASCADE'),
+                           primary_key=True)
+    document = db.Column(db.Text, nullable=False)
+
+
+class PartnerDocument(db.Model):
+    """Read model: the JSON of ``Partner.format()``, ready to be sent."""
+    __tablename__ = "partner_documents"
+
+    partner_id = db.Column(db.Integer,
+                           db.ForeignKey('partners.id', ondelete='CASCADE'),
+                           primary_key=True)
+    document = db.Column(db.Text, nullable=False)
+
+
+class StatCounter(db.Model):
+    """Count maintained by the triggers of ``counters_ddl``.
+
+    A count is the sum of the values of its shards; each transaction adds
+    to the shard of its connection, so concurrent writes seldom wait for
+    the same row. ``key`` tells apart the counts of a breakdown, such as
+    the sanctions of each organization.
+    """
+    __tablename__ = "stat_counters"
+
+    name = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String, primary_key=True, default='')
+    shard = db.Column(db.SmallInteger, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False)
+
+
+class CompanyStats(db.Model):
+    """Number of partners and sanctions of a company, maintained by the
+    triggers of ``counters_ddl``. Companies that never had any have no
+    row."""
+    __tablename__ = "company_stats"
+    # the companies with the most partners in an index range scan
+    __table_args__ = (
+        db.Index('ix_company_stats_partners', db.desc('partners'),
+                 'company_id'),
+    )
+
+    # no foreign key: the row must outlive the cascades of a delete, which
+    # update it, until the trigger of the company deletes it
+    company_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    partners = db.Column(db.Integer, nullable=False, default=0)
+    sanctions = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TopCompany(db.Model):
+    """The companies with the most partners, ranked by the
+    ``refresh_stats`` job, see ``src.statistics``."""
+    __tablename__ = "top_companies"
+
+    rank = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer,
+                           db.ForeignKey('companies.id', ondelete='CASCADE'),
+                           nullable=False)
+    partners = db.Column(db.Integer, nullable=False)
+    refreshed_at = db.Column(db.DateTime, nullable=False)
+
+    company = db.relationship('Company', lazy='joined')
+
+
+# transactions add to one of STAT_SHARDS rows of a count
+STAT_SHARDS = 16
+
+
+def counters_ddl():
+    """Triggers maintaining ``stat_counters`` and ``company_stats``.
+
+    As the versioning triggers, they are statement level: a bulk write
+    updates each count once. Rows removed by the cascades of a company
+    delete no longer count for the company, whose row is deleted by the
+    trigger of ``companies``. The counts start with the rows present when
+    the triggers are created.
+    """
+    def count(rows, sign):
+        return f'{sign} * (SELECT count(*) FROM {rows})'
+
+    def ownerships_counts(rows, sign):
+        return f"""PERFORM bump_stat('ownerships', '', {count(rows, sign)});
+    INSERT INTO company_stats (company_id, partners, sanctions)
+    SELECT r.company_id, {sign} * count(*), 0
+    FROM {rows} r JOIN companies c ON c.id = r.company_id
+    GROUP BY r.company_id
+    ON CONFLICT (company_id) DO UPDATE
+    SET partners = company_stats.partners + excluded.partners;"""
+
+    def sanctions_counts(rows, sign):
+        return f"""PERFORM bump_stat('sanctions', '', {count(rows, sign)});
+    PERFORM bump_stat('sanctions_by_organization', organization, sanctions)
+    FROM (SELECT organization, {sign} * count(*) AS sanctions
+          FROM {rows} GROUP BY organization) organizations;
+    WITH delta AS (
+        SELECT r.company_id, {sign} * count(*) AS sanctions
+        FROM {rows} r JOIN companies c ON c.id = r.company_id
+        GROUP BY r.company_id
+    ), previous AS (
+        SELECT d.company_id, d.sanctions, coalesce(s.sanctions, 0) AS before
+        FROM delta d LEFT JOIN company_stats s USING (company_id)
+    ), upserted AS (
+        INSERT INTO company_stats (company_id, partners, sanctions)
+        SELECT company_id, 0, sanctions FROM delta
+        ON CONFLICT (company_id) DO UPDATE
+        SET sanctions = company_stats.sanctions + excluded.sanctions
+    )
+    SELECT count(*) FILTER (WHERE before = 0 AND before + sanctions > 0)
+         - count(*) FILTER (WHERE before > 0 AND before + sanctions = 0)
+    INTO changed FROM previous;
+    PERFORM bump_stat('sanctioned_companies', '', changed);"""
+
+    def trigger(table, event, body, transitions):
+        function = f'{table}_{event.lower()}_stats'
+        return f"""
+CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+DECLARE
+    changed bigint;
+BEGIN
+    {body}
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS {function} ON {table};
+CREATE TRIGGER {function} AFTER {event} ON {table}
+    REFERENCING {transitions}
+    FOR EACH STATEMENT EXECUTE FUNCTION {function}();
+"""
+
+    new = 'NEW TABLE AS new_rows'
+    old = 'OLD TABLE AS old_rows'
+    deleted = count('old_rows', -1)
+    companies_delete = f"""PERFORM bump_stat('companies', '', {deleted});
+    WITH deleted AS (
+        DELETE FROM company_stats s USING old_rows o
+        WHERE s.company_id = o.id
+        RETURNING s.sanctions
+    )
+    SELECT count(*) FILTER (WHERE sanctions > 0) INTO changed FROM deleted;
+    PERFORM bump_stat('sanctioned_companies', '', -changed);"""
+    triggers = ''.join((
+        trigger('companies', 'INSERT', f"PERFORM bump_stat('companies', '', "
+                f"{count('new_rows', 1)});", new),
+        trigger('companies', 'DELETE', companies_delete, old),
+        trigger('partners', 'INSERT', f"PERFORM bump_stat('partners', '', "
+                f"{count('new_rows', 1)});", new),
+        trigger('partners', 'DELETE', f"PERFORM bump_stat('partners', '', "
+                f"{count('old_rows', -1)});", old),
+        trigger('ownerships', 'INSERT', ownerships_counts('new_rows', 1), new),
+        trigger('ownerships', 'DELETE', ownerships_counts('old_rows', -1),
+                old),
+        trigger('sanctions', 'INSERT', sanctions_counts('new_rows', 1), new),
+        trigger('sanctions', 'UPDATE', sanctions_counts('old_rows', -1)
+                + '\n    ' + sanctions_counts('new_rows', 1), f'{old} {new}'),
+        trigger('sanctions', 'DELETE', sanctions_counts('old_rows', -1), old),
+    ))
+
+    return f"""
+CREATE OR REPLACE FUNCTION bump_stat(stat_name varchar, stat_key varchar,
+                                     delta bigint) RETURNS void AS $$
+BEGIN
+    IF delta <> 0 THEN
+        INSERT INTO stat_counters (name, key, shard, value)
+        VALUES (stat_name, stat_key, mod(pg_backend_pid(), {STAT_SHARDS}),
+                delta)
+        ON CONFLICT (name, key, shard)
+        DO UPDATE SET value = stat_counters.value + excluded.value;
+    END IF;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rebuild_stat_counters() RETURNS void AS $$
+BEGIN
+    LOCK TABLE companies, partners, ownerships, sanctions IN SHARE MODE;
+    DELETE FROM stat_counters;
+    DELETE FROM company_stats;
+    INSERT INTO company_stats (company_id, partners, sanctions)
+    SELECT company_id, sum(partners), sum(sanctions) FROM (
+        SELECT company_id, count(*) AS partners, 0 AS sanctions
+        FROM ownerships GROUP BY company_id
+        UNION ALL
+        SELECT company_id, 0, count(*) FROM sanctions GROUP BY company_id
+    ) counts
+    GROUP BY company_id;
+    INSERT INTO stat_counters (name, key, shard, value)
+    SELECT 'companies', '', 0, count(*) FROM companies
+    UNION ALL SELECT 'partners', '', 0, count(*) FROM partners
+    UNION ALL SELECT 'ownerships', '', 0, count(*) FROM ownerships
+    UNION ALL SELECT 'sanctions', '', 0, count(*) FROM sanctions
+    UNION ALL SELECT 'sanctioned_companies', '', 0, count(*)
+    FROM company_stats WHERE sanctions > 0
+    UNION ALL SELECT 'sanctions_by_organization', organization, 0, count(*)
+    FROM sanctions GROUP BY organization;
+END $$ LANGUAGE plpgsql;
+{triggers}
+SELECT rebuild_stat_counters() WHERE NOT EXISTS (SELECT 1 FROM stat_counters);
+"""
+
+
+# created after the tables the triggers count the rows of
+for _table in (StatCounter.__table__, Company.__table__, Partner.__table__,
+               ownerships, Sanction.__table__):
+    CompanyStats.__table__.add_is_dependent_on(_table)
+db.event.listen(CompanyStats.__table__, 'after_create', db.DDL(
+    counters_ddl()).execute_if(dialect='postgresql'))
+
+
+class BeneficialOwner(db.Model):
+    """Share of a company ultimately held by a partner, through any chain
+    of holding companies. Written by the ``compute_beneficial_owners``
+    job, see ``src.ubo``."""
+    __tablename__ = "beneficial_owners"
+
+    company_id = db.Column(db.Integer,
+                           db.ForeignKey('companies.id', ondelete='CASCADE'),
+                           primary_key=True)
+    partner_id = db.Column(db.Integer,
+                           db.ForeignKey('partners.id', ondelete='CASCADE'),
+                           primary_key=True)
+    # percentages: effective share, and the share held directly if any
+    share = db.Column(db.Float, nullable=False)
+    direct_share = db.Column(db.Float)
+    computed_at = db.Column(db.DateTime, nullable=False)
+
+    partner = db.relationship('Partner', lazy='joined')
+
+    def format(self):
+        return {
+            'partner': self.partner.format(companies_info=False),
+            'share': self.share,
+            'direct_share': self.direct_share
+        }
+
+
+class PartnerMerge(db.Model):
+    """Duplicate of a partner, merged into the canonical partner it is
+    the same person or company as. Written by the ``resolve_partners`` job,
+    see ``src.resolution``."""
+    __tablename__ = "partner_merges"
+    __table_args__ = (
+        db.Index('ix_partner_merges_canonical_id', 'canonical_id'),
+    )
+
+    partner_id = db.Column(db.Integer,
+                           db.ForeignKey('partners.id', ondelete='CASCADE'),
+                           primary_key=True)
+    canonical_id = db.Column(db.Integer,
+                             db.ForeignKey('partners.id', ondelete='CASCADE'),
+                             nullable=False)
+    # similarity of the normalized names, 1 for branches of a company
+    score = db.Column(db.Float, nullable=False)
+    resolved_at = db.Column(db.DateTime, nullable=False)
+
+
+class CompanyGroup(db.Model):
+    """Economic group of a company: the connected component of the
+    ownership graph it belongs to. Kept by ``src.groups``."""
+    __tablename__ = "company_groups"
+    # members of a group in a single index range scan
+    __table_args__ = (
+        db.Index('ix_company_groups_group_id_company_id',
+                 'group_id', 'company_id'),
+    )
+
+    company_id = db.Column(db.Integer,
+                           db.ForeignKey('companies.id', ondelete='CASCADE'),
+                           primary_key=True)
+    # id of one of the companies of the group
+    group_id = db.Column(db.Integer, nullable=False)
+
+
+class PartnerGroup(db.Model):
+    """Economic group of a partner owning a company or being one."""
+    __tablename__ = "partner_groups"
+    __table_args__ = (
+        db.Index('ix_partner_groups_group_id_partner_id',
+                 'group_id', 'partner_id'),
+    )
+
+    partner_id = db.Column(db.Integer,
+                           db.ForeignKey('partners.id', ondelete='CASCADE'),
+                           primary_key=True)
+    group_id = db.Column(db.Integer, nullable=False)
+
+
+class Job(DBModelInterface):
+    __tablename__ = "jobs"
+    # workers look for the oldest queued job
+    __table_args__ = (
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String, nullable=False, default=QUEUED)
+    # units of work done, out of total when the job knows it
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.JSON)
+    error = db.Column(db.String)
+    worker = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # renewed by the worker while the job runs; a stale one means the worker
+    # died without recording the outcome of the job
+    heartbeat_at = db.Column(db.DateTime)
+
+    @classmethod
+    def enqueue(cls, kind, params=None, unique=False):
+        """Queue a job, or return the one already queued when ``unique``."""
+        if unique:
+            job = cls.query \
+                .filter(cls.kind == kind, cls.status == cls.QUEUED) \
+                .first()
+            if job:
+                return job
+
+        job = cls(kind=kind, params=params or {})
+        job.insert()
+
+        return job
+
+    @classmethod
+    def claim(cls, worker, stale_after=None):
+        """Mark the oldest queued job as running and return it.
+
+        ``SKIP LOCKED`` makes concurrent workers pass over the row another
+        worker is claiming instead of waiting for it, so each job is handed
+        to a single worker.
+
+        Args:
+            worker (str): name of the claiming worker.
+            stale_after (float): seconds without a heartbeat after which a
+                running job is claimed again, its worker being gone. Running
+                jobs are never claimed when None.
+
+        Returns:
+            Job: the claimed job, or None when the queue is empty.
+        """
+        claimable = cls.status == cls.QUEUED
+        if stale_after is not None:
+            stale_before = datetime.utcnow() - timedelta(seconds=stale_after)
+            claimable = db.or_(claimable, db.and_(
+                cls.status == cls.RUNNING,
+                db.func.coalesce(cls.heartbeat_at, cls.started_at)
+                < stale_before))
+
+        job = db.session.execute(
+            db.select(cls)
+            .where(claimable)
+            .order_by(cls.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar_one_or_none()
+
+        if job:
+            job.status = cls.RUNNING
+            job.worker = worker
+            job.progress = 0
+            job.started_at = job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+
+        return job
+
+    @classmethod
+    def heartbeat(cls, ids):
+        """Record that the worker running the jobs ``ids`` is alive."""
+        db.session.execute(db.update(cls)
+                           .where(cls.id.in_(ids), cls.status == cls.RUNNING)
+                           .values(heartbeat_at=datetime.utcnow()))
+        db.session.commit()
+
+    def report(self, progress, total=None):
+        """Record the progress of the running job.
+
+        The update is committed on a connection of its own, so reporting
+        neither commits nor interrupts the work the job has in progress.
+        """
+        values = {'progress': progress}
+        if total is not None:
+            values['total'] = total
+
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Job)
+                               .where(Job.id == self.id)
+                               .values(**values))
+        for key, value in values.items():
+            set_committed_value(self, key, value)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at and self.started_at.isoformat(),
+            'finished_at': self.finished_at and self.finished_at.isoformat()
+        }
+
+
+class Watchlist(DBModelInterface):
+    """Fiscal numbers a client monitors to be told when they turn ineligible.
+
+    Notifications are pushed to ``webhook_url`` when it is set and are
+    always streamed by /watchlists/<id>/events.
+    """
+    __tablename__ = "watchlists"
+
+    id = db.Column(db.Integer, primary_key=True)
+    # subject (sub) of the token that created the watchlist
+    client = db.Column(db.String, nullable=False, index=True)
+    name = db.Column(db.String, nullable=False)
+    webhook_url = db.Column(db.String)
+    # key of the HMAC signature of the webhook requests
+    webhook_secret = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+    entries = db.relationship('WatchlistEntry', lazy=True,
+                              cascade='all, delete-orphan',
+                              passive_deletes=True,
+                              order_by='WatchlistEntry.fiscal_number')
+
+    @property
+    def fiscal_numbers(self):
+        return [entry.fiscal_number for entry in self.entries]
+
+    @fiscal_numbers.setter
+    def fiscal_numbers(self, fiscal_numbers):
+        self.entries = [WatchlistEntry(fiscal_number=fiscal_number)
+                        for fiscal_number in
+                        {parse_cnpj(value) for value in fiscal_numbers}]
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'fiscal_numbers': [format_cnpj(fiscal_number)
+                               for fiscal_number in self.fiscal_numbers],
+            'webhook_url': self.webhook_url,
+            'created_at': self.created_at.isoformat()
+        }
+
+
+class WatchlistEntry(db.Model):
+    __tablename__ = "watchlist_entries"
+    # reverse index: the watchlists monitoring a fiscal number
+    __table_args__ = (
+        db.Index('ix_watchlist_entries_fiscal_number', 'fiscal_number'),
+    )
+
+    watchlist_id = db.Column(db.Integer,
+                             db.ForeignKey('watchlists.id',
+                                           ondelete='CASCADE'),
+                             primary_key=True)
+    # CNPJ stored as an integer, as in companies
+    fiscal_number = db.Column(db.BigInteger, primary_key=True)
+
+
+class Notification(DBModelInterface):
+    """A monitored company found ineligible after a write.
+
+    ``delivered_at`` and ``attempts`` track the webhook delivery; streams
+    resume from the id of the last notification they sent.
+    """
+    __tablename__ = "notifications"
+    __table_args__ = (
+        db.Index('ix_notifications_watchlist_id_id', 'watchlist_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    watchlist_id = db.Column(db.Integer,
+                             db.ForeignKey('watchlists.id',
+                                           ondelete='CASCADE'),
+                             nullable=False)
+    # the write that made the company ineligible: 'sanction' or 'ownership'
+    event = db.Column(db.String, nullable=False)
+    company_id = db.Column(db.Integer, nullable=False)
+    fiscal_number = db.Column(db.BigInteger, nullable=False)
+    # eligibility of the company when the notification was created
+    eligibility = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String)
 
     def format(self):
         return {
             'id': self.id,
-            'organization': self.organization
+            'watchlist_id': self.watchlist_id,
+            'event': self.event,
+            'company_id': self.company_id,
+            'fiscal_number': format_cnpj(self.fiscal_number),
+            'eligibility': self.eligibility,
+            'created_at': self.created_at.isoformat()
         }
@@ -0,0 +1,252 @@
+"""Routing of the reads of GET requests to read replicas.
+
+``SQLALCHEMY_REPLICA_URIS`` lists the replicas, separated by commas. While
+it is unset, everything goes to ``SQLALCHEMY_DATABASE_URI``, the primary.
+
+During a GET or HEAD request, the session sends its queries to a replica
+chosen once per request, so every query of the request reads the same
+database. Flushes, INSERT/UPDATE/DELETE statements and ``SELECT ... FOR
+UPDATE`` always go to the primary, as does everything outside requests
+(the CLI, the worker) and every other method.
+
+Replicas are skipped when they lag behind the primary by more than
+``REPLICA_MAX_LAG`` seconds or cannot be reached; the lag is measured at
+most every ``REPLICA_LAG_CHECK_INTERVAL`` seconds. Without a healthy
+replica, reads go to the primary.
+
+A client that wrote (any successful request other than GET and HEAD) reads
+from the primary for ``REPLICA_PIN_SECONDS``, so it sees its own writes
+whatever the lag of the replicas.
+"""
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+READ_METHODS = ('GET', 'HEAD')
+
+ROUND_ROBIN = 'round_robin'
+LEAST_CONNECTIONS = 'least_connections'
+
+# 0 while the replica has replayed everything it received, otherwise the
+# age of the last replayed transaction. NULL on a server not in recovery.
+LAG_QUERY = sa.text("""
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+       END
+""")
+
+
+class Replica:
+    """Engine of a read replica, with the last lag measured on it."""
+
+    def __init__(self, url, engine_options, max_lag, check_interval):
+        self.engine = sa.create_engine(url, **engine_options)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = None
+        self._checked = float('-inf')
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.engine.url.render_as_string(hide_password=True)
+
+    def _measure_lag(self):
+        with self.engine.connect() as connection:
+            if connection.dialect.name != 'postgresql':
+                return 0.0
+            return float(connection.execute(LAG_QUERY).scalar() or 0)
+
+    def healthy(self):
+        """Whether the replica may serve reads, checking its lag when due.
+
+        A single thread checks at a time; the others use the last result.
+        """
+        if time.monotonic() - self._checked >= self.check_interval \
+                and self._lock.acquire(blocking=False):
+            try:
+                self.lag = self._measure_lag()
+            except sa.exc.SQLAlchemyError:
+                self.lag = None
+                current_app.logger.warning('replica unavailable',
+                                           extra={'replica': self.name})
+            finally:
+                self._checked = time.monotonic()
+                self._lock.release()
+
+        return self.lag is not None and self.lag <= self.max_lag
+
+    def connections(self):
+        checkedout = getattr(self.engine.pool, 'checkedout', None)
+        return checkedout() if checkedout else 0
+
+
+class MemoryPins:
+    """Clients reading from the primary, held by the worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = {}
+
+    def pin(self, client, until):
+        with self._lock:
+            self._until[client] = until
+
+    def pinned(self, client):
+        with self._lock:
+            until = self._until.get(client)
+            if until is not None and until <= time.time():
+                del self._until[client]
+                until = None
+
+        return until is not None
+
+
+class SharedPins:
+    """Clients reading from the primary, in a SQLite file shared by every
+    gunicorn worker, as the rate limiter buckets (see ``SharedBuckets``)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connect()
+        connection.execute('CREATE TABLE IF NOT EXISTS pins ('
+                           'client TEXT PRIMARY KEY, until REAL)')
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=1, isolation_level=None)
+
+    @property
+    def connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def pin(self, client, until):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO pins (client, until) VALUES (?, ?)',
+            (client, until))
+
+    def pinned(self, client):
+        row = self.connection.execute(
+            'SELECT until FROM pins WHERE client = ?', (client,)).fetchone()
+
+        return row is not None and row[0] > time.time()
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas, selection, pins, pin_seconds):
+        if selection not in (ROUND_ROBIN, LEAST_CONNECTIONS):
+            raise ValueError(f'unknown replica selection: {selection!r}')
+
+        self.replicas = replicas
+        self.selection = selection
+        self.pins = pins
+        self.pin_seconds = pin_seconds
+        self._turn = itertools.count()
+
+    def choose(self):
+        """The replica to read from, or None to read from the primary."""
+        healthy = [replica for replica in self.replicas if replica.healthy()]
+        if not healthy:
+            return None
+
+        if self.selection == LEAST_CONNECTIONS:
+            return min(healthy, key=Replica.connections)
+
+        return healthy[next(self._turn) % len(healthy)]
+
+    def pin(self, client):
+        try:
+            self.pins.pin(client, time.time() + self.pin_seconds)
+        except sqlite3.Error:
+            current_app.logger.exception('client not pinned to the primary')
+
+    def pinned(self, client):
+        try:
+            return self.pins.pinned(client)
+        except sqlite3.Error:
+            # reading from the primary is always right, only slower
+            return True
+
+
+def _read_engine():
+    """Engine of the replica serving the reads of the request, if any."""
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+
+    if 'read_engine' not in g:
+        router = current_app.extensions.get('replicas')
+        client = g.get('client')
+        replica = None
+        if router is not None and not (client and router.pinned(client)):
+            replica = router.choose()
+        g.read_engine = replica and replica.engine
+
+    return g.read_engine
+
+
+def _writes(clause):
+    return clause is not None and (
+        getattr(clause, 'is_dml', False)
+        or getattr(clause, '_for_update_arg', None) is not None)
+
+
+class RoutingSession(Session):
+    """Session sending the reads of GET requests to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not _writes(clause):
+            engine = _read_engine()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def _pin_writer(response):
+    client = g.get('client')
+    if client and request.method not in READ_METHODS \
+            and response.status_code < 400:
+        current_app.extensions['replicas'].pin(client)
+
+    return response
+
+
+def setup_replicas(app):
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if isinstance(uris, str):
+        uris = [uri.strip() for uri in uris.split(',') if uri.strip()]
+    if not uris:
+        return None
+
+    max_lag = float(app.config.get('REPLICA_MAX_LAG', 5))
+    check_interval = float(app.config.get('REPLICA_LAG_CHECK_INTERVAL', 5))
+    engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {},
+                          pool_pre_ping=True)
+
+    storage = app.config.get('REPLICA_PIN_STORAGE', 'memory')
+    pins = MemoryPins() if storage == 'memory' else SharedPins(storage)
+
+    router = ReplicaRouter(
+        [Replica(uri, engine_options, max_lag, check_interval)
+         for uri in uris],
+        app.config.get('REPLICA_SELECTION', ROUND_ROBIN),
+        pins,
+        float(app.config.get('REPLICA_PIN_SECONDS', 2 * max_lag)))
+    app.extensions['replicas'] = router
+    app.after_request(_pin_writer)
+
+    return router
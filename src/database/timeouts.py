@@ -0,0 +1,190 @@
+"""Pool settings, statement timeouts and request deadlines.
+
+Connection pools of the primary and of the replicas are sized by
+``DB_POOL_SIZE`` and ``DB_MAX_OVERFLOW``; a request waits at most
+``DB_POOL_TIMEOUT`` seconds for a connection and gets a 503 after that,
+rather than piling up behind a slow one. Connections are replaced after
+``DB_POOL_RECYCLE`` seconds and, with ``DB_POOL_PRE_PING``, tested when
+checked out, so a failover only costs a reconnection.
+
+Every statement of a request runs with a ``statement_timeout`` set by the
+budget of its route: point lookups get a tight one, lists and exports
+larger ones (see ``BUDGETS``). Each budget is overridden by the
+``<NAME>_STATEMENT_TIMEOUT`` setting, in seconds. Routes declare theirs with
+``requires_auth(..., budget=...)``; the others get ``LOOKUP_BUDGET`` for
+GET and HEAD and ``WRITE_BUDGET`` otherwise.
+
+A request also has ``REQUEST_DEADLINE`` seconds to respond. The timeout of
+a statement is cut to what is left of the deadline, so the database cancels
+it when the deadline passes, and no statement starts afterwards. Either
+way the request fails with a 504. The deadline ends with the response: a
+streamed body, such as the events of a watchlist, is bounded by the
+statement timeouts only.
+
+Timeouts are PostgreSQL's; on other databases only the deadline is checked
+between statements. The budget, the timeout of the last statement, what
+timed out and the connections in use are reported on the ``request`` log
+line (see ``src.log``).
+"""
+import time
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request
+
+from .routing import READ_METHODS
+
+LOOKUP_BUDGET = 'lookup'
+WRITE_BUDGET = 'write'
+LIST_BUDGET = 'list'
+EXPORT_BUDGET = 'export'
+
+# statement_timeout of each budget, in seconds
+BUDGETS = {
+    LOOKUP_BUDGET: 2,
+    WRITE_BUDGET: 5,
+    LIST_BUDGET: 10,
+    EXPORT_BUDGET: 60,
+}
+
+# SQLSTATE of a statement canceled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class RequestTimeout(Exception):
+    def __init__(self, cause):
+        self.cause = cause
+        self.description = 'request deadline exceeded' \
+            if cause == 'deadline' else 'statement timeout'
+
+
+# errors answered with a 503 or a 504 (see src/__init__.py): routes let them
+# through rather than answer with a 422
+TIMEOUTS = (RequestTimeout, sa.exc.TimeoutError)
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS with the pool settings filled in.
+
+    Options set explicitly in SQLALCHEMY_ENGINE_OPTIONS are kept.
+    """
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    pre_ping = str(config.get('DB_POOL_PRE_PING', True)).lower()
+    options.setdefault('pool_pre_ping',
+                       pre_ping not in ('0', 'false', 'no'))
+    options.setdefault('pool_recycle',
+                       int(config.get('DB_POOL_RECYCLE', 1800)))
+
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    # SQLite pools hold a connection per thread and take no size
+    if uri and sa.engine.make_url(uri).get_backend_name() != 'sqlite':
+        options.setdefault('pool_size', int(config.get('DB_POOL_SIZE', 5)))
+        options.setdefault('max_overflow',
+                           int(config.get('DB_MAX_OVERFLOW', 10)))
+        options.setdefault('pool_timeout',
+                           float(config.get('DB_POOL_TIMEOUT', 10)))
+
+    return options
+
+
+def _budget():
+    budget = g.get('budget')
+    if budget is None:
+        budget = LOOKUP_BUDGET if request.method in READ_METHODS \
+            else WRITE_BUDGET
+
+    return budget
+
+
+def _end_deadline(response):
+    g.deadline = None
+
+    return response
+
+
+def _set_timeout(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or 'deadline' not in g:
+        return
+
+    timeout = current_app.extensions['statement_timeouts'][_budget()]
+    g.timeout_cause = 'statement'
+
+    deadline = g.get('deadline')
+    if deadline is not None:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            g.timed_out = 'deadline'
+            raise RequestTimeout('deadline')
+        if left < timeout:
+            timeout = left
+            g.timeout_cause = 'deadline'
+
+    g.statement_timeout_ms = milliseconds = max(int(timeout * 1000), 1)
+
+    # SET LOCAL lasts until the end of the transaction, when it is dropped
+    # from conn.info (see _reset_timeout)
+    if conn.dialect.name == 'postgresql' \
+            and conn.info.get('statement_timeout') != milliseconds:
+        cursor.execute(f'SET LOCAL statement_timeout = {milliseconds}')
+        conn.info['statement_timeout'] = milliseconds
+
+
+def _reset_timeout(conn):
+    conn.info.pop('statement_timeout', None)
+
+
+def _reset_record(dbapi_connection, connection_record):
+    connection_record.info.pop('statement_timeout', None)
+
+
+def _translate_cancel(context):
+    code = getattr(context.original_exception, 'pgcode', None)
+    if code == QUERY_CANCELED and has_request_context() \
+            and 'timeout_cause' in g:
+        g.timed_out = g.timeout_cause
+        raise RequestTimeout(g.timeout_cause) \
+            from context.original_exception
+
+
+def watch_engine(engine):
+    """Apply the timeouts of requests to the statements of ``engine``."""
+    sa.event.listen(engine, 'before_cursor_execute', _set_timeout)
+    sa.event.listen(engine, 'commit', _reset_timeout)
+    sa.event.listen(engine, 'rollback', _reset_timeout)
+    sa.event.listen(engine, 'handle_error', _translate_cancel)
+    sa.event.listen(engine.pool, 'checkin', _reset_record)
+
+
+def request_metrics(engine):
+    """Budget, timeouts and pool usage of the request being handled."""
+    pool = engine.pool
+    metrics = {
+        'budget': _budget(),
+        'pool_checked_out': pool.checkedout()
+        if hasattr(pool, 'checkedout') else None,
+        'pool_overflow': max(pool.overflow(), 0)
+        if hasattr(pool, 'overflow') else None
+    }
+    if 'statement_timeout_ms' in g:
+        metrics['statement_timeout_ms'] = g.statement_timeout_ms
+    if 'timed_out' in g:
+        metrics['timed_out'] = g.timed_out
+
+    return metrics
+
+
+def setup_timeouts(app, engines):
+    config = app.config
+    app.extensions['statement_timeouts'] = {
+        budget: float(config.get(f'{budget.upper()}_STATEMENT_TIMEOUT',
+                                 seconds))
+        for budget, seconds in BUDGETS.items()}
+    deadline = float(config.get('REQUEST_DEADLINE', 30))
+
+    @app.before_request
+    def start_deadline():
+        g.deadline = time.monotonic() + deadline
+
+    app.after_request(_end_deadline)
+
+    for engine in engines:
+        watch_engine(engine)
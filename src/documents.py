@@ -0,0 +1,125 @@
+"""Normalization and validation of Brazilian CNPJ and CPF documents.
+
+Documents are stored as integers; these helpers turn the strings received
+by the API (with or without punctuation) into those integers, rejecting
+numbers whose check digits do not match, and format them back as the
+zero padded strings returned by the API.
+"""
+import re
+
+CNPJ_LENGTH = 14
+CPF_LENGTH = 11
+
+# person_type of a partner: natural person (CPF) or legal entity (CNPJ)
+NATURAL_PERSON = 'F'
+LEGAL_ENTITY = 'J'
+
+_CNPJ_WEIGHTS = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_PUNCTUATION = re.compile(r'[\s./-]')
+# public QSA files hide the first three and last two digits of a CPF
+_MASKED_CPF = re.compile(r'\*{3}(\d{6})\*{2}')
+
+
+def _check_digit(digits, weights):
+    remainder = sum(int(d) * w for d, w in zip(digits, weights)) % 11
+    return '0' if remainder < 2 else str(11 - remainder)
+
+
+def cnpj_check_digits(base):
+    """Return the two check digits of the first 12 digits of a CNPJ."""
+    first = _check_digit(base, _CNPJ_WEIGHTS[1:])
+    return first + _check_digit(base + first, _CNPJ_WEIGHTS)
+
+
+def cpf_check_digits(base):
+    """Return the two check digits of the first 9 digits of a CPF."""
+    first = _check_digit(base, range(10, 1, -1))
+    return first + _check_digit(base + first, range(11, 1, -1))
+
+
+def _digits(value):
+    if not isinstance(value, str):
+        raise ValueError('documents must be sent as strings')
+
+    digits = _PUNCTUATION.sub('', value)
+    if not digits.isdigit():
+        raise ValueError(f'invalid document: {value!r}')
+
+    return digits
+
+
+def _valid(digits, length, check_digits):
+    return len(digits) == length \
+        and len(set(digits)) > 1 \
+        and check_digits(digits[:-2]) == digits[-2:]
+
+
+def parse_cnpj(value):
+    """Normalize a CNPJ to an integer.
+
+    Raises:
+        ValueError: when the value is not a CNPJ with valid check digits.
+    """
+    digits = _digits(value)
+    if not _valid(digits, CNPJ_LENGTH, cnpj_check_digits):
+        raise ValueError(f'invalid CNPJ: {value!r}')
+
+    return int(digits)
+
+
+def parse_document(value):
+    """Normalize the CPF or CNPJ of a partner to an integer.
+
+    Returns:
+        tuple: the document as an integer and the person type, either
+        NATURAL_PERSON (CPF) or LEGAL_ENTITY (CNPJ).
+
+    Raises:
+        ValueError: when the value is neither a CPF nor a CNPJ with valid
+        check digits.
+    """
+    digits = _digits(value)
+    if _valid(digits, CPF_LENGTH, cpf_check_digits):
+        return int(digits), NATURAL_PERSON
+    if _valid(digits, CNPJ_LENGTH, cnpj_check_digits):
+        return int(digits), LEGAL_ENTITY
+
+    raise ValueError(f'invalid CPF or CNPJ: {value!r}')
+
+
+def parse_masked_cpf(value):
+    """Read the six middle digits of a CPF masked as ``***.456.789-**``.
+
+    Raises:
+        ValueError: when the value is not a masked CPF.
+    """
+    if not isinstance(value, str):
+        raise ValueError('documents must be sent as strings')
+
+    match = _MASKED_CPF.fullmatch(_PUNCTUATION.sub('', value))
+    if not match:
+        raise ValueError(f'invalid masked CPF: {value!r}')
+
+    return int(match.group(1))
+
+
+def cpf_middle(number):
+    """The six middle digits of a CPF, those its masked form shows."""
+    return number // 100 % 1_000_000
+
+
+def cnpj_root(number):
+    """The first eight digits of a CNPJ, shared by the branches of a
+    company."""
+    return number // 1_000_000
+
+
+def format_cnpj(number):
+    return str(number).zfill(CNPJ_LENGTH)
+
+
+def format_document(number, person_type):
+    if person_type == LEGAL_ENTITY:
+        return format_cnpj(number)
+
+    return str(number).zfill(CPF_LENGTH)
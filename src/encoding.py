@@ -0,0 +1,194 @@
+"""Response encodings negotiated through the ``Accept`` header.
+
+JSON stays the default. Clients may ask instead for:
+
+* MessagePack (``application/msgpack``) or CBOR (``application/cbor``):
+  the same payload in a binary encoding;
+* columnar JSON (``application/vnd.capstone.columnar+json``), on list
+  endpoints: the list is sent as ``columns`` and ``rows``, so key names are
+  sent once instead of once per row. Nested lists of objects are encoded the
+  same way inside each row, their columns declared once in the parent's
+  column list, and nested objects as arrays of their ``fields``. String
+  columns with repeated values (e.g. the organization of sanctions) are
+  dictionary encoded: their cells hold the index of the value in
+  ``dictionaries[path]``, ``path`` being the dotted column names.
+
+Documents stored as JSON text, such as those of the read model, are sent
+as they are to JSON clients and only parsed for the other encodings.
+"""
+import json
+from collections import Counter, defaultdict
+
+import cbor2
+import msgpack
+from flask import current_app, jsonify, request
+
+JSON = 'application/json'
+COLUMNAR = 'application/vnd.capstone.columnar+json'
+MSGPACK = 'application/msgpack'
+CBOR = 'application/cbor'
+
+
+def _schema(records):
+    keys = {}
+    for record in records:
+        keys.update(dict.fromkeys(record))
+
+    columns = []
+    for key in keys:
+        values = [record[key] for record in records
+                  if record.get(key) is not None]
+        if values and all(isinstance(value, dict) for value in values):
+            columns.append({'name': key, 'fields': _schema(values)})
+        elif values and all(isinstance(value, list) for value in values) \
+                and any(isinstance(item, dict)
+                        for value in values for item in value):
+            columns.append({'name': key,
+                            'columns': _schema([item for value in values
+                                                for item in value])})
+        else:
+            columns.append(key)
+
+    return columns
+
+
+def _nested(records, column):
+    values = [record[column['name']] for record in records
+              if record.get(column['name'])]
+    if 'columns' in column:
+        return [item for value in values for item in value], \
+            column['columns']
+
+    return values, column['fields']
+
+
+class _Columnar:
+
+    def __init__(self, records):
+        self.columns = _schema(records)
+
+        counts = defaultdict(Counter)
+        mixed = set()
+        self._count(records, self.columns, '', counts, mixed)
+        # only columns holding nothing but strings, some of them repeated
+        self.dictionaries = {
+            path: {value: index for index, value in enumerate(values)}
+            for path, values in counts.items()
+            if path not in mixed and len(values) < sum(values.values())
+        }
+
+    def _count(self, records, columns, prefix, counts, mixed):
+        for column in columns:
+            if isinstance(column, str):
+                path = prefix + column
+                for record in records:
+                    value = record.get(column)
+                    if isinstance(value, str):
+                        counts[path][value] += 1
+                    elif value is not None:
+                        mixed.add(path)
+            else:
+                nested, nested_columns = _nested(records, column)
+                self._count(nested, nested_columns,
+                            prefix + column['name'] + '.', counts, mixed)
+
+    def row(self, record, columns, prefix=''):
+        row = []
+        for column in columns:
+            if isinstance(column, str):
+                value = record.get(column)
+                dictionary = self.dictionaries.get(prefix + column)
+                if dictionary is not None and value is not None:
+                    value = dictionary[value]
+                row.append(value)
+                continue
+
+            value = record.get(column['name'])
+            path = prefix + column['name'] + '.'
+            if value is None:
+                row.append(None)
+            elif 'columns' in column:
+                row.append([self.row(item, column['columns'], path)
+                            for item in value])
+            else:
+                row.append(self.row(value, column['fields'], path))
+
+        return row
+
+
+def columnar(records):
+    """Encode a list of dicts in the columnar shape."""
+    encoder = _Columnar(records)
+
+    return {
+        'columns': encoder.columns,
+        'dictionaries': {path: list(dictionary)
+                         for path, dictionary in encoder.dictionaries.items()},
+        'rows': [encoder.row(record, encoder.columns) for record in records]
+    }
+
+
+def _negotiate(table):
+    offered = [JSON, MSGPACK, 'application/x-msgpack', CBOR]
+    if table:
+        offered.append(COLUMNAR)
+
+    return request.accept_mimetypes.best_match(offered, default=JSON)
+
+
+def respond(payload, table=None, status=200):
+    """Encode ``payload`` in the media type the client prefers.
+
+    Args:
+        payload (dict): the response, as it would be passed to jsonify.
+        table (str): key of the list of records of ``payload``. The
+            columnar shape is only offered when it is given.
+        status (int): status code of the response.
+    """
+    mimetype = _negotiate(table)
+
+    if mimetype == COLUMNAR:
+        response = current_app.response_class(
+            current_app.json.dumps(dict(payload,
+                                        **{table: columnar(payload[table])})),
+            mimetype=COLUMNAR)
+    elif mimetype in (MSGPACK, 'application/x-msgpack'):
+        response = current_app.response_class(msgpack.packb(payload),
+                                              mimetype=MSGPACK)
+    elif mimetype == CBOR:
+        response = current_app.response_class(cbor2.dumps(payload),
+                                              mimetype=CBOR)
+    else:
+        response = jsonify(payload)
+
+    response.vary.add('Accept')
+
+    return response, status
+
+
+def _respond_text(key, text, table, status):
+    if _negotiate(table) != JSON:
+        return respond({'success': True, key: json.loads(text)},
+                       table=key if table else None, status=status)
+
+    response = current_app.response_class(
+        f'{{"{key}":{text},"success":true}}\n', mimetype=JSON)
+    response.vary.add('Accept')
+
+    return response, status
+
+
+def respond_documents(key, documents, status=200):
+    """Respond with ``{'success': True, key: [...]}`` from JSON texts.
+
+    Args:
+        key (str): key of the list in the response.
+        documents (list): the records, each one already encoded as JSON.
+        status (int): status code of the response.
+    """
+    return _respond_text(key, '[' + ','.join(documents) + ']', True, status)
+
+
+def respond_document(key, document, status=200):
+    """Respond with ``{'success': True, key: ...}`` from a JSON text."""
+    return _respond_text(key, document, False, status)
@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from .database.models import db, Company, Partner, Sanction, ownerships
+from .documents import LEGAL_ENTITY, format_cnpj
+from . import signals
+
+
+def partner_exposure(partner_id, depth, active_at=None):
+    """List the sanctioned companies reachable from a partner.
+
+    The ownership graph is walked breadth first. Each hop goes from the
+    partners of a level to the companies they own; a company that is itself
+    a partner (its fiscal number is a partner document) continues the walk
+    on the next level. Every level costs three queries, whatever the number
+    of edges.
+
+    Args:
+        partner_id (int): Id of the partner the walk starts from.
+        depth (int): maximum number of ownership hops.
+        active_at (date): when given, only sanctions in force on that date
+            are considered.
+
+    Returns:
+        tuple: the exposure as a dict, plus the sets of company ids and
+        partner ids visited by the walk.
+    """
+    partner_paths = {partner_id: []}
+    company_paths = {}
+    companies = {}
+    frontier = {partner_id}
+
+    for level in range(depth):
+        rows = db.session.query(ownerships.c.partner_id, Company.id,
+                                Company.fiscal_number, Company.name) \
+            .join(Company, Company.id == ownerships.c.company_id) \
+            .filter(ownerships.c.partner_id.in_(frontier)) \
+            .order_by(ownerships.c.partner_id, Company.id) \
+            .all()
+
+        reached = {}
+        for owner_id, company_id, fiscal_number, name in rows:
+            if company_id in company_paths:
+                continue
+            company_paths[company_id] = partner_paths[owner_id] + [company_id]
+            companies[company_id] = {
+                'id': company_id,
+                'fiscal_number': format_cnpj(fiscal_number),
+                'name': name
+            }
+            reached[fiscal_number] = company_id
+
+        if not reached or level == depth - 1:
+            break
+
+        # companies that are partners of other companies open the next level
+        frontier = set()
+        bridges = Partner.query \
+            .with_entities(Partner.id, Partner.document) \
+            .filter(Partner.person_type == LEGAL_ENTITY,
+                    Partner.document.in_(reached)) \
+            .all()
+        for bridge_id, document in bridges:
+            if bridge_id in partner_paths:
+                continue
+            partner_paths[bridge_id] = company_paths[reached[document]]
+            frontier.add(bridge_id)
+
+        if not frontier:
+            break
+
+    sanctions = defaultdict(list)
+    if companies:
+        query = Sanction.query.filter(Sanction.company_id.in_(companies))
+        if active_at:
+            query = query.filter(Sanction.active_at(active_at))
+        for sanction in query.order_by(Sanction.id):
+            sanctions[sanction.company_id].append(sanction.format())
+
+    exposure = {
+        'id': partner_id,
+        'depth': depth,
+        'active_at': active_at and active_at.isoformat(),
+        'companies': [
+            dict(companies[company_id],
+                 sanctions=sanctions[company_id],
+                 path=company_paths[company_id])
+            for company_id in sorted(sanctions,
+                                     key=lambda id: (len(company_paths[id]),
+                                                     id))
+        ]
+    }
+
+    return exposure, set(company_paths), set(partner_paths)
+
+
+class ExposureCache:
+    """Memoized partner exposures, invalidated by the writes on their path.
+
+    Each entry remembers the companies and partners its walk visited, so a
+    change to an ownership of a visited partner, or to a sanction, fiscal
+    number or existence of a visited company, drops only the entries that
+    may have changed. The cache lives in the worker process; ``ttl`` bounds
+    how long a change made through another worker may go unnoticed.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_company = defaultdict(set)
+        self._by_partner = defaultdict(set)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires, _, _ = entry
+            if expires < time.monotonic():
+                self._discard(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, company_ids, partner_ids):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl,
+                                  company_ids, partner_ids)
+            for company_id in company_ids:
+                self._by_company[company_id].add(key)
+            for partner_id in partner_ids:
+                self._by_partner[partner_id].add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, company_ids=(), partner_ids=()):
+        with self._lock:
+            keys = set()
+            for company_id in company_ids:
+                keys.update(self._by_company.get(company_id, ()))
+            for partner_id in partner_ids:
+                keys.update(self._by_partner.get(partner_id, ()))
+
+            for key in keys:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_company.clear()
+            self._by_partner.clear()
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        _, _, company_ids, partner_ids = entry
+        for company_id in company_ids:
+            self._by_company[company_id].discard(key)
+            if not self._by_company[company_id]:
+                del self._by_company[company_id]
+        for partner_id in partner_ids:
+            self._by_partner[partner_id].discard(key)
+            if not self._by_partner[partner_id]:
+                del self._by_partner[partner_id]
+
+    # signal receivers
+
+    def on_companies_changed(self, sender, company_ids, **kwargs):
+        self.invalidate(company_ids=company_ids)
+
+    def on_partners_changed(self, sender, partner_ids, **kwargs):
+        # a new document may turn the partner into the bridge of a company
+        # that walks already went through
+        bridged = Company.query \
+            .with_entities(Company.id) \
+            .join(Partner, Partner.is_company(Company)) \
+            .filter(Partner.id.in_(partner_ids)) \
+            .all()
+        self.invalidate(company_ids=[company_id for company_id, in bridged],
+                        partner_ids=partner_ids)
+
+    def on_ownerships_changed(self, sender, edges, **kwargs):
+        self.invalidate(partner_ids={partner_id for _, partner_id in edges})
+
+    def on_sanctions_changed(self, sender, company_ids, **kwargs):
+        self.invalidate(company_ids=company_ids)
+
+
+def setup_exposure_cache(app):
+    cache = ExposureCache(
+        maxsize=int(app.config.get('EXPOSURE_CACHE_SIZE', 1024)),
+        ttl=float(app.config.get('EXPOSURE_CACHE_TTL', 60))
+    )
+    app.extensions['exposure_cache'] = cache
+
+    signals.companies_changed.connect(cache.on_companies_changed, app)
+    signals.partners_changed.connect(cache.on_partners_changed, app)
+    signals.ownerships_changed.connect(cache.on_ownerships_changed, app)
+    signals.sanctions_changed.connect(cache.on_sanctions_changed, app)
+
+    return cache
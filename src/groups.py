@@ -0,0 +1,386 @@
+"""Economic groups: the connected components of the ownership graph.
+
+Companies and partners are the nodes of the graph, ownerships its edges,
+and a partner that is a company (a legal entity whose document is the
+fiscal number of a company) is the same node as that company, as is a
+duplicate with its canonical partner (see ``src.resolution``). Every company
+belongs to a group and so does every partner owning a company or being one;
+``company_groups`` and ``partner_groups`` store the id of the group, which
+is the id of one of its companies. Members of a group, or whether one of
+them is sanctioned, are then read with a range scan of the group_id
+indexes instead of walking the relationships.
+
+``rebuild_groups`` computes every group with a union-find over a streamed
+scan of companies, ownerships and partners that are companies. New
+companies and new ownerships only ever join groups, so they are applied
+incrementally: the nodes are added and their groups merged, relabelling
+the smaller groups. Anything that may split a group (deletes, changes of
+documents or fiscal numbers) and writes of more than GROUPS_MERGE_LIMIT
+nodes at once, as those of the imports, queue a rebuild instead. Renames
+leave the graph as it is.
+
+Writes to the group tables are serialized by an advisory lock. A rebuild
+waits for it; an incremental update, run by the request that made the
+write, does not: when the lock is held, e.g. by a running rebuild, it
+queues a rebuild instead.
+"""
+from datetime import date
+
+from flask import current_app
+
+from .database.models import (
+    db,
+    unit_of_work,
+    Company,
+    CompanyGroup,
+    Job,
+    Partner,
+    PartnerGroup,
+    PartnerMerge,
+    Sanction,
+    ownerships
+)
+from . import signals
+
+BATCH_SIZE = 10000
+
+# key of the advisory lock serializing the writes to the group tables
+LOCK_KEY = 4_204_242
+
+
+class GroupsLocked(Exception):
+    """The group tables are being written by another transaction."""
+
+
+def _lock(wait=True):
+    """Lock the group tables until the end of the transaction.
+
+    Raises:
+        GroupsLocked: when ``wait`` is False and the lock is held.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+
+    if wait:
+        db.session.execute(db.select(db.func.pg_advisory_xact_lock(LOCK_KEY)))
+    elif not db.session.scalar(
+            db.select(db.func.pg_try_advisory_xact_lock(LOCK_KEY))):
+        raise GroupsLocked()
+
+
+def _stream(statement):
+    return db.session.execute(statement.execution_options(
+        yield_per=BATCH_SIZE))
+
+
+class _UnionFind:
+    """Disjoint sets of nodes: company ids, and partner ids negated."""
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def add(self, node):
+        if node not in self.parent:
+            self.parent[node] = node
+            self.size[node] = 1
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            # path halving keeps the trees flat without recursion
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+
+        return node
+
+    def union(self, a, b):
+        self.add(a)
+        self.add(b)
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+
+
+def _bridges():
+    """Select (partner_id, company_id) of the partners that are companies."""
+    return db.select(Partner.id, Company.id).join(Company,
+                                                  Partner.is_company(Company))
+
+
+def rebuild_groups(report=None):
+    """Compute every group from scratch and replace the stored ones.
+
+    Args:
+        report (callable): receives the progress and total of the write.
+
+    Returns:
+        dict: the number of groups, companies and partners stored.
+    """
+    with unit_of_work():
+        _lock()
+
+        groups = _UnionFind()
+        for company_id, in _stream(db.select(Company.id)):
+            groups.add(company_id)
+        for company_id, partner_id in _stream(
+                db.select(ownerships.c.company_id, ownerships.c.partner_id)):
+            groups.union(company_id, -partner_id)
+        for partner_id, company_id in _stream(_bridges()):
+            groups.union(company_id, -partner_id)
+        for partner_id, canonical_id in _stream(
+                db.select(PartnerMerge.partner_id, PartnerMerge.canonical_id)):
+            groups.union(-canonical_id, -partner_id)
+
+        # each group is named after its first company
+        names = {}
+        for node in groups.parent:
+            if node > 0:
+                root = groups.find(node)
+                names[root] = min(names.get(root, node), node)
+
+        companies = []
+        partners = []
+        for node in groups.parent:
+            group_id = names.get(groups.find(node))
+            if group_id is None:
+                # duplicated partners owning no company
+                continue
+            if node > 0:
+                companies.append({'company_id': node, 'group_id': group_id})
+            else:
+                partners.append({'partner_id': -node, 'group_id': group_id})
+
+        db.session.execute(db.delete(CompanyGroup))
+        db.session.execute(db.delete(PartnerGroup))
+        total = len(companies) + len(partners)
+        done = 0
+        for model, rows in ((CompanyGroup, companies),
+                            (PartnerGroup, partners)):
+            for start in range(0, len(rows), BATCH_SIZE):
+                batch = rows[start:start + BATCH_SIZE]
+                db.session.execute(db.insert(model), batch)
+                done += len(batch)
+                if report:
+                    report(done, total)
+
+    return {'groups': len(names), 'companies': len(companies),
+            'partners': len(partners)}
+
+
+def _merge(company_ids, partner_ids):
+    """Put ``company_ids`` and ``partner_ids`` in a single group."""
+    groups = set(db.session.scalars(
+        db.select(CompanyGroup.group_id)
+        .where(CompanyGroup.company_id.in_(company_ids))))
+    groups.update(db.session.scalars(
+        db.select(PartnerGroup.group_id)
+        .where(PartnerGroup.partner_id.in_(partner_ids))))
+
+    # companies missing from their table are groups of their own
+    grouped = set(db.session.scalars(
+        db.select(CompanyGroup.company_id)
+        .where(CompanyGroup.company_id.in_(company_ids))))
+    missing = set(company_ids) - grouped
+    if missing:
+        db.session.execute(db.insert(CompanyGroup), [
+            {'company_id': company_id, 'group_id': company_id}
+            for company_id in missing])
+        groups |= missing
+
+    sizes = dict(db.session.execute(
+        db.select(CompanyGroup.group_id, db.func.count())
+        .where(CompanyGroup.group_id.in_(groups))
+        .group_by(CompanyGroup.group_id)).all())
+    target = max(groups, key=lambda group_id: (sizes.get(group_id, 0),
+                                               -group_id))
+
+    merged = groups - {target}
+    if merged:
+        for model in (CompanyGroup, PartnerGroup):
+            db.session.execute(db.update(model)
+                               .where(model.group_id.in_(merged))
+                               .values(group_id=target))
+
+    grouped = set(db.session.scalars(
+        db.select(PartnerGroup.partner_id)
+        .where(PartnerGroup.partner_id.in_(partner_ids))))
+    missing = set(partner_ids) - grouped
+    if missing:
+        db.session.execute(db.insert(PartnerGroup), [
+            {'partner_id': partner_id, 'group_id': target}
+            for partner_id in missing])
+
+
+def _duplicates(partner_ids):
+    """Map each partner to the set of partners it is the same as."""
+    canonical = dict(db.session.execute(
+        db.select(PartnerMerge.partner_id, PartnerMerge.canonical_id)
+        .where(PartnerMerge.partner_id.in_(partner_ids))).all())
+    for partner_id in partner_ids:
+        canonical.setdefault(partner_id, partner_id)
+
+    same = {}
+    for partner_id, canonical_id in db.session.execute(
+            db.select(PartnerMerge.partner_id, PartnerMerge.canonical_id)
+            .where(PartnerMerge.canonical_id.in_(set(canonical.values())))):
+        same.setdefault(canonical_id, {canonical_id}).add(partner_id)
+
+    return {partner_id: same.get(canonical[partner_id], {partner_id})
+            for partner_id in partner_ids}
+
+
+def _companies_of(partner_ids):
+    """Map the partners that are companies to the ids of those."""
+    bridges = {}
+    for partner_id, company_id in db.session.execute(
+            _bridges().where(Partner.id.in_(partner_ids))):
+        bridges.setdefault(partner_id, set()).add(company_id)
+
+    return bridges
+
+
+def merge_ownerships(edges):
+    """Join the groups of the companies and partners of new ``edges``.
+
+    Raises:
+        GroupsLocked: when the group tables are locked.
+    """
+    with unit_of_work():
+        _lock(wait=False)
+        duplicates = _duplicates({partner_id for _, partner_id in edges})
+        bridges = _companies_of(set().union(*duplicates.values()))
+
+        for company_id, partner_id in edges:
+            partner_ids = duplicates[partner_id]
+            _merge({company_id}.union(*(bridges.get(id, set())
+                                        for id in partner_ids)),
+                   partner_ids)
+
+
+def add_companies(company_ids):
+    """Add new companies to the groups, joining the partners they are.
+
+    Raises:
+        GroupsLocked: when the group tables are locked.
+    """
+    with unit_of_work():
+        _lock(wait=False)
+        partners = {}
+        for partner_id, company_id in db.session.execute(
+                _bridges().where(Company.id.in_(company_ids))):
+            partners.setdefault(company_id, set()).add(partner_id)
+        duplicates = _duplicates(set().union(*partners.values()))
+
+        for company_id in company_ids:
+            _merge({company_id},
+                   set().union(*(duplicates[partner_id] for partner_id
+                                 in partners.get(company_id, set()))))
+
+
+def company_group(company_id, active_at=None):
+    """The group of a company, with its members.
+
+    Args:
+        company_id (int): Id of the company.
+        active_at (date): date the sanctions must be in force on to make
+            the group sanctioned. Defaults to today.
+
+    Returns:
+        dict: the group, or None when the company is not in any group yet.
+    """
+    group_id = db.session.scalar(
+        db.select(CompanyGroup.group_id)
+        .where(CompanyGroup.company_id == company_id))
+    if group_id is None:
+        return None
+    active_at = active_at or date.today()
+
+    companies = db.session.scalars(
+        db.select(Company)
+        .join(CompanyGroup, CompanyGroup.company_id == Company.id)
+        .where(CompanyGroup.group_id == group_id)
+        .order_by(Company.id)).all()
+    partners = db.session.scalars(
+        db.select(Partner)
+        .join(PartnerGroup, PartnerGroup.partner_id == Partner.id)
+        .where(PartnerGroup.group_id == group_id)
+        .order_by(Partner.id)).all()
+
+    return {
+        'id': group_id,
+        'active_at': active_at.isoformat(),
+        'sanctioned': group_sanctioned(group_id, active_at),
+        'companies': [company.format(partners_info=False,
+                                     sanctions_info=False)
+                      for company in companies],
+        'partners': [partner.format(companies_info=False)
+                     for partner in partners]
+    }
+
+
+def group_sanctioned(group_id, active_at):
+    """Whether a company of the group has a sanction in force on
+    ``active_at``, in a single query."""
+    return db.session.scalar(db.select(
+        db.select(Sanction.id)
+        .join(CompanyGroup, CompanyGroup.company_id == Sanction.company_id)
+        .where(CompanyGroup.group_id == group_id,
+               Sanction.active_at(active_at))
+        .exists()))
+
+
+def setup_groups(app):
+    signals.companies_changed.connect(_on_companies_changed, app)
+    signals.partners_changed.connect(_on_partners_changed, app)
+    signals.ownerships_changed.connect(_on_ownerships_changed, app)
+
+
+def _queue_rebuild():
+    Job.enqueue('rebuild_groups', unique=True)
+
+
+def _incremental(update, nodes):
+    if len(nodes) > int(current_app.config.get('GROUPS_MERGE_LIMIT', 100)):
+        _queue_rebuild()
+        return
+
+    # the write is committed already: a failure here must not fail it
+    try:
+        update(nodes)
+    except GroupsLocked:
+        # the rebuild queued sees the write, whoever holds the lock now
+        _queue_rebuild()
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception('groups not merged')
+        _queue_rebuild()
+
+
+def _on_companies_changed(sender, company_ids, action, columns=None):
+    if action == 'created':
+        _incremental(add_companies, company_ids)
+    elif action == 'deleted' or columns is None \
+            or 'fiscal_number' in columns:
+        # a new fiscal number may stop the company from being a partner;
+        # names are not part of the graph
+        _queue_rebuild()
+
+
+def _on_partners_changed(sender, partner_ids, action, columns=None):
+    # partners join groups through their ownerships; a new document or a
+    # removal may split the groups they were in
+    if action == 'deleted' or action == 'updated' and (
+            columns is None or 'document' in columns):
+        _queue_rebuild()
+
+
+def _on_ownerships_changed(sender, edges, action):
+    if action == 'created':
+        _incremental(merge_ownerships, edges)
+    elif action == 'deleted':
+        _queue_rebuild()
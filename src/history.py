@@ -0,0 +1,158 @@
+"""Reads of companies, partners and sanctions as they were in the past.
+
+Every write to companies, partners, ownerships and sanctions is recorded by
+triggers in their ``*_history`` tables (see ``versioning_ddl``), one row per
+version with the period it was valid. A read at a point in time selects the
+versions valid then, through the indexes on the keys and ``valid_from``,
+and formats them as the current rows are.
+"""
+from collections import defaultdict
+
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .database.models import (
+    db,
+    Company,
+    Partner,
+    Sanction,
+    companies_history,
+    ownerships_history,
+    partners_history,
+    sanctions_history,
+    valid_at
+)
+
+
+def _where_in(column, ids):
+    return [] if ids is None else [column.in_(ids)]
+
+
+def _versions(model, history, as_of, *criteria):
+    columns = [history.c[column.name] for column in model.__table__.columns]
+    rows = db.session.execute(
+        db.select(*columns)
+        .where(valid_at(history, as_of), *criteria)
+        .order_by(history.c.id))
+
+    return [model.from_row(row) for row in rows]
+
+
+def _edges(as_of, *criteria):
+    return db.session.execute(
+        db.select(ownerships_history.c.company_id,
+                  ownerships_history.c.partner_id)
+        .where(valid_at(ownerships_history, as_of), *criteria)
+    ).all()
+
+
+def _attach_sanctions(companies, as_of, company_ids):
+    by_company = defaultdict(list)
+    for sanction in _versions(
+            Sanction, sanctions_history, as_of,
+            *_where_in(sanctions_history.c.company_id, company_ids)):
+        by_company[sanction.company_id].append(sanction)
+
+    for company in companies:
+        set_committed_value(company, 'sanctions', by_company[company.id])
+
+
+def companies_as_of(as_of, ids=None):
+    """Companies, with their partners and sanctions, at ``as_of``.
+
+    Args:
+        as_of (datetime): the moment (UTC) to read.
+        ids (list): ids of the companies to read. Defaults to all of them.
+
+    Returns:
+        list: detached companies ordered by id, to be formatted.
+    """
+    companies = _versions(Company, companies_history, as_of,
+                          *_where_in(companies_history.c.id, ids))
+    # when reading every company, the related rows are read whole too
+    company_ids = None if ids is None \
+        else [company.id for company in companies]
+
+    edges = _edges(as_of, *_where_in(ownerships_history.c.company_id,
+                                     company_ids))
+    partner_ids = None if ids is None \
+        else {partner_id for _, partner_id in edges}
+    partners = {partner.id: partner for partner in _versions(
+        Partner, partners_history, as_of,
+        *_where_in(partners_history.c.id, partner_ids))}
+
+    by_company = defaultdict(list)
+    for company_id, partner_id in sorted(edges, key=lambda edge: edge[1]):
+        if partner_id in partners:
+            by_company[company_id].append(partners[partner_id])
+
+    for company in companies:
+        set_committed_value(company, 'partners', by_company[company.id])
+    _attach_sanctions(companies, as_of, company_ids)
+
+    return companies
+
+
+def partners_as_of(as_of, ids=None):
+    """Partners, with their companies and their sanctions, at ``as_of``.
+
+    Args:
+        as_of (datetime): the moment (UTC) to read.
+        ids (list): ids of the partners to read. Defaults to all of them.
+
+    Returns:
+        list: detached partners ordered by id, to be formatted.
+    """
+    partners = _versions(Partner, partners_history, as_of,
+                         *_where_in(partners_history.c.id, ids))
+    partner_ids = None if ids is None \
+        else [partner.id for partner in partners]
+
+    edges = _edges(as_of, *_where_in(ownerships_history.c.partner_id,
+                                     partner_ids))
+    company_ids = None if ids is None \
+        else {company_id for company_id, _ in edges}
+    companies = {company.id: company for company in _versions(
+        Company, companies_history, as_of,
+        *_where_in(companies_history.c.id, company_ids))}
+    _attach_sanctions(list(companies.values()), as_of, company_ids)
+
+    by_partner = defaultdict(list)
+    for company_id, partner_id in sorted(edges):
+        if company_id in companies:
+            by_partner[partner_id].append(companies[company_id])
+
+    for partner in partners:
+        set_committed_value(partner, 'companies', by_partner[partner.id])
+
+    return partners
+
+
+def sanctions_as_of(as_of, company_id=None, active_at=None):
+    """Sanctions at ``as_of`` ordered by id.
+
+    Args:
+        as_of (datetime): the moment (UTC) to read.
+        company_id (int): only the sanctions of this company.
+        active_at (date): only the sanctions in force on this date.
+    """
+    criteria = []
+    if company_id is not None:
+        criteria.append(sanctions_history.c.company_id == company_id)
+    if active_at is not None:
+        criteria.append(Sanction.active_at(active_at, sanctions_history))
+
+    return _versions(Sanction, sanctions_history, as_of, *criteria)
+
+
+def company_as_of(id, as_of):
+    """The company ``id`` at ``as_of``, or None when it did not exist."""
+    companies = companies_as_of(as_of, [id])
+
+    return companies[0] if companies else None
+
+
+def partner_as_of(id, as_of):
+    """The partner ``id`` at ``as_of``, or None when it did not exist."""
+    partners = partners_as_of(as_of, [id])
+
+    return partners[0] if partners else None
@@ -0,0 +1,97 @@
+import os
+
+from flask import current_app
+
+from .. import signals
+from ..database.models import Job
+from .bloom import ScreeningFilter
+from .sorted_index import ScreeningIndex
+from .taint import screening_rows, tainted_around, tainted_fiscal_numbers
+
+
+def setup_screening_filter(app):
+    path = app.config.get('SCREENING_FILTER_PATH') or \
+        os.path.join(app.instance_path, 'screening.bloom')
+    screening_filter = ScreeningFilter(
+        path, float(app.config.get('SCREENING_FILTER_FPR', 0.01)))
+    app.extensions['screening_filter'] = screening_filter
+
+    index_path = app.config.get('SCREENING_INDEX_PATH') or \
+        os.path.join(app.instance_path, 'screening.index')
+    app.extensions['screening_index'] = ScreeningIndex(index_path)
+
+    signals.companies_changed.connect(_on_companies_changed, app)
+    signals.ownerships_changed.connect(_on_ownerships_changed, app)
+    signals.sanctions_changed.connect(_on_sanctions_changed, app)
+
+    return screening_filter
+
+
+def get_screening_filter():
+    """Return the screening filter, building it on first use."""
+    screening_filter = current_app.extensions['screening_filter']
+    if not screening_filter.exists:
+        rebuild_screening_filter()
+
+    return screening_filter
+
+
+def map_screening_files():
+    """Map the screening filter and index, when they are built, so that the
+    processes forked afterwards share the mappings."""
+    current_app.extensions['screening_filter'].load()
+    current_app.extensions['screening_index'].load()
+
+
+def rebuild_screening_filter():
+    """Rebuild the screening filter from the database.
+
+    Returns:
+        int: the generation of the new filter.
+    """
+    screening_filter = current_app.extensions['screening_filter']
+    return screening_filter.rebuild(tainted_fiscal_numbers())
+
+
+def build_screening_index():
+    """Build the screening index from the database.
+
+    The filter generation is read before the companies are queried, so a
+    write committed during the build leaves the index outdated rather than
+    wrong.
+
+    Returns:
+        int: the number of companies in the index.
+    """
+    generation = get_screening_filter().generation
+    index = current_app.extensions['screening_index']
+
+    return index.build(screening_rows(), generation)
+
+
+def _add_tainted(company_ids):
+    if not get_screening_filter().add(tainted_around(company_ids)):
+        rebuild_screening_filter()
+
+
+# signal receivers. New sanctions, ownerships and fiscal numbers may taint
+# companies, so their fiscal numbers are added at once. Removals only leave
+# stale bits, which screening resolves against the database, except for
+# deleted sanctions, after which a worker rebuilds the filter to keep it
+# selective.
+
+def _on_companies_changed(sender, company_ids, action, **kwargs):
+    if action == 'updated':
+        _add_tainted(company_ids)
+
+
+def _on_ownerships_changed(sender, edges, action):
+    if action == 'created':
+        _add_tainted({company_id for company_id, _ in edges})
+
+
+def _on_sanctions_changed(sender, company_ids, action):
+    if action == 'created':
+        _add_tainted(company_ids)
+    elif action == 'deleted':
+        Job.enqueue('rebuild_screening_filter', unique=True)
@@ -0,0 +1,168 @@
+"""Bloom filter of the fiscal numbers that fail screening.
+
+File layout (little endian)::
+
+    magic      4 bytes  b'CPBF'
+    version    uint16   1
+    hashes     uint16   k, number of bit positions per key
+    bits       uint64   m, size of the bit array
+    capacity   uint64   number of keys the filter was sized for
+    count      uint64   number of keys added since the last rebuild
+    generation uint64   incremented on every change of the filter
+    bit array  m / 8 bytes, bit i is (byte i // 8) >> (i % 8) & 1
+
+A key is the fiscal number as 14 ASCII digits. Its positions are
+``(h1 + i * h2) % m`` for ``i`` in ``range(k)``, where ``h1`` and ``h2`` are
+the first and last 8 bytes (little endian) of its 16 bytes BLAKE2b digest,
+``h2`` with its lowest bit set.
+"""
+import hashlib
+import math
+import struct
+
+from ..documents import format_cnpj
+from .mapped import MappedFile, atomic_write, file_lock
+
+MAGIC = b'CPBF'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQQQ')
+# offsets of the fields updated in place
+_COUNT = 24
+_GENERATION = 32
+
+
+def parameters(capacity, false_positive_rate):
+    """Return the number of bits and of hashes for the wanted error rate."""
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(false_positive_rate)
+                     / math.log(2) ** 2)
+    bits = max(64, (bits + 7) // 8 * 8)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+
+    return bits, hashes
+
+
+def positions(fiscal_number, bits, hashes):
+    digest = hashlib.blake2b(format_cnpj(fiscal_number).encode(),
+                             digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class ScreeningFilter:
+    """Bloom filter file shared by every worker through ``mmap``.
+
+    Adding keys sets bits in the shared mapping under a file lock, so every
+    worker sees them at once. Bits cannot be cleared: a rebuild writes a new
+    file and swaps it in place, and workers remap it on their next lookup.
+    """
+
+    def __init__(self, path, false_positive_rate=0.01):
+        self.path = path
+        self.false_positive_rate = false_positive_rate
+        self._file = MappedFile(path, writable=True)
+
+    def load(self):
+        """Map the filter file, when it exists, ahead of the first lookup.
+
+        Returns:
+            bool: whether the file exists.
+        """
+        return self._file.get() is not None
+
+    @property
+    def exists(self):
+        return self.load()
+
+    def _header(self, buffer):
+        magic, version, hashes, bits, capacity, count, generation = \
+            HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{self.path} is not a screening filter')
+
+        return hashes, bits, capacity, count, generation
+
+    def might_contain(self, fiscal_number):
+        """False means the fiscal number is definitely not in the filter.
+
+        Raises:
+            FileNotFoundError: when the filter was never built.
+        """
+        buffer = self._file.get()
+        if buffer is None:
+            raise FileNotFoundError(self.path)
+
+        hashes, bits, _, _, _ = self._header(buffer)
+        offset = HEADER.size
+        for position in positions(fiscal_number, bits, hashes):
+            if not buffer[offset + position // 8] >> (position % 8) & 1:
+                return False
+
+        return True
+
+    def add(self, fiscal_numbers):
+        """Add fiscal numbers to the filter.
+
+        Returns:
+            bool: False when the filter is over capacity and should be
+            rebuilt to keep its false positive rate.
+        """
+        fiscal_numbers = list(fiscal_numbers)
+        if not fiscal_numbers:
+            return True
+
+        with file_lock(self.path):
+            buffer = self._file.get()
+            if buffer is None:
+                raise FileNotFoundError(self.path)
+
+            hashes, bits, capacity, count, generation = self._header(buffer)
+            offset = HEADER.size
+            for fiscal_number in fiscal_numbers:
+                for position in positions(fiscal_number, bits, hashes):
+                    buffer[offset + position // 8] |= 1 << (position % 8)
+
+            count += len(fiscal_numbers)
+            struct.pack_into('<QQ', buffer, _COUNT, count, generation + 1)
+
+        return count <= capacity
+
+    def rebuild(self, fiscal_numbers):
+        """Replace the filter by one holding exactly ``fiscal_numbers``.
+
+        The filter is sized for twice the current keys, leaving room for the
+        keys added until the next rebuild.
+        """
+        with file_lock(self.path):
+            fiscal_numbers = list(fiscal_numbers)
+            buffer = self._file.get()
+            generation = self._header(buffer)[4] + 1 if buffer else 1
+
+            capacity = max(2 * len(fiscal_numbers), 1024)
+            bits, hashes = parameters(capacity, self.false_positive_rate)
+            array = bytearray(bits // 8)
+            for fiscal_number in fiscal_numbers:
+                for position in positions(fiscal_number, bits, hashes):
+                    array[position // 8] |= 1 << (position % 8)
+
+            header = HEADER.pack(MAGIC, VERSION, hashes, bits, capacity,
+                                 len(fiscal_numbers), generation)
+            atomic_write(self.path, [header, array])
+
+        return generation
+
+    @property
+    def generation(self):
+        buffer = self._file.get()
+        return self._header(buffer)[4] if buffer else None
+
+    def dump(self):
+        """Return the generation and a copy of the serialized filter."""
+        with file_lock(self.path):
+            buffer = self._file.get()
+            if buffer is None:
+                raise FileNotFoundError(self.path)
+
+            return self._header(buffer)[4], bytes(buffer)
@@ -0,0 +1,91 @@
+import fcntl
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+class MappedFile:
+    """Memory map of a file that rebuilds replace atomically.
+
+    Every access checks, with a single ``stat``, whether the path still
+    points to the mapped inode. When a rebuild has swapped the file, the new
+    one is mapped and the old mapping is dropped, so long running workers
+    follow rebuilds without restarting.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+        self._identity = None
+        self._map = None
+
+    def get(self):
+        """Return the current mapping, or None when the file is missing."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        identity = (stat.st_dev, stat.st_ino, stat.st_size)
+        if identity == self._identity:
+            return self._map
+
+        with self._lock:
+            if identity != self._identity:
+                self._remap(identity)
+
+        return self._map
+
+    def _remap(self, identity):
+        flags = os.O_RDWR if self.writable else os.O_RDONLY
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+
+        fd = os.open(self.path, flags)
+        try:
+            # the mapping keeps the inode alive after the descriptor is gone
+            self._map = mmap.mmap(fd, 0, access=access)
+        finally:
+            os.close(fd)
+
+        self._identity = identity
+
+
+def atomic_write(path, chunks):
+    """Write ``chunks`` to a temporary file and swap it in place of ``path``.
+
+    Readers see either the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in chunks:
+                tmp.write(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock shared by every process using ``path``."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
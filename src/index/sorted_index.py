@@ -0,0 +1,165 @@
+"""Read-only screening index shared by every worker through ``mmap``.
+
+File layout (native byte order, built and read on the same host)::
+
+    magic       4 bytes  b'CPSI'
+    version     uint16   1
+    reserved    uint16
+    count       uint64   number of companies
+    generation  uint64   screening filter generation the index matches
+    built_at    float64  unix time of the build
+    fiscal      count x uint64, sorted fiscal numbers
+    company id  count x uint32, id of the company at the same position
+    flags       count x uint8, SANCTIONED | TAINTED
+
+Lookups binary search the fiscal numbers straight in the mapping, without
+copying or parsing the file.
+"""
+import array
+import bisect
+import shutil
+import struct
+import tempfile
+import time
+
+from .mapped import MappedFile, atomic_write, file_lock
+
+MAGIC = b'CPSI'
+VERSION = 1
+HEADER = struct.Struct('=4sHHQQd')
+
+SANCTIONED = 1
+TAINTED = 2
+
+_CHUNK = 65536
+
+
+class ScreeningIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = MappedFile(path)
+        self._buffer = None
+        self._views = None
+
+    def _load(self):
+        buffer = self._file.get()
+        if buffer is None:
+            return None
+
+        if buffer is not self._buffer:
+            magic, version, _, count, generation, built_at = \
+                HEADER.unpack_from(buffer)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{self.path} is not a screening index')
+
+            view = memoryview(buffer)
+            start = HEADER.size
+            fiscal = view[start:start + 8 * count].cast('Q')
+            start += 8 * count
+            ids = view[start:start + 4 * count].cast('I')
+            start += 4 * count
+            flags = view[start:start + count]
+
+            self._views = (generation, built_at, fiscal, ids, flags)
+            self._buffer = buffer
+
+        return self._views
+
+    def load(self):
+        """Map the index file, when it exists, ahead of the first lookup.
+
+        Returns:
+            bool: whether the file exists.
+        """
+        return self._load() is not None
+
+    def lookup(self, fiscal_number, generation):
+        """Find a company in the index.
+
+        Args:
+            fiscal_number (int): the normalized fiscal number.
+            generation (int): current generation of the screening filter.
+                The index only answers while it matches, that is while no
+                sanction or ownership changed since it was built.
+
+        Returns:
+            tuple: (company_id, flags), (None, 0) when the company is not in
+            the index, or None when the index is missing or outdated.
+        """
+        views = self._load()
+        if views is None or views[0] != generation:
+            return None
+
+        _, _, fiscal, ids, flags = views
+        position = bisect.bisect_left(fiscal, fiscal_number)
+        if position < len(fiscal) and fiscal[position] == fiscal_number:
+            return ids[position], flags[position]
+
+        return None, 0
+
+    @property
+    def info(self):
+        views = self._load()
+        if views is None:
+            return None
+
+        generation, built_at, fiscal, _, _ = views
+        return {
+            'companies': len(fiscal),
+            'generation': generation,
+            'built_at': built_at
+        }
+
+    def build(self, rows, generation):
+        """Write a new index from ``rows`` and swap it in place.
+
+        Args:
+            rows (iterable): (fiscal_number, company_id, flags) tuples
+                sorted by fiscal number.
+            generation (int): screening filter generation read before the
+                rows were queried.
+
+        Returns:
+            int: the number of companies in the index.
+        """
+        # the arrays are spooled to temporary files, so the build does not
+        # need the whole table in memory
+        with tempfile.TemporaryFile() as fiscal_file, \
+                tempfile.TemporaryFile() as ids_file, \
+                tempfile.TemporaryFile() as flags_file:
+            count = 0
+            fiscal, ids, flags = array.array('Q'), array.array('I'), \
+                bytearray()
+            for fiscal_number, company_id, company_flags in rows:
+                fiscal.append(fiscal_number)
+                ids.append(company_id)
+                flags.append(company_flags)
+                count += 1
+
+                if len(flags) == _CHUNK:
+                    fiscal.tofile(fiscal_file)
+                    ids.tofile(ids_file)
+                    flags_file.write(flags)
+                    fiscal, ids, flags = array.array('Q'), \
+                        array.array('I'), bytearray()
+
+            fiscal.tofile(fiscal_file)
+            ids.tofile(ids_file)
+            flags_file.write(flags)
+
+            def chunks():
+                yield HEADER.pack(MAGIC, VERSION, 0, count, generation,
+                                  time.time())
+                for spooled in (fiscal_file, ids_file, flags_file):
+                    spooled.seek(0)
+                    while True:
+                        data = spooled.read(shutil.COPY_BUFSIZE)
+                        if not data:
+                            break
+                        yield data
+
+            with file_lock(self.path):
+                atomic_write(self.path, chunks())
+
+        return count
@@ -0,0 +1,78 @@
+"""Companies that fail screening.
+
+A company is tainted when it received a sanction, or when one of its
+partners owns a company that received one. Sanction periods are ignored on
+purpose: the tainted set is a superset of the companies ineligible on any
+date, and the exact answer for a date comes from ``Company.eligibility``.
+"""
+from ..database.models import db, Company, Sanction, ownerships
+from .sorted_index import SANCTIONED, TAINTED
+
+
+def _sanctioned():
+    return db.select(Sanction.company_id)
+
+
+def _co_owned(company_ids):
+    """Select the companies sharing a partner with ``company_ids``."""
+    ours = ownerships.alias('ours')
+    theirs = ownerships.alias('theirs')
+
+    return db.select(theirs.c.company_id) \
+        .join(ours, ours.c.partner_id == theirs.c.partner_id) \
+        .where(ours.c.company_id.in_(company_ids))
+
+
+def tainted_fiscal_numbers(batch_size=10000):
+    """Stream the fiscal numbers of every tainted company."""
+    statement = db.select(Company.fiscal_number) \
+        .where(db.or_(Company.id.in_(_sanctioned()),
+                      Company.id.in_(_co_owned(_sanctioned())))) \
+        .execution_options(yield_per=batch_size)
+
+    for fiscal_number in db.session.execute(statement).scalars():
+        yield fiscal_number
+
+
+def screening_rows(batch_size=10000):
+    """Stream (fiscal_number, company_id, flags) sorted by fiscal number."""
+    sanctioned = Company.id.in_(_sanctioned())
+    tainted = Company.id.in_(_co_owned(_sanctioned()))
+
+    statement = db.select(
+        Company.fiscal_number,
+        Company.id,
+        db.case((sanctioned, SANCTIONED | TAINTED),
+                (tainted, TAINTED),
+                else_=0)
+    ).order_by(Company.fiscal_number) \
+        .execution_options(yield_per=batch_size)
+
+    for row in db.session.execute(statement):
+        yield tuple(row)
+
+
+def tainted_around(company_ids):
+    """Fiscal numbers of the tainted companies near ``company_ids``.
+
+    Covers the given companies and every company sharing a partner with
+    them, which are all the companies whose taint a new sanction or a new
+    ownership of ``company_ids`` can change.
+    """
+    if not company_ids:
+        return []
+
+    around = db.select(Company.id).where(db.or_(
+        Company.id.in_(company_ids),
+        Company.id.in_(_co_owned(company_ids))
+    ))
+    sanctioned_near = db.select(Sanction.company_id) \
+        .where(db.or_(Sanction.company_id.in_(around),
+                      Sanction.company_id.in_(_co_owned(around))))
+
+    statement = db.select(Company.fiscal_number) \
+        .where(Company.id.in_(around),
+               db.or_(Company.id.in_(sanctioned_near),
+                      Company.id.in_(_co_owned(sanctioned_near))))
+
+    return db.session.execute(statement).scalars().all()
@@ -0,0 +1,132 @@
+import inspect
+import os
+
+import click
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    jsonify,
+    request,
+    send_from_directory
+)
+
+from .database.models import Job
+from .database.timeouts import TIMEOUTS
+from .auth.auth import requires_auth
+from .worker import TASKS, work
+from .worker.tasks import jobs_dir
+
+jobs_blueprint = Blueprint('jobs_blueprint', __name__, cli_group=None)
+
+
+@jobs_blueprint.route('/jobs', methods=['POST'])
+@requires_auth('post:jobs')
+def new_job(jwt):
+    """Queue a job to be run by ``flask worker``.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        kind (str): the job to run, one of the keys of
+            ``src.worker.tasks.TASKS``.
+        params (dict): optional arguments of the job, e.g. the ``file`` an
+            import reads from JOBS_DIR.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - created (int): Id of the queued job.
+    """
+    try:
+        data = request.get_json()
+
+        kind = data.get('kind')
+        params = data.get('params') or {}
+
+        if kind not in TASKS or not isinstance(params, dict):
+            raise ValueError(f'invalid job: {kind!r}')
+        # rejects missing or unexpected params before the job is queued
+        inspect.signature(TASKS[kind]).bind(None, **params)
+
+        job = Job.enqueue(kind, params)
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'created': job.id
+    }), 201
+
+
+@jobs_blueprint.route('/jobs/<int:id>', methods=['GET'])
+@requires_auth('get:jobs')
+def job(jwt, id):
+    """Retrieves the status and progress of a job.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the job.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - job (dict): the job in the following format:
+                - id (int)
+                - kind (str)
+                - params (dict)
+                - status (str): 'queued', 'running', 'succeeded' or 'failed'
+                - progress (int): units of work done
+                - total (int): units of work of the job, when known
+                - result (dict): outcome of a succeeded job
+                - error (str): cause of the failure of a failed job
+                - created_at (str)
+                - started_at (str)
+                - finished_at (str)
+    """
+    job = Job.query.get_or_404(id)
+
+    return jsonify({
+        'success': True,
+        'job': job.format()
+    }), 200
+
+
+@jobs_blueprint.route('/jobs/<int:id>/file', methods=['GET'])
+@requires_auth('get:jobs')
+def job_file(jwt, id):
+    """Download the file written by a job, such as a snapshot export.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the job.
+
+    Returns:
+        The file, or 404 when the job did not write one.
+    """
+    job = Job.query.get_or_404(id)
+    if job.status != Job.SUCCEEDED or 'file' not in (job.result or {}):
+        abort(404)
+
+    return send_from_directory(jobs_dir(), job.result['file'],
+                               as_attachment=True)
+
+
+@jobs_blueprint.cli.command('worker')
+@click.option('--processes', type=int,
+              help='Jobs run at the same time, one per process. '
+                   'Defaults to JOBS_WORKER_PROCESSES or the number of CPUs.')
+@click.option('--burst', is_flag=True,
+              help='Exit once the queue is empty.')
+def worker_command(processes, burst):
+    """Run the queued jobs."""
+    config = current_app.config
+    processes = processes or \
+        int(config.get('JOBS_WORKER_PROCESSES') or os.cpu_count())
+
+    work(current_app._get_current_object(), processes, burst,
+         poll_interval=float(config.get('JOBS_POLL_INTERVAL', 1)),
+         echo=click.echo,
+         stale_after=float(config.get('JOBS_STALE_AFTER', 60)))
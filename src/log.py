@@ -0,0 +1,216 @@
+"""Structured logging kept off the request threads.
+
+Request threads only tag a record with the request it belongs to and put it
+on a bounded queue. A listener thread formats it as a JSON line, traceback
+included, and writes it, so a burst of errors never blocks a worker on a
+slow stdout or stderr. When the queue is full the record is dropped and the
+number of dropped records is attached to the next one that gets through.
+
+Besides the records of the application, a ``request`` line is logged at the
+end of every request with its route, status, latency, number of SQL
+statements, statement timeout budget and connections in use (see
+``src.database.timeouts``). Identical errors (same message, exception type
+and route) are let through at most ``LOG_REPEAT_LIMIT`` times per
+``LOG_REPEAT_INTERVAL`` seconds; the first one let through afterwards
+tells how many were suppressed.
+"""
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+from sqlalchemy import event
+
+from .database.models import db
+from .database.timeouts import request_metrics
+
+# attributes every LogRecord has; any other one was passed in ``extra``
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message'}
+
+_listener = None
+_handler = None
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items()
+                     if key not in _RECORD_ATTRIBUTES)
+
+        if record.exc_info:
+            entry['exc_type'] = record.exc_info[0].__name__
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class _RequestFilter(logging.Filter):
+    """Tag records with the request being handled by the thread."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule \
+                else request.path
+
+        return True
+
+
+class _RepeatFilter(logging.Filter):
+    """Let through ``limit`` identical errors every ``interval`` seconds."""
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        # key -> [window start, records in the window, suppressed records]
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+
+        key = (record.name, record.msg,
+               record.exc_info and record.exc_info[0],
+               getattr(record, 'route', None))
+        now = time.monotonic()
+
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window and window[2]:
+                    record.suppressed = window[2]
+                if len(self._windows) > 1024:
+                    self._expire(now)
+                self._windows[key] = [now, 1, 0]
+                return True
+
+            window[1] += 1
+            if window[1] <= self.limit:
+                return True
+
+            window[2] += 1
+            return False
+
+    def _expire(self, now):
+        for key, window in list(self._windows.items()):
+            if now - window[0] >= self.interval and not window[2]:
+                del self._windows[key]
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler formats the record here; that, tracebacks included,
+        # is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped = 0
+
+
+def _count_statement(*args):
+    if has_request_context() and 'sql_count' in g:
+        g.sql_count += 1
+
+
+def restart_logging():
+    """Start the listener again in a process forked from the one that set
+    logging up, such as a gunicorn worker of a preloaded app.
+
+    Threads do not survive a fork, and the lock of the queue may have been
+    held by the listener of the parent, so both are replaced.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+
+    _handler.queue = queue.Queue(_handler.queue.maxsize)
+    _listener = QueueListener(_handler.queue, *_listener.handlers)
+    _listener.start()
+
+
+def setup_logging(app):
+    global _listener, _handler
+
+    config = app.config
+    handler = _NonBlockingQueueHandler(
+        queue.Queue(int(config.get('LOG_QUEUE_SIZE', 10000))))
+    handler.addFilter(_RequestFilter())
+    handler.addFilter(_RepeatFilter(
+        int(config.get('LOG_REPEAT_LIMIT', 5)),
+        float(config.get('LOG_REPEAT_INTERVAL', 60))))
+
+    output = logging.StreamHandler()
+    output.setFormatter(JSONFormatter())
+
+    # the logger is shared by every app of the process, e.g. in tests; the
+    # handler of the previous app is replaced rather than duplicated
+    if _listener:
+        _listener.stop()
+        app.logger.removeHandler(_handler)
+    else:
+        atexit.register(lambda: _listener.stop())
+
+    _listener = QueueListener(handler.queue, output)
+    _listener.start()
+    _handler = handler
+
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(handler)
+    app.logger.setLevel(config.get('LOG_LEVEL', 'INFO'))
+    app.logger.propagate = False
+
+    requests_logger = app.logger.getChild('requests')
+
+    @app.before_request
+    def start_request_log():
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+
+    @app.after_request
+    def log_request(response):
+        if 'request_started' in g:
+            latency = time.perf_counter() - g.request_started
+            requests_logger.info('request', extra={
+                'status': response.status_code,
+                'latency_ms': round(latency * 1000, 3),
+                'sql_count': g.sql_count,
+                **request_metrics(db.engine)
+            })
+
+        return response
+
+    router = app.extensions.get('replicas')
+    with app.app_context():
+        for engine in [db.engine] + [replica.engine for replica in
+                                     (router.replicas if router else [])]:
+            event.listen(engine, 'before_cursor_execute', _count_statement)
+
+    return handler
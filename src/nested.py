@@ -0,0 +1,109 @@
+"""Pages of the partners of a company and of the companies of a partner.
+
+Documents embed at most ``NESTED_LIMIT`` of them, with their total and a
+cursor, so funds and state holdings with tens of thousands of ownerships
+still get small responses. The others are read a page at a time, from
+the cursor on, with a range scan of an index of ownerships: its primary
+key (company_id, partner_id) for the partners of a company and
+``ix_ownerships_partner_id_company_id`` for the companies of a partner. A
+page takes the same time whatever its position in the collection.
+
+``format()`` reads the first page of the collection it embeds this way,
+rather than loading the whole collection, unless the collection is loaded
+already or every row is asked for. The read model reads the first pages of
+a batch of documents at once with ``ownership_pages``.
+"""
+from sqlalchemy.orm import selectinload
+
+from .database.models import (
+    db,
+    NESTED_LIMIT,
+    Company,
+    Partner,
+    nested_cursor,
+    ownerships
+)
+
+# most rows of a page a client may ask for
+MAX_PAGE_SIZE = 1000
+
+
+def _sides(model):
+    """Owner and owned columns of ownerships and the loader options of the
+    rows of ``model``."""
+    if model is Partner:
+        return ownerships.c.company_id, ownerships.c.partner_id, ()
+
+    # companies are formatted with their sanctions
+    return ownerships.c.partner_id, ownerships.c.company_id, \
+        (selectinload(Company.sanctions),)
+
+
+def ownership_page(model, id, cursor=0, limit=NESTED_LIMIT):
+    """A page of the partners of a company or of the companies of a partner.
+
+    Args:
+        model: Partner, for the partners of the company ``id``, or Company,
+            for the companies of the partner ``id``.
+        id (int): Id of the company or of the partner.
+        cursor (int): the rows after this id are read.
+        limit (int): most rows read.
+
+    Returns:
+        tuple: the rows ordered by id, their total, whatever the cursor,
+        and the cursor of the next page, None on the last one.
+    """
+    owner, owned, options = _sides(model)
+
+    rows = db.session.scalars(
+        db.select(model)
+        .join(ownerships, owned == model.id)
+        .where(owner == id, owned > cursor)
+        .options(*options)
+        .order_by(owned)
+        .limit(limit + 1)).all()
+    total = db.session.scalar(
+        db.select(db.func.count()).select_from(ownerships)
+        .where(owner == id))
+
+    return rows[:limit], total, nested_cursor(rows, limit)
+
+
+def ownership_pages(model, ids, limit=NESTED_LIMIT, session=None):
+    """The first pages of the partners of companies, or of the companies of
+    partners, read at once.
+
+    Args:
+        model: Partner or Company, as in ``ownership_page``.
+        ids (list): Ids of the companies or of the partners.
+        limit (int): most rows read for each of them.
+        session: the session reading them, ``db.session`` by default.
+
+    Returns:
+        dict: the first page of each id, as returned by ``ownership_page``.
+    """
+    session = session or db.session
+    owner, owned, options = _sides(model)
+
+    # only the ids of the ownerships past the page are scanned, never
+    # loaded as rows
+    ranked = db.select(
+        owner.label('owner_id'), owned.label('owned_id'),
+        db.func.row_number().over(partition_by=owner, order_by=owned)
+        .label('rank')
+    ).where(owner.in_(ids)).subquery()
+
+    pages = {id: [] for id in ids}
+    for owner_id, row in session.execute(
+            db.select(ranked.c.owner_id, model)
+            .join(model, model.id == ranked.c.owned_id)
+            .where(ranked.c.rank <= limit + 1)
+            .options(*options)
+            .order_by(ranked.c.owner_id, ranked.c.owned_id)):
+        pages[owner_id].append(row)
+    totals = dict(session.execute(
+        db.select(owner, db.func.count()).where(owner.in_(ids))
+        .group_by(owner)).all())
+
+    return {id: (rows[:limit], totals.get(id, 0), nested_cursor(rows, limit))
+            for id, rows in pages.items()}
@@ -0,0 +1,402 @@
+"""Notifications of watched companies that become ineligible.
+
+A new sanction, or a new ownership, can make ineligible the company it
+concerns and every company sharing a partner with it. After such a write is
+committed, the tainted companies around it are matched against the fiscal
+numbers of the watchlists, through the ``watchlist_entries`` index on
+fiscal numbers, and those not eligible today get a notification for every
+watchlist monitoring them. Nothing is done for unwatched companies beyond
+that lookup. A watchlist already told a company is ineligible is not told
+again while a sanction of its last notification is still in force: the
+company has not been eligible since.
+
+Notifications are stored, then:
+
+* streamed as server-sent events by /watchlists/<id>/events. Streams of
+  this process wake up as soon as notifications are created; those of
+  other processes find them on their next poll. Each open stream holds a
+  thread of its worker, so a worker serves at most WATCHLIST_MAX_STREAMS
+  of them at once;
+* posted to the webhook of their watchlist by the
+  ``deliver_notifications`` job, which retries failed deliveries on its
+  next runs. Webhooks must be public hosts, checked when a watchlist is
+  created and again before every delivery, as the host may since resolve
+  to other addresses. The address actually connected to is checked too,
+  before anything is sent, as the host may resolve to another one by then;
+  redirects are not followed.
+"""
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import socket
+import ssl
+import threading
+import time
+import urllib.request
+from datetime import date, datetime
+from urllib.parse import urlparse
+
+from flask import current_app
+
+from .database.models import (
+    db,
+    unit_of_work,
+    Company,
+    Job,
+    Notification,
+    Watchlist,
+    WatchlistEntry
+)
+from .index import tainted_around
+from . import signals
+
+SANCTION = 'sanction'
+OWNERSHIP = 'ownership'
+
+# notifications read at once by streams and deliveries
+BATCH_SIZE = 100
+
+SIGNATURE_HEADER = 'X-Capstone-Signature'
+
+
+class _Notifier:
+    """Wakes the event streams of the process up on new notifications and
+    caps how many are open."""
+
+    def __init__(self, max_streams):
+        self._condition = threading.Condition()
+        self._streams = threading.BoundedSemaphore(max_streams)
+        self.generation = 0
+
+    def open_stream(self):
+        """Take the slot of a stream.
+
+        Returns:
+            bool: False when every slot is taken.
+        """
+        return self._streams.acquire(blocking=False)
+
+    def close_stream(self):
+        self._streams.release()
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Wait until notifications newer than ``generation`` exist.
+
+        Returns:
+            bool: False when the timeout elapsed first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.generation != generation, timeout)
+
+
+def setup_notifications(app):
+    app.extensions['notifications'] = _Notifier(
+        int(app.config.get('WATCHLIST_MAX_STREAMS', 4)))
+
+    signals.ownerships_changed.connect(_on_ownerships_changed, app)
+    signals.sanctions_changed.connect(_on_sanctions_changed, app)
+
+
+def _reasons(eligibility):
+    """Ids of the sanctions that make a company ineligible."""
+    return {sanction['id'] for sanction in eligibility['sanctions']} | {
+        related['sanction']['id']
+        for related in eligibility['partners_sanctions']}
+
+
+def _notified(rows):
+    """Reasons of the last notification of each (watchlist, company)."""
+    watchlist_ids = {watchlist_id for watchlist_id, _ in rows}
+    company_ids = {company.id for _, company in rows}
+    last_ids = db.select(db.func.max(Notification.id)) \
+        .where(Notification.watchlist_id.in_(watchlist_ids),
+               Notification.company_id.in_(company_ids)) \
+        .group_by(Notification.watchlist_id, Notification.company_id)
+
+    return {
+        (notification.watchlist_id, notification.company_id):
+        _reasons(notification.eligibility)
+        for notification in db.session.scalars(
+            db.select(Notification).where(Notification.id.in_(last_ids)))
+    }
+
+
+def notify_watchlists(company_ids, event):
+    """Notify the watchlists of the companies ``company_ids`` made ineligible.
+
+    Args:
+        company_ids (set): companies that received a sanction or an
+            ownership.
+        event (str): the write, SANCTION or OWNERSHIP.
+
+    Returns:
+        list: the notifications created. Companies still ineligible for a
+        reason their last notification gave are left out.
+    """
+    tainted = tainted_around(company_ids)
+    if not tainted:
+        return []
+
+    rows = db.session.execute(
+        db.select(WatchlistEntry.watchlist_id, Company)
+        .join(Company, Company.fiscal_number == WatchlistEntry.fiscal_number)
+        .where(WatchlistEntry.fiscal_number.in_(tainted))
+        .order_by(Company.id, WatchlistEntry.watchlist_id)
+    ).all()
+
+    today = date.today()
+    notified = _notified(rows) if rows else {}
+    eligibilities = {}
+    notifications = []
+    for watchlist_id, company in rows:
+        if company.id not in eligibilities:
+            eligibilities[company.id] = company.eligibility(today)
+        if eligibilities[company.id]['eligible']:
+            continue
+        if _reasons(eligibilities[company.id]) \
+                & notified.get((watchlist_id, company.id), set()):
+            continue
+
+        notifications.append(Notification(
+            watchlist_id=watchlist_id,
+            event=event,
+            company_id=company.id,
+            fiscal_number=company.fiscal_number,
+            eligibility=eligibilities[company.id]))
+
+    if not notifications:
+        return []
+
+    with unit_of_work():
+        for notification in notifications:
+            notification.insert()
+
+    current_app.extensions['notifications'].notify()
+    watchlist_ids = {notification.watchlist_id
+                     for notification in notifications}
+    if Watchlist.query.filter(Watchlist.id.in_(watchlist_ids),
+                              Watchlist.webhook_url.isnot(None)).count():
+        Job.enqueue('deliver_notifications', unique=True)
+
+    return notifications
+
+
+def _notify(company_ids, event):
+    # the write is committed already: a failure here must not fail it
+    try:
+        notify_watchlists(company_ids, event)
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception('watchlists not notified')
+
+
+def _on_ownerships_changed(sender, edges, action):
+    if action == 'created':
+        _notify({company_id for company_id, _ in edges}, OWNERSHIP)
+
+
+def _on_sanctions_changed(sender, company_ids, action):
+    if action == 'created':
+        _notify(company_ids, SANCTION)
+
+
+def signature(secret, body):
+    """Value of the signature header of a webhook request."""
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    return f'sha256={digest}'
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect could lead to an address check_webhook_url refuses; the
+    # 3xx is raised as an HTTPError instead
+    def redirect_request(self, *args):
+        return None
+
+
+def _allow_private():
+    allow_private = str(
+        current_app.config.get('WEBHOOK_ALLOW_PRIVATE', False)).lower()
+
+    return allow_private not in ('0', 'false', 'no')
+
+
+def _is_public(host):
+    address = ipaddress.ip_address(host)
+
+    return address.is_global and not address.is_multicast
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    # the host is resolved again to connect: the peer of the socket is the
+    # address the body would go to
+    def connect(self):
+        super().connect()
+        if not _allow_private() and \
+                not _is_public(self.sock.getpeername()[0]):
+            self.sock.close()
+            raise ValueError(f'webhook host is not public: {self.host!r}')
+
+
+# HTTPSConnection.connect calls the check above before the TLS handshake
+class _PublicHTTPSConnection(http.client.HTTPSConnection,
+                             _PublicHTTPConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req,
+                            context=ssl.create_default_context())
+
+
+# no proxies: the peer of the socket must be the host of the webhook
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _NoRedirect, _PublicHTTPHandler,
+    _PublicHTTPSHandler)
+
+
+def check_webhook_url(url):
+    """Check that ``url`` is an http(s) URL of a public host.
+
+    Every address the host resolves to must be public: loopback, link-local,
+    private and reserved addresses are refused, unless WEBHOOK_ALLOW_PRIVATE
+    is set, e.g. to deliver to a receiver on the same network.
+
+    Raises:
+        ValueError: when the URL is invalid or its host is not public.
+        OSError: when the host does not resolve.
+    """
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError(f'invalid webhook url: {url!r}')
+
+    if _allow_private():
+        return
+
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    for *_, sockaddr in socket.getaddrinfo(parts.hostname, port,
+                                           proto=socket.IPPROTO_TCP):
+        if not _is_public(sockaddr[0]):
+            raise ValueError(f'webhook host is not public: {url!r}')
+
+
+def post_webhook(watchlist, notification, timeout):
+    """POST a formatted notification to the webhook of ``watchlist``.
+
+    Raises:
+        OSError: when the request fails or is answered with an error.
+        ValueError: when the webhook is not a public host.
+    """
+    check_webhook_url(watchlist.webhook_url)
+
+    body = json.dumps(notification).encode()
+    headers = {'Content-Type': 'application/json'}
+    if watchlist.webhook_secret:
+        headers[SIGNATURE_HEADER] = signature(watchlist.webhook_secret, body)
+
+    request = urllib.request.Request(watchlist.webhook_url, data=body,
+                                     headers=headers, method='POST')
+    with _opener.open(request, timeout=timeout):
+        pass
+
+
+def deliver_notifications():
+    """Post the undelivered notifications to the webhooks of their lists.
+
+    A failed delivery is counted in ``attempts`` and retried by the next
+    run, until WEBHOOK_MAX_ATTEMPTS. Receivers may get notifications out of
+    order and should rely on their ids.
+
+    Returns:
+        dict: the number of notifications delivered and failed.
+    """
+    timeout = float(current_app.config.get('WEBHOOK_TIMEOUT', 5))
+    max_attempts = int(current_app.config.get('WEBHOOK_MAX_ATTEMPTS', 5))
+    delivered = failed = 0
+    last_id = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select(Notification, Watchlist)
+            .join(Watchlist, Watchlist.id == Notification.watchlist_id)
+            .where(Notification.id > last_id,
+                   Notification.delivered_at.is_(None),
+                   Notification.attempts < max_attempts,
+                   Watchlist.webhook_url.isnot(None))
+            .order_by(Notification.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+
+        for notification, watchlist in rows:
+            last_id = notification.id
+            notification.attempts += 1
+            try:
+                post_webhook(watchlist, notification.format(), timeout)
+            except (OSError, ValueError) as error:
+                notification.error = f'{type(error).__name__}: {error}'
+                failed += 1
+            else:
+                notification.delivered_at = datetime.utcnow()
+                notification.error = None
+                delivered += 1
+        db.session.commit()
+
+    return {'delivered': delivered, 'failed': failed}
+
+
+def event_stream(watchlist_id, last_id=0):
+    """Yield the notifications of a watchlist as server-sent events.
+
+    Starts after the notification ``last_id`` and ends after
+    WATCHLIST_STREAM_TIMEOUT seconds; clients reconnect with the
+    ``Last-Event-ID`` of the last event they got.
+    """
+    config = current_app.config
+    poll_interval = float(config.get('WATCHLIST_POLL_INTERVAL', 5))
+    deadline = time.monotonic() + \
+        float(config.get('WATCHLIST_STREAM_TIMEOUT', 300))
+    notifier = current_app.extensions['notifications']
+
+    yield f'retry: {int(poll_interval * 1000)}\n\n'
+
+    while True:
+        generation = notifier.generation
+        events = [notification.format() for notification in
+                  db.session.scalars(
+                      db.select(Notification)
+                      .where(Notification.watchlist_id == watchlist_id,
+                             Notification.id > last_id)
+                      .order_by(Notification.id)
+                      .limit(BATCH_SIZE))]
+        # the connection goes back to the pool while the stream waits
+        db.session.close()
+
+        for event in events:
+            last_id = event['id']
+            yield f'id: {last_id}\nevent: ineligible\n' \
+                f'data: {json.dumps(event)}\n\n'
+        if len(events) == BATCH_SIZE:
+            continue
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not notifier.wait(generation, min(poll_interval, remaining)):
+            # keeps proxies from closing an idle connection
+            yield ': keepalive\n\n'
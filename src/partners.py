@@ -1,25 +1,43 @@
-import sys
-
 from flask import (
     Blueprint,
     abort,
+    current_app,
     jsonify,
     request
 )
 
-from .database.models import Partner
+from .database.models import (
+    unit_of_work,
+    NESTED_LIMIT,
+    Company,
+    Partner,
+    PartnerDocument
+)
+from .database.timeouts import LIST_BUDGET, TIMEOUTS
 from .auth.auth import requires_auth
+from .auth.ratelimit import LIST_COST, admission_control
+from .encoding import respond, respond_document, respond_documents
+from .exposure import partner_exposure
+from .history import partner_as_of, partners_as_of
+from .nested import MAX_PAGE_SIZE, ownership_page
+from .read_model import partner_documents
+from .utils import get_as_of_arg, get_date_arg, get_int_arg
+from . import signals
 
 partners_blueprint = Blueprint('partners_blueprint', __name__)
 
 
 @partners_blueprint.route('/partners', methods=['GET'])
-@requires_auth('get:partners')
+@requires_auth('get:partners', cost=LIST_COST,
+               budget=LIST_BUDGET)
+@admission_control
 def partners(jwt):
     """Retrieves a list of all partners in the database.
 
     Args:
         jwt (str): the JSON Web Token used by the user.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to list the partners as they were then.
 
     Returns:
         JSON: A JSON with the following keys:
@@ -38,19 +56,105 @@ def partners(jwt):
                           received:
                             - id (int)
                             - organization (str)
+                            - start_date (str)
+                            - end_date (str)
     """
-    try:
-        partners = Partner.query.all()
+    as_of = get_as_of_arg()
 
-        partners_lst = [partner.format() for partner in partners]
+    try:
+        if as_of:
+            partners_lst = [partner.format()
+                            for partner in partners_as_of(as_of)]
+        else:
+            documents = partner_documents()
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
-    return jsonify({
+    if as_of:
+        return respond({
+            'success': True,
+            'partners': partners_lst
+        }, table='partners')
+
+    return respond_documents('partners', documents)
+
+
+@partners_blueprint.route('/partners/<int:id>', methods=['GET'])
+@requires_auth('get:partners')
+def partner(jwt, id):
+    """Retrieves a partner, with the companies it owns.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the partner.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to get the partner as it was then.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - partner (dict): the partner in the format of /partners.
+    """
+    as_of = get_as_of_arg()
+    if as_of:
+        partner = partner_as_of(id, as_of)
+        if partner is None:
+            abort(404)
+
+        return respond({
+            'success': True,
+            'partner': partner.format()
+        })
+
+    document = PartnerDocument.query.get_or_404(id)
+
+    return respond_document('partner', document.document)
+
+
+@partners_blueprint.route('/partners/<int:id>/companies', methods=['GET'])
+@requires_auth('get:partners')
+def partner_companies(jwt, id):
+    """Retrieves a page of the companies a partner owns.
+
+    A partner embeds the first companies it owns only; the others are read
+    from its ``companies_cursor``, one page after the other.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the partner.
+        cursor (int): optional ``next_cursor`` of the previous page, or
+            ``companies_cursor`` of the partner, in the query string.
+            Defaults to the first page.
+        limit (int): optional number of companies of the page, up to 1000.
+            Defaults to 100.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - companies (list): the companies ordered by id, with their
+              sanctions, in the format of the companies of /partners.
+            - total (int): number of companies the partner owns.
+            - next_cursor (int): cursor of the next page, None on the
+              last one.
+    """
+    Partner.query.get_or_404(id)
+    cursor = get_int_arg('cursor', 0, min_value=0)
+    limit = get_int_arg('limit', NESTED_LIMIT, min_value=1,
+                        max_value=MAX_PAGE_SIZE)
+
+    companies, total, next_cursor = ownership_page(Company, id, cursor,
+                                                   limit)
+
+    return respond({
         'success': True,
-        'partners': partners_lst
-    }), 200
+        'companies': [company.format(partners_info=False)
+                      for company in companies],
+        'total': total,
+        'next_cursor': next_cursor
+    }, table='companies')
 
 
 @partners_blueprint.route('/partners', methods=['POST'])
@@ -60,7 +164,8 @@ def new_partner(jwt):
 
     Args:
         jwt (str): the JSON Web Token used by the user.
-        document (str): a document of the partner.
+        document (str): a document (CPF or CNPJ) of the partner, with or
+            without punctuation. Its check digits must be valid.
         name (str): Name of the partner.
 
     Returns:
@@ -69,18 +174,25 @@ def new_partner(jwt):
             - created (int): Id of the created partner.
     """
     try:
-        data = request.get_json()
+        with unit_of_work():
+            data = request.get_json()
 
-        document = data.get('document')
-        name = data.get('name')
+            document = data.get('document')
+            name = data.get('name')
 
-        partner = Partner(document=document, name=name)
+            partner = Partner(document=document, name=name)
 
-        partner.insert()
+            partner.insert()
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.partners_changed.send(current_app._get_current_object(),
+                                  partner_ids={partner.id},
+                                  action='created')
+
     return jsonify({
         'success': True,
         'created': partner.id
@@ -106,23 +218,33 @@ def update_partner(jwt, id):
     partner = Partner.query.get_or_404(id)
 
     try:
-        data = request.get_json()
+        with unit_of_work():
+            data = request.get_json()
 
-        document = data.get('document')
-        name = data.get('name')
+            document = data.get('document')
+            name = data.get('name')
 
-        if document:
-            partner.document = document
+            columns = set()
+            if document:
+                partner.document = document
+                columns.add('document')
 
-        if name:
-            partner.name = name
+            if name:
+                partner.name = name
+                columns.add('name')
 
-        partner.update()
+            partner.update()
 
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.partners_changed.send(current_app._get_current_object(),
+                                  partner_ids={partner.id},
+                                  action='updated', columns=columns)
+
     return jsonify({
         'success': True,
         'updated': partner.id
@@ -146,13 +268,82 @@ def delete_partner(jwt, id):
     partner = Partner.query.get_or_404(id)
 
     try:
-        partner.delete()
+        with unit_of_work():
+            partner.delete()
 
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.partners_changed.send(current_app._get_current_object(),
+                                  partner_ids={id},
+                                  action='deleted')
+
     return jsonify({
         'success': True,
         'deleted': id
     }), 200
+
+
+@partners_blueprint.route('/partners/<int:id>/exposure', methods=['GET'])
+@requires_auth('get:partners', cost=LIST_COST,
+               budget=LIST_BUDGET)
+@admission_control
+def partner_exposure_route(jwt, id):
+    """List the sanctioned companies reachable from a partner.
+
+    The first hop reaches the companies owned by the partner. A company that
+    is itself a partner of other companies leads, on the next hop, to the
+    companies it owns, and so on up to ``depth`` hops.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the partner.
+        depth (int): maximum number of ownership hops (query string,
+            defaults to 1).
+        active_at (str): optional date (YYYY-MM-DD) in the query string.
+            When given, only sanctions in force on that date are considered.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - exposure (dict): exposure of the partner:
+                - id (int)
+                - depth (int)
+                - active_at (str)
+                - companies (list): sanctioned companies reachable from the
+                  partner in the following format:
+                    - id (int)
+                    - fiscal_number (str)
+                    - name (str)
+                    - sanctions (list)
+                    - path (list): ids of the companies from the partner
+                      down to the sanctioned company
+    """
+    Partner.query.get_or_404(id)
+    max_depth = int(current_app.config.get('EXPOSURE_MAX_DEPTH', 6))
+    depth = get_int_arg('depth', 1, min_value=1, max_value=max_depth)
+    active_at = get_date_arg('active_at')
+
+    cache = current_app.extensions['exposure_cache']
+    key = (id, depth, active_at)
+
+    exposure = cache.get(key)
+    if exposure is None:
+        try:
+            exposure, company_ids, partner_ids = partner_exposure(
+                id, depth, active_at)
+        except TIMEOUTS:
+            raise
+        except Exception:
+            current_app.logger.exception('unprocessable request')
+            abort(422)
+
+        cache.set(key, exposure, company_ids, partner_ids)
+
+    return jsonify({
+        'success': True,
+        'exposure': exposure
+    }), 200
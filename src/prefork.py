@@ -0,0 +1,59 @@
+"""Sharing of an app built once in the gunicorn master.
+
+With ``preload_app`` (see ``gunicorn.conf.py``), the master imports
+``wsgi``, so the app is created, its tables checked and its modules
+imported once instead of in every worker. ``warm_up`` then builds in the
+master what the workers would otherwise each build on their first requests:
+the python-jose backends, the JWKS of AUTH0_DOMAIN and the mappings of the
+screening filter and index. Workers share all of it copy-on-write.
+
+What does not survive a fork is reset by ``after_fork`` in every worker:
+the connections of the pools, which would otherwise be shared with the
+master and the other workers, and the thread writing the logs.
+"""
+import importlib
+
+from .auth import auth
+from .database.models import db
+from .index import map_screening_files
+from .log import restart_logging
+
+
+def _engines(app):
+    router = app.extensions.get('replicas')
+
+    return list(db.engines.values()) + [
+        replica.engine for replica in (router.replicas if router else [])]
+
+
+def warm_up(app):
+    """Build the shared state of the workers. Runs in the master."""
+    importlib.import_module('jose.jwt')
+
+    if auth.AUTH0_DOMAIN:
+        try:
+            auth.load_jwks()
+        except Exception:
+            # workers fetch the keys on their first request instead
+            app.logger.exception('JWKS not loaded')
+
+    with app.app_context():
+        try:
+            map_screening_files()
+        except Exception:
+            app.logger.exception('screening files not mapped')
+
+        # the connections opened so far must not be inherited
+        for engine in _engines(app):
+            engine.dispose()
+
+
+def after_fork(app):
+    """Reset what a worker must not share with the master. Runs in the
+    worker, right after the fork."""
+    with app.app_context():
+        for engine in _engines(app):
+            # the sockets belong to the master: dropped, not closed
+            engine.dispose(close=False)
+
+    restart_logging()
@@ -0,0 +1,224 @@
+"""Read model of companies and partners.
+
+``company_documents`` and ``partner_documents`` hold the JSON of
+``Company.format()`` and ``Partner.format()``, so /companies and /partners
+send stored text instead of joining partners, companies and sanctions on
+every read.
+
+A company document embeds its partners and sanctions and a partner document
+the companies it owns with their sanctions, up to NESTED_LIMIT partners or
+companies (see ``src.nested``), hence:
+
+* a change of a company or of its sanctions refreshes its document and the
+  documents of its partners;
+* a change of a partner refreshes its document and the documents of its
+  companies;
+* a new or removed ownership refreshes the documents of both sides.
+
+The session collects what its flushes change and refreshes the documents
+right before it commits, in the same transaction. Writes made with Core
+statements, such as the bulk imports and deletes, are not seen by the
+session and call ``mark_companies`` and ``mark_partners`` themselves.
+Documents of existing rows are built by the ``rebuild_documents`` job.
+"""
+import json
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from .database.models import (
+    db,
+    Company,
+    CompanyDocument,
+    Partner,
+    PartnerDocument,
+    Sanction,
+    ownerships
+)
+from .nested import ownership_pages
+
+BATCH_SIZE = 1000
+
+_INFO_KEY = 'read_model'
+
+
+def dumps(document):
+    # keys in the order of format(), which the columnar encoding follows
+    return json.dumps(document, separators=(',', ':'))
+
+
+def _pending(session):
+    return session.info.setdefault(_INFO_KEY, {
+        'companies': set(),
+        'partners': set(),
+        'objects': []
+    })
+
+
+def _mark(session, company_ids=(), partner_ids=()):
+    pending = _pending(session)
+    company_ids = set(company_ids) - {None}
+    partner_ids = set(partner_ids) - {None}
+
+    # the ownerships are read now, before a delete removes them
+    with session.no_autoflush:
+        if company_ids:
+            pending['companies'] |= company_ids
+            pending['partners'].update(session.scalars(
+                db.select(ownerships.c.partner_id)
+                .where(ownerships.c.company_id.in_(company_ids))))
+        if partner_ids:
+            pending['partners'] |= partner_ids
+            pending['companies'].update(session.scalars(
+                db.select(ownerships.c.company_id)
+                .where(ownerships.c.partner_id.in_(partner_ids))))
+
+
+def mark_companies(company_ids):
+    """Refresh the documents around ``company_ids`` on the next commit.
+
+    Must be called before the companies, or their ownerships, are deleted.
+    """
+    _mark(db.session(), company_ids=company_ids)
+
+
+def mark_partners(partner_ids):
+    """Refresh the documents around ``partner_ids`` on the next commit."""
+    _mark(db.session(), partner_ids=partner_ids)
+
+
+def _removed(instance, key):
+    attribute = inspect(instance).attrs[key]
+    return attribute.history.deleted or ()
+
+
+def _collect(session, flush_context, instances):
+    deleted_companies = set()
+    deleted_partners = set()
+    for instance in session.deleted:
+        if isinstance(instance, Company):
+            deleted_companies.add(instance.id)
+        elif isinstance(instance, Partner):
+            deleted_partners.add(instance.id)
+        elif isinstance(instance, Sanction):
+            deleted_companies.add(instance.company_id)
+    if deleted_companies or deleted_partners:
+        _mark(session, deleted_companies, deleted_partners)
+
+    # new rows have no id before the flush: they are resolved on commit
+    changed = []
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Company):
+            changed.append(instance)
+            changed.extend(_removed(instance, 'partners'))
+        elif isinstance(instance, Partner):
+            changed.append(instance)
+            changed.extend(_removed(instance, 'companies'))
+        elif isinstance(instance, Sanction):
+            changed.append(instance)
+    if changed:
+        _pending(session)['objects'].extend(changed)
+
+
+def _refresh_pending(session):
+    session.flush()
+    pending = session.info.pop(_INFO_KEY, None)
+    if pending is None:
+        return
+
+    company_ids = set(pending['companies'])
+    partner_ids = set(pending['partners'])
+    for instance in pending['objects']:
+        if isinstance(instance, Company):
+            company_ids.add(instance.id)
+        elif isinstance(instance, Partner):
+            partner_ids.add(instance.id)
+        else:
+            company_ids.add(instance.company_id)
+
+    _mark(session, company_ids, partner_ids)
+    pending = session.info.pop(_INFO_KEY)
+    refresh_documents(pending['companies'], pending['partners'], session)
+
+
+def _discard_pending(session):
+    session.info.pop(_INFO_KEY, None)
+
+
+def _upsert(session, table, key, rows):
+    dialect = session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[key],
+        set_={'document': statement.excluded.document})
+    session.execute(statement, rows)
+
+
+def _refresh(session, model, document_model, key, options, nested, ids):
+    ids = sorted(ids)
+    table = document_model.__table__
+
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        # populate_existing replaces what was loaded before the change
+        rows = session.scalars(
+            db.select(model)
+            .options(*options)
+            .where(model.id.in_(batch))
+            .execution_options(populate_existing=True)
+        ).all()
+
+        if rows:
+            # the first pages of the whole batch, not the full collections
+            pages = ownership_pages(nested, [row.id for row in rows],
+                                    session=session)
+            _upsert(session, table, key, [
+                {key: row.id,
+                 'document': dumps(row.format(page=pages[row.id]))}
+                for row in rows
+            ])
+        # rows deleted since: their documents are usually gone already
+        missing = set(batch) - {row.id for row in rows}
+        if missing:
+            session.execute(db.delete(table)
+                            .where(table.c[key].in_(missing)))
+
+
+def refresh_documents(company_ids=(), partner_ids=(), session=None):
+    """Rewrite the documents of ``company_ids`` and ``partner_ids``.
+
+    Only these documents are rewritten; use ``mark_companies`` and
+    ``mark_partners`` to refresh the documents embedding them too.
+    """
+    session = session or db.session()
+
+    with session.no_autoflush:
+        _refresh(session, Company, CompanyDocument, 'company_id',
+                 (selectinload(Company.sanctions),), Partner, company_ids)
+        _refresh(session, Partner, PartnerDocument, 'partner_id',
+                 (), Company, partner_ids)
+
+
+def company_documents():
+    """JSON texts of every company, ordered by id."""
+    return db.session.scalars(
+        db.select(CompanyDocument.document)
+        .order_by(CompanyDocument.company_id)).all()
+
+
+def partner_documents():
+    """JSON texts of every partner, ordered by id."""
+    return db.session.scalars(
+        db.select(PartnerDocument.document)
+        .order_by(PartnerDocument.partner_id)).all()
+
+
+def setup_read_model(app):
+    # the listeners belong to the session class, shared by every app
+    if not event.contains(db.session, 'before_flush', _collect):
+        event.listen(db.session, 'before_flush', _collect)
+        event.listen(db.session, 'before_commit', _refresh_pending)
+        event.listen(db.session, 'after_rollback', _discard_pending)
@@ -0,0 +1,258 @@
+"""Entity resolution of partners.
+
+A company shows up in QSA files under the CNPJ of any of its branches,
+and public files publish the CPF of people masked, as ``***.456.789-**``,
+under slightly different names across files.
+
+``resolve_partners`` streams the legal entities in the order of their CNPJ,
+groups those sharing its root (its first eight digits, the same for every
+branch) in blocks, finds the duplicates of the blocks in
+RESOLUTION_PROCESSES processes and replaces ``partner_merges``, which maps
+every duplicate to its canonical partner, the oldest one. Stored people all
+have a full CPF, which identifies them: two different CPFs are two people,
+whatever their names, so they are never merged.
+
+``import_partners`` resolves the rows with a masked CPF, never stored, to
+the stored person sharing the middle digits of their CPF and the phonetic
+key of their first and last names, when their normalized names are at
+least RESOLUTION_THRESHOLD similar. Only the people of that blocking key are
+compared, so the work grows with the number of rows rather than with the
+number of partners.
+"""
+import itertools
+import multiprocessing
+import os
+import re
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from flask import current_app
+
+from .database.models import (
+    db,
+    unit_of_work,
+    Job,
+    Partner,
+    PartnerMerge
+)
+from .documents import LEGAL_ENTITY, NATURAL_PERSON, cnpj_root, cpf_middle
+
+BATCH_SIZE = 10000
+
+# particles left out of names: "Silva" and "da Silva" are the same name
+_PARTICLES = {'D', 'DA', 'DAS', 'DE', 'DI', 'DO', 'DOS', 'E'}
+
+# spellings of the same sound in Portuguese names, applied in order
+_PHONETIC_RULES = tuple((re.compile(pattern), sound) for pattern, sound in (
+    (r'PH', 'F'),
+    (r'LH', 'L'),
+    (r'NH', 'N'),
+    (r'CH|SH', 'X'),
+    (r'C(?=[EI])', 'S'),
+    (r'G(?=[EI])', 'J'),
+    (r'QU|Q|C|K', 'K'),
+    (r'Z', 'S'),
+    (r'W', 'V'),
+    (r'Y', 'I'),
+    (r'H', ''),
+    (r'N(?=[^AEIOU]|$)', 'M'),
+))
+_VOWELS = re.compile(r'[AEIOU]')
+_REPEATS = re.compile(r'(.)\1+')
+_WORDS = re.compile(r'[A-Z0-9]+')
+_ABBREVIATIONS = re.compile(r"[.']")
+
+
+def normalize_name(name):
+    """Words of a name in upper case ASCII, without particles."""
+    text = unicodedata.normalize('NFKD', name) \
+        .encode('ascii', 'ignore').decode().upper()
+    # abbreviations keep their letters together: S.A. is SA
+    words = _WORDS.findall(_ABBREVIATIONS.sub('', text))
+
+    return [word for word in words if word not in _PARTICLES]
+
+
+# names repeat a lot: the keys of the common words are computed once
+@lru_cache(maxsize=100_000)
+def phonetic(word):
+    """Key of a word that spellings of the same sound share."""
+    for pattern, sound in _PHONETIC_RULES:
+        word = pattern.sub(sound, word)
+    # vowels after the first letter are the usual misspellings
+    word = word[:1] + _VOWELS.sub('', word[1:])
+
+    return _REPEATS.sub(r'\1', word)
+
+
+def name_key(words):
+    """Phonetic key of the first and last words of a normalized name."""
+    if not words:
+        return ''
+
+    return f'{phonetic(words[0])} {phonetic(words[-1])}'
+
+
+def similarity(a, b):
+    """Similarity, between 0 and 1, of two normalized names."""
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def resolve_blocks(blocks):
+    """Find the duplicates in blocks of partners. Runs in the pool.
+
+    Args:
+        blocks (list): lists of the ids of the legal entities sharing the
+            root of their CNPJ.
+
+    Returns:
+        list: (partner_id, canonical_id, score) of the duplicates, each
+        merged into the oldest partner of its block.
+    """
+    merges = []
+    for block in blocks:
+        canonical_id = min(block)
+        merges.extend((id, canonical_id, 1.0)
+                      for id in block if id != canonical_id)
+
+    return merges
+
+
+def _blocks():
+    """Yield the lists of two legal entities or more sharing the root of
+    their CNPJ."""
+    rows = db.session.execute(
+        db.select(Partner.id, Partner.document)
+        .where(Partner.person_type == LEGAL_ENTITY)
+        .order_by(Partner.document)
+        .execution_options(yield_per=BATCH_SIZE))
+    for _, block in itertools.groupby(rows, lambda row: cnpj_root(row[1])):
+        block = [id for id, _ in block]
+        if len(block) > 1:
+            yield block
+
+
+def _chunks(blocks):
+    """Group blocks in lists of about BATCH_SIZE partners."""
+    chunk = []
+    size = 0
+    for block in blocks:
+        chunk.append(block)
+        size += len(block)
+        if size >= BATCH_SIZE:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def _resolve(chunks, processes):
+    """Yield the merges of every chunk, compared in ``processes``."""
+    if processes == 1:
+        for chunk in chunks:
+            yield from resolve_blocks(chunk)
+        return
+
+    # spawned processes do not inherit the connections of this one
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=context) as pool:
+        pending = set()
+        for chunk in chunks:
+            pending.add(pool.submit(resolve_blocks, chunk))
+            # a few chunks ahead keep the processes busy, not the memory
+            if len(pending) >= 2 * processes:
+                finished, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
+
+
+def _threshold():
+    return float(current_app.config.get('RESOLUTION_THRESHOLD', 0.85))
+
+
+def resolve_partners(report=None):
+    """Find the duplicated partners and replace the merge table.
+
+    Args:
+        report (callable): receives the progress and total of the write.
+
+    Returns:
+        dict: the number of partners merged and of canonical partners
+        they were merged into.
+    """
+    processes = int(current_app.config.get('RESOLUTION_PROCESSES')
+                    or os.cpu_count() or 1)
+    merges = sorted(_resolve(_chunks(_blocks()), processes))
+
+    resolved_at = datetime.utcnow()
+    rows = [{'partner_id': partner_id,
+             'canonical_id': canonical_id,
+             'score': round(score, 4),
+             'resolved_at': resolved_at}
+            for partner_id, canonical_id, score in merges]
+
+    with unit_of_work():
+        merged_before = db.session.scalar(
+            db.select(db.func.count()).select_from(PartnerMerge))
+        db.session.execute(db.delete(PartnerMerge))
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = rows[start:start + BATCH_SIZE]
+            db.session.execute(db.insert(PartnerMerge), batch)
+            if report:
+                report(start + len(batch), len(rows))
+
+    if rows or merged_before:
+        # duplicates join the economic groups of their canonical partners
+        Job.enqueue('rebuild_groups', unique=True)
+
+    return {
+        'merged': len(rows),
+        'canonical': len({row['canonical_id'] for row in rows})
+    }
+
+
+def resolve_masked_cpfs(people):
+    """Find the stored partners of people known by a masked CPF.
+
+    Args:
+        people (set): (middle digits of the CPF, name) tuples.
+
+    Returns:
+        dict: the id of the most similar partner sharing the blocking key
+        of each person, by (middle digits, name). People without one
+        similar enough are left out.
+    """
+    if not people:
+        return {}
+
+    candidates = {}
+    for id, document, name in db.session.execute(
+            db.select(Partner.id, Partner.document, Partner.name)
+            .where(Partner.person_type == NATURAL_PERSON,
+                   Partner.cpf_middle().in_({middle for middle, _ in people}))
+            .order_by(Partner.id)):
+        words = normalize_name(name)
+        candidates.setdefault((cpf_middle(document), name_key(words)), []) \
+            .append((id, ' '.join(words)))
+
+    threshold = _threshold()
+    resolved = {}
+    for middle, name in people:
+        words = normalize_name(name)
+        joined = ' '.join(words)
+        score, id = max(
+            ((similarity(joined, other), id) for id, other
+             in candidates.get((middle, name_key(words)), ())),
+            key=lambda candidate: (candidate[0], -candidate[1]),
+            default=(0, None))
+        if score >= threshold:
+            resolved[middle, name] = id
+
+    return resolved
@@ -1,18 +1,124 @@
-import sys
-
 from flask import (
     Blueprint,
     abort,
+    current_app,
     jsonify,
     request
 )
 
-from .database.models import Company, Sanction
+from .database.models import unit_of_work, Company, Sanction
+from .database.timeouts import LIST_BUDGET, TIMEOUTS
 from .auth.auth import requires_auth
+from .auth.ratelimit import LIST_COST, admission_control
+from .encoding import respond
+from .history import company_as_of, sanctions_as_of
+from .utils import get_as_of_arg, get_date_arg, parse_date
+from . import signals
 
 sanctions_blueprint = Blueprint('sanctions_blueprint', __name__)
 
 
+@sanctions_blueprint.route('/sanctions', methods=['GET'])
+@requires_auth('get:companies', cost=LIST_COST,
+               budget=LIST_BUDGET)
+@admission_control
+def sanctions(jwt):
+    """Retrieves the sanctions from the database.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        active_at (str): optional date (YYYY-MM-DD) in the query string.
+            When given, only sanctions in force on that date are listed.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to list the sanctions recorded at that moment.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - sanctions (list): A list of sanctions in the following format:
+                - id (int)
+                - organization (str)
+                - start_date (str)
+                - end_date (str)
+    """
+    active_at = get_date_arg('active_at')
+    as_of = get_as_of_arg()
+
+    try:
+        if as_of:
+            sanctions = sanctions_as_of(as_of, active_at=active_at)
+        else:
+            query = Sanction.query
+            if active_at:
+                query = query.filter(Sanction.active_at(active_at))
+            sanctions = query.order_by(Sanction.id)
+
+        sanctions_lst = [sanction.format() for sanction in sanctions]
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return respond({
+        'success': True,
+        'sanctions': sanctions_lst
+    }, table='sanctions')
+
+
+@sanctions_blueprint.route('/companies/<int:id>/sanctions', methods=['GET'])
+@requires_auth('get:companies')
+def company_sanctions(jwt, id):
+    """Retrieves the sanctions a company received.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the company.
+        active_at (str): optional date (YYYY-MM-DD) in the query string.
+            When given, only sanctions in force on that date are listed.
+        as_of (str): optional date or date and time (ISO format) in the
+            query string, to list the sanctions recorded at that moment.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - sanctions (list): A list of sanctions in the following format:
+                - id (int)
+                - organization (str)
+                - start_date (str)
+                - end_date (str)
+    """
+    as_of = get_as_of_arg()
+    if as_of:
+        if company_as_of(id, as_of) is None:
+            abort(404)
+    else:
+        Company.query.get_or_404(id)
+    active_at = get_date_arg('active_at')
+
+    try:
+        if as_of:
+            sanctions = sanctions_as_of(as_of, company_id=id,
+                                        active_at=active_at)
+        else:
+            query = Sanction.query.filter(Sanction.company_id == id)
+            if active_at:
+                query = query.filter(Sanction.active_at(active_at))
+            sanctions = query.order_by(Sanction.id)
+
+        sanctions_lst = [sanction.format() for sanction in sanctions]
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return respond({
+        'success': True,
+        'sanctions': sanctions_lst
+    }, table='sanctions')
+
+
 @sanctions_blueprint.route('/companies/<int:id>/sanctions', methods=['POST'])
 @requires_auth('post:sanctions')
 def new_sanction(jwt, id):
@@ -22,6 +128,10 @@ def new_sanction(jwt, id):
         jwt (str): the JSON Web Token used by the user.
         name (str): name of the sanction.
         organization (str): name of the organization that applied the sanction.
+        start_date (str): optional first day (YYYY-MM-DD) the sanction is
+            in force.
+        end_date (str): optional last day (YYYY-MM-DD) the sanction is in
+            force.
 
     Returns:
         JSON: A JSON with the following keys:
@@ -30,20 +140,34 @@ def new_sanction(jwt, id):
     """
     Company.query.get_or_404(id)
     try:
-        data = request.get_json()
-
-        name = data.get('name')
-        organization = data.get('organization')
-
-        sanction = Sanction(name=name,
-                            organization=organization,
-                            company_id=id)
-
-        sanction.insert()
+        with unit_of_work():
+            data = request.get_json()
+
+            name = data.get('name')
+            organization = data.get('organization')
+            start_date = parse_date(data.get('start_date'))
+            end_date = parse_date(data.get('end_date'))
+
+            if start_date and end_date and start_date > end_date:
+                raise ValueError('start_date must not be after end_date')
+
+            sanction = Sanction(name=name,
+                                organization=organization,
+                                company_id=id,
+                                start_date=start_date,
+                                end_date=end_date)
+
+            sanction.insert()
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.sanctions_changed.send(current_app._get_current_object(),
+                                   company_ids={id},
+                                   action='created')
+
     return jsonify({
         'success': True,
         'created': sanction.id
@@ -65,14 +189,22 @@ def delete_sanction(jwt, id):
             - created (int): Id of the deleted sanction.
     """
     sanction = Sanction.query.get_or_404(id)
+    company_id = sanction.company_id
 
     try:
-        sanction.delete()
+        with unit_of_work():
+            sanction.delete()
 
+    except TIMEOUTS:
+        raise
     except Exception:
-        print(sys.exc_info())
+        current_app.logger.exception('unprocessable request')
         abort(422)
 
+    signals.sanctions_changed.send(current_app._get_current_object(),
+                                   company_ids={company_id},
+                                   action='deleted')
+
     return jsonify({
         'success': True,
         'deleted': id
@@ -0,0 +1,144 @@
+from datetime import date
+
+import click
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    request
+)
+
+from .database.models import Company
+from .database.timeouts import EXPORT_BUDGET, TIMEOUTS
+from .auth.auth import requires_auth
+from .auth.ratelimit import LIST_COST
+from .encoding import respond
+from .documents import format_cnpj, parse_cnpj
+from .index import (
+    build_screening_index,
+    get_screening_filter,
+    rebuild_screening_filter
+)
+from .index.sorted_index import TAINTED
+from .utils import get_date_arg
+
+screening_blueprint = Blueprint('screening_blueprint', __name__,
+                                cli_group='screening')
+
+
+@screening_blueprint.route('/screening/<fiscal_number>', methods=['GET'])
+@requires_auth('get:companies')
+def screen_company(jwt, fiscal_number):
+    """Check whether the company with a fiscal number may be contracted.
+
+    Most companies are clean. They are answered from the screening filter
+    without querying the database. Fiscal numbers the filter reports as
+    possibly tainted are looked up in the screening index, which clears
+    false positives while it is up to date; only the companies that remain
+    tainted go through the full eligibility check.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        fiscal_number (str): Fiscal number (CNPJ) of the company.
+        active_at (str): optional date (YYYY-MM-DD) in the query string,
+            usually the contract date. Defaults to today.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - screening (dict): result of the screening:
+                - fiscal_number (str)
+                - active_at (str)
+                - eligible (bool)
+                - source (str): 'filter', 'index' or 'database'
+                - eligibility (dict): eligibility of the company, as
+                  returned by /companies/<id>/eligibility, when it was
+                  checked against the database
+    """
+    try:
+        fiscal_number = parse_cnpj(fiscal_number)
+    except ValueError:
+        abort(400)
+    active_at = get_date_arg('active_at', date.today())
+
+    screening = {
+        'fiscal_number': format_cnpj(fiscal_number),
+        'active_at': active_at.isoformat(),
+        'eligible': True,
+        'source': 'filter'
+    }
+
+    try:
+        screening_filter = get_screening_filter()
+        entry = (None, 0)
+        if screening_filter.might_contain(fiscal_number):
+            screening['source'] = 'index'
+            entry = current_app.extensions['screening_index'].lookup(
+                fiscal_number, screening_filter.generation)
+
+        # a missing or outdated index leaves the answer to the database
+        if entry is None or entry[1] & TAINTED:
+            screening['source'] = 'database'
+
+            company = Company.query \
+                .filter(Company.fiscal_number == fiscal_number) \
+                .one_or_none()
+            if company:
+                eligibility = company.eligibility(active_at)
+                screening['eligible'] = eligibility['eligible']
+                screening['eligibility'] = eligibility
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return respond({
+        'success': True,
+        'screening': screening
+    })
+
+
+@screening_blueprint.route('/screening/filter', methods=['GET'])
+@requires_auth('get:companies', cost=LIST_COST, budget=EXPORT_BUDGET)
+def screening_filter(jwt):
+    """Download the screening filter to pre-screen companies offline.
+
+    The filter is a Bloom filter of the fiscal numbers of sanctioned
+    companies and of companies whose partners own a sanctioned company. Its
+    format is described in ``src/index/bloom.py``. The ETag is the filter
+    generation, so clients holding the latest filter get a 304.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+
+    Returns:
+        bytes: the serialized filter (application/octet-stream).
+    """
+    try:
+        generation, data = get_screening_filter().dump()
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    response = current_app.response_class(
+        data, mimetype='application/octet-stream')
+    response.set_etag(str(generation))
+
+    return response.make_conditional(request)
+
+
+@screening_blueprint.cli.command('rebuild-filter')
+def rebuild_filter_command():
+    """Rebuild the screening filter from the database."""
+    generation = rebuild_screening_filter()
+    click.echo(f'Screening filter rebuilt (generation {generation}).')
+
+
+@screening_blueprint.cli.command('build-index')
+def build_index_command():
+    """Build the screening index from the database."""
+    count = build_screening_index()
+    click.echo(f'Screening index built with {count} companies.')
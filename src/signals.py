@@ -0,0 +1,21 @@
+from blinker import Namespace
+
+# Signals sent by the blueprints once a write has been committed. They are
+# sent with the application as sender and let derived data (caches, filters,
+# indexes) follow changes of the source tables. Every signal also carries
+# action (str): 'created', 'updated' or 'deleted'. Updates of companies and
+# partners carry columns (set) too: the names of the columns written.
+_signals = Namespace()
+
+# company_ids (set): companies created, updated or deleted
+companies_changed = _signals.signal('companies-changed')
+
+# partner_ids (set): partners created, updated or deleted
+partners_changed = _signals.signal('partners-changed')
+
+# edges (set): (company_id, partner_id) ownerships added, removed or whose
+# share was updated
+ownerships_changed = _signals.signal('ownerships-changed')
+
+# company_ids (set): companies whose sanctions were added or removed
+sanctions_changed = _signals.signal('sanctions-changed')
@@ -0,0 +1,121 @@
+"""Aggregate statistics of companies, partners, ownerships and sanctions.
+
+Dashboards read counts that would otherwise take a scan of every table:
+
+* ``stat_counters`` and ``company_stats`` are maintained by triggers (see
+  ``counters_ddl``) in the transaction of every write, the bulk imports
+  included, so their counts are exact as soon as the write commits;
+* ``top_companies``, the companies with the most partners, is ranked by
+  the ``refresh_stats`` job, queued whenever ownerships are created or
+  deleted, with a scan of the first STATS_TOP_K entries of an index.
+
+Reading the statistics then takes a few rows whatever the size of the
+tables. The ``rebuild_stats`` job counts everything again, should the
+counters ever drift (e.g. after writes with the triggers disabled).
+"""
+from datetime import datetime
+
+from flask import current_app
+
+from .database.models import (
+    db,
+    unit_of_work,
+    CompanyStats,
+    Job,
+    StatCounter,
+    TopCompany
+)
+from . import signals
+
+COUNTS = ('companies', 'partners', 'ownerships', 'sanctions',
+          'sanctioned_companies')
+
+
+def _top_k():
+    return int(current_app.config.get('STATS_TOP_K', 10))
+
+
+def refresh_top_companies():
+    """Rank the STATS_TOP_K companies with the most partners.
+
+    Returns:
+        dict: the number of companies ranked.
+    """
+    rows = db.session.execute(
+        db.select(CompanyStats.company_id, CompanyStats.partners)
+        .where(CompanyStats.partners > 0)
+        .order_by(CompanyStats.partners.desc(), CompanyStats.company_id)
+        .limit(_top_k())).all()
+
+    refreshed_at = datetime.utcnow()
+    with unit_of_work():
+        db.session.execute(db.delete(TopCompany))
+        if rows:
+            db.session.execute(db.insert(TopCompany), [
+                {'rank': rank, 'company_id': company_id,
+                 'partners': partners, 'refreshed_at': refreshed_at}
+                for rank, (company_id, partners) in enumerate(rows, 1)])
+
+    return {'ranked': len(rows)}
+
+
+def rebuild_statistics():
+    """Count every row again and rank the top companies.
+
+    Writes wait for the count, which locks the counted tables.
+
+    Returns:
+        dict: the statistics rebuilt.
+    """
+    with unit_of_work():
+        db.session.execute(db.select(db.func.rebuild_stat_counters()))
+    refresh_top_companies()
+
+    return read_statistics()
+
+
+def read_statistics():
+    """The counts, the sanctions of each organization and the companies
+    with the most partners.
+
+    Returns:
+        dict: the statistics.
+    """
+    counts = dict.fromkeys(COUNTS, 0)
+    organizations = {}
+    for name, key, value in db.session.execute(
+            db.select(StatCounter.name, StatCounter.key,
+                      db.func.sum(StatCounter.value))
+            .group_by(StatCounter.name, StatCounter.key)):
+        if name == 'sanctions_by_organization':
+            if value:
+                organizations[key] = int(value)
+        else:
+            counts[name] = int(value)
+
+    top = TopCompany.query.order_by(TopCompany.rank).all()
+
+    return dict(
+        counts,
+        partners_per_company=round(counts['ownerships']
+                                   / counts['companies'], 2)
+        if counts['companies'] else 0.0,
+        sanctions_by_organization=dict(sorted(
+            organizations.items(), key=lambda item: (-item[1], item[0]))),
+        top_companies=[{
+            'company': company.company.format(partners_info=False,
+                                              sanctions_info=False),
+            'partners': company.partners
+        } for company in top],
+        top_companies_refreshed_at=top[0].refreshed_at.isoformat()
+        if top else None
+    )
+
+
+def setup_statistics(app):
+    signals.ownerships_changed.connect(_on_ownerships_changed, app)
+
+
+def _on_ownerships_changed(sender, edges, action):
+    if action != 'updated':
+        Job.enqueue('refresh_stats', unique=True)
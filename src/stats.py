@@ -0,0 +1,43 @@
+from flask import Blueprint
+
+from .auth.auth import requires_auth
+from .encoding import respond
+from .statistics import read_statistics
+
+stats_blueprint = Blueprint('stats_blueprint', __name__)
+
+
+@stats_blueprint.route('/stats', methods=['GET'])
+@requires_auth('get:stats')
+def stats(jwt):
+    """Retrieves aggregate statistics of the database.
+
+    Counts are kept by the database in the transaction of every write, so
+    this reads a few rows whatever the number of companies.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - stats (dict):
+                - companies (int)
+                - partners (int)
+                - ownerships (int): associations of partners and companies
+                - sanctions (int)
+                - sanctioned_companies (int): companies with a sanction,
+                  whatever its period
+                - partners_per_company (float): average
+                - sanctions_by_organization (dict): number of sanctions by
+                  organization, the largest first
+                - top_companies (list): the companies with the most
+                  partners, as ranked by the last ``refresh_stats`` job:
+                    - company (dict)
+                    - partners (int)
+                - top_companies_refreshed_at (str)
+    """
+    return respond({
+        'success': True,
+        'stats': read_statistics()
+    })
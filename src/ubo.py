@@ -0,0 +1,198 @@
+"""Ultimate beneficial owners: who holds each company in the end.
+
+A partner that is a company (a legal entity whose document is the fiscal
+number of a company) holds its share on behalf of its own partners. With
+``A[c, h]`` the fraction of company ``c`` held by holding company ``h``
+and ``B[c, p]`` the fraction held by partner ``p`` directly, the fractions
+held in the end, through chains of holdings of any length, are
+
+    E = B + A E
+
+which is solved over the whole network at once by iterating on sparse
+matrices until no fraction moves by more than ``UBO_TOLERANCE``. Only
+ownerships with a known share count. A holding company whose own shares
+are unknown is an owner in the end itself. Shares of a company adding up
+to more than 100% are scaled down to 100%, which keeps cycles of holdings
+(companies owning each other) from growing the fractions without bound:
+the part of a company held by a cycle is shared among the owners feeding
+the cycle, in the limit.
+
+The result is stored in ``beneficial_owners`` by the
+``compute_beneficial_owners`` job, queued whenever ownerships, companies or
+partners change, so reading the owners of a company is a lookup.
+"""
+from datetime import datetime
+
+from flask import current_app
+
+from .database.models import (
+    db,
+    unit_of_work,
+    BeneficialOwner,
+    Company,
+    Job,
+    Partner,
+    ownerships
+)
+from . import signals
+
+BATCH_SIZE = 10000
+
+
+def _network():
+    """Rows (company_id, partner_id, share, holding company id or None)."""
+    return db.session.execute(
+        db.select(ownerships.c.company_id, ownerships.c.partner_id,
+                  ownerships.c.share, Company.id)
+        .join(Partner, Partner.id == ownerships.c.partner_id)
+        .outerjoin(Company, Partner.is_company(Company))
+        .where(ownerships.c.share.isnot(None))
+    ).all()
+
+
+def _matrix(entries, shape):
+    import numpy as np
+    from scipy import sparse
+
+    rows, columns, values = zip(*entries) if entries else ((), (), ())
+
+    return sparse.csr_matrix((np.array(values, dtype=float),
+                              (np.array(rows, dtype=int),
+                               np.array(columns, dtype=int))),
+                             shape=shape)
+
+
+def effective_ownership(edges, tolerance=1e-6, max_iterations=100):
+    """Solve ``E = B + A E`` over an ownership network.
+
+    Args:
+        edges (list): (company_id, partner_id, share, holding_id) tuples,
+            ``share`` a percentage and ``holding_id`` the company the
+            partner is, or None.
+        tolerance (float): largest change of a fraction at convergence.
+        max_iterations (int): iterations done at most.
+
+    Returns:
+        tuple: a dict of the fractions held in the end, by (company_id,
+        partner_id), the number of iterations and whether they converged.
+    """
+    # numpy and scipy take a fifth of the startup of a web worker, which
+    # never computes the owners: only the worker running the job loads them
+    import numpy as np
+    from scipy import sparse
+
+    owned = sorted({company_id for company_id, _, _, _ in edges})
+    companies = {company_id: index for index, company_id in enumerate(owned)}
+    owners = {}
+    looked_through = []
+    held = []
+    totals = np.zeros(len(owned))
+
+    for company_id, partner_id, share, holding_id in edges:
+        row = companies[company_id]
+        fraction = float(share) / 100
+        totals[row] += fraction
+        if holding_id in companies:
+            looked_through.append((row, companies[holding_id], fraction))
+        else:
+            held.append((row, owners.setdefault(partner_id, len(owners)),
+                         fraction))
+
+    if not held:
+        return {}, 0, True
+
+    scale = sparse.diags(1 / np.maximum(totals, 1))
+    A = scale @ _matrix(looked_through, (len(owned), len(owned)))
+    B = scale @ _matrix(held, (len(owned), len(owners)))
+
+    E = B.tocsr()
+    converged = False
+    for iteration in range(1, max_iterations + 1):
+        following = (B + A @ E).tocsr()
+        # fractions under the tolerance would only slow the products down
+        following.data[following.data < tolerance] = 0
+        following.eliminate_zeros()
+
+        change = abs(following - E).max()
+        E = following
+        if change < tolerance:
+            converged = True
+            break
+
+    partner_ids = list(owners)
+    E = E.tocoo()
+    fractions = {(owned[row], partner_ids[column]): float(value)
+                 for row, column, value in zip(E.row, E.col, E.data)}
+
+    return fractions, iteration, converged
+
+
+def compute_beneficial_owners(report=None):
+    """Recompute and store the beneficial owners of every company.
+
+    The previous owners are replaced in a single transaction, so readers
+    see either of the two complete results.
+
+    Args:
+        report (callable): receives the progress and total of the write.
+
+    Returns:
+        dict: the number of companies and owners stored, the iterations
+        done and whether they converged.
+    """
+    config = current_app.config
+    edges = _network()
+    fractions, iterations, converged = effective_ownership(
+        edges,
+        float(config.get('UBO_TOLERANCE', 1e-6)),
+        int(config.get('UBO_MAX_ITERATIONS', 100)))
+
+    direct = {(company_id, partner_id): float(share)
+              for company_id, partner_id, share, _ in edges}
+    computed_at = datetime.utcnow()
+    rows = [{'company_id': company_id,
+             'partner_id': partner_id,
+             'share': round(fraction * 100, 4),
+             'direct_share': direct.get((company_id, partner_id)),
+             'computed_at': computed_at}
+            for (company_id, partner_id), fraction
+            in sorted(fractions.items())]
+
+    with unit_of_work():
+        db.session.execute(db.delete(BeneficialOwner))
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = rows[start:start + BATCH_SIZE]
+            db.session.execute(db.insert(BeneficialOwner), batch)
+            if report:
+                report(start + len(batch), len(rows))
+
+    return {
+        'companies': len({company_id for company_id, _ in fractions}),
+        'owners': len(rows),
+        'iterations': iterations,
+        'converged': converged
+    }
+
+
+def beneficial_owners(company_id, min_share=0):
+    """The stored owners of a company holding at least ``min_share``%.
+
+    Returns:
+        list: BeneficialOwner rows, the largest shares first.
+    """
+    return BeneficialOwner.query \
+        .filter(BeneficialOwner.company_id == company_id,
+                BeneficialOwner.share >= min_share) \
+        .order_by(BeneficialOwner.share.desc(), BeneficialOwner.partner_id) \
+        .all()
+
+
+def setup_beneficial_owners(app):
+    signals.companies_changed.connect(_on_network_changed, app)
+    signals.partners_changed.connect(_on_network_changed, app)
+    signals.ownerships_changed.connect(_on_network_changed, app)
+
+
+def _on_network_changed(sender, action, **kwargs):
+    # every change may move shares along a chain, hence a full recompute
+    Job.enqueue('compute_beneficial_owners', unique=True)
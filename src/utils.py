@@ -0,0 +1,116 @@
+from datetime import date, datetime, time, timezone
+
+from flask import abort, request
+
+
+def get_date_arg(name, default=None):
+    """Read an ISO formatted date (YYYY-MM-DD) from the query string.
+
+    Args:
+        name (str): name of the query string parameter.
+        default (date): value returned when the parameter is missing.
+
+    Returns:
+        date: the parsed date. Aborts with 400 when it is malformed.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def get_as_of_arg():
+    """Read the moment of a historical read (``as_of``) from the query string.
+
+    It is an ISO formatted date or date and time. A date means the end of
+    that day; a time without an offset is taken as UTC.
+
+    Returns:
+        datetime: the moment, in UTC without tzinfo as the history tables
+        store it, or None when the parameter is missing. Aborts with 400
+        when it is malformed.
+    """
+    value = request.args.get('as_of')
+    if value is None:
+        return None
+
+    try:
+        if len(value) == 10:
+            return datetime.combine(date.fromisoformat(value), time.max)
+
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return moment
+
+
+def parse_date(value):
+    """Parse an optional ISO formatted date sent in a request body."""
+    if value is None:
+        return None
+
+    return date.fromisoformat(value)
+
+
+def parse_share(value):
+    """Parse an optional ownership share, a percentage above 0 up to 100.
+
+    Raises:
+        ValueError: when the value is not such a percentage.
+    """
+    if value is None or value == '':
+        return None
+
+    share = float(value)
+    if not 0 < share <= 100:
+        raise ValueError(f'invalid share: {value!r}')
+
+    return share
+
+
+def _get_number_arg(name, parse, default, min_value, max_value):
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        value = parse(value)
+    except ValueError:
+        abort(400)
+
+    # NaN fails every comparison, hence the bounds are checked this way
+    if min_value is not None and not value >= min_value:
+        abort(400)
+    if max_value is not None and not value <= max_value:
+        abort(400)
+
+    return value
+
+
+def get_int_arg(name, default=None, min_value=None, max_value=None):
+    """Read an integer from the query string.
+
+    Args:
+        name (str): name of the query string parameter.
+        default (int): value returned when the parameter is missing.
+        min_value (int): smallest accepted value.
+        max_value (int): largest accepted value.
+
+    Returns:
+        int: the parsed value. Aborts with 400 when it is malformed or out
+        of bounds.
+    """
+    return _get_number_arg(name, int, default, min_value, max_value)
+
+
+def get_float_arg(name, default=None, min_value=None, max_value=None):
+    """Read a number from the query string, see ``get_int_arg``."""
+    return _get_number_arg(name, float, default, min_value, max_value)
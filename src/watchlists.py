@@ -0,0 +1,212 @@
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context
+)
+
+from .database.models import unit_of_work, Watchlist
+from .database.timeouts import TIMEOUTS
+from .auth.auth import requires_auth
+from .auth.ratelimit import RateLimitError
+from .notifications import check_webhook_url, event_stream
+
+watchlists_blueprint = Blueprint('watchlists_blueprint', __name__)
+
+
+def _client(jwt):
+    return jwt.get('sub') or ''
+
+
+def _get_watchlist(jwt, id):
+    # watchlists of other clients are not found, rather than forbidden
+    watchlist = Watchlist.query.get_or_404(id)
+    if watchlist.client != _client(jwt):
+        abort(404)
+
+    return watchlist
+
+
+def _webhook_url(url):
+    if url is None:
+        return None
+
+    check_webhook_url(url)
+
+    return url
+
+
+@watchlists_blueprint.route('/watchlists', methods=['GET'])
+@requires_auth('get:watchlists')
+def watchlists(jwt):
+    """Retrieves the watchlists of the client.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - watchlists (list): the watchlists of the client, ordered by id.
+    """
+    watchlists = Watchlist.query \
+        .filter(Watchlist.client == _client(jwt)) \
+        .order_by(Watchlist.id) \
+        .all()
+
+    return jsonify({
+        'success': True,
+        'watchlists': [watchlist.format() for watchlist in watchlists]
+    }), 200
+
+
+@watchlists_blueprint.route('/watchlists/<int:id>', methods=['GET'])
+@requires_auth('get:watchlists')
+def watchlist(jwt, id):
+    """Retrieves a watchlist of the client.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the watchlist.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - watchlist (dict): the watchlist.
+    """
+    return jsonify({
+        'success': True,
+        'watchlist': _get_watchlist(jwt, id).format()
+    }), 200
+
+
+@watchlists_blueprint.route('/watchlists', methods=['POST'])
+@requires_auth('post:watchlists')
+def new_watchlist(jwt):
+    """Create a watchlist of fiscal numbers for the client.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        name (str): Name of the watchlist.
+        fiscal_numbers (list): Fiscal numbers (CNPJ) to monitor, with or
+            without punctuation. They need not belong to known companies.
+        webhook_url (str): optional http(s) URL of a public host the
+            notifications are posted to.
+        webhook_secret (str): optional key of the HMAC-SHA256 signature
+            sent in the X-Capstone-Signature header of the webhook requests.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - created (int): Id of the created watchlist.
+    """
+    try:
+        with unit_of_work():
+            data = request.get_json()
+
+            name = data.get('name')
+            fiscal_numbers = data.get('fiscal_numbers')
+            if not name or not isinstance(fiscal_numbers, list) \
+                    or not fiscal_numbers:
+                raise ValueError('missing name or fiscal_numbers')
+
+            watchlist = Watchlist(
+                client=_client(jwt),
+                name=name,
+                webhook_url=_webhook_url(data.get('webhook_url')),
+                webhook_secret=data.get('webhook_secret'))
+            watchlist.fiscal_numbers = fiscal_numbers
+
+            watchlist.insert()
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'created': watchlist.id
+    }), 201
+
+
+@watchlists_blueprint.route('/watchlists/<int:id>', methods=['DELETE'])
+@requires_auth('delete:watchlists')
+def delete_watchlist(jwt, id):
+    """Delete a watchlist of the client, with its notifications.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the watchlist to be deleted.
+
+    Returns:
+        JSON: A JSON with the following keys:
+            - success (bool): Indicates if the request was successful.
+            - deleted (int): Id of the deleted watchlist.
+    """
+    watchlist = _get_watchlist(jwt, id)
+
+    try:
+        with unit_of_work():
+            watchlist.delete()
+    except TIMEOUTS:
+        raise
+    except Exception:
+        current_app.logger.exception('unprocessable request')
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'deleted': id
+    }), 200
+
+
+@watchlists_blueprint.route('/watchlists/<int:id>/events', methods=['GET'])
+@requires_auth('get:watchlists')
+def watchlist_events(jwt, id):
+    """Stream the notifications of a watchlist as server-sent events.
+
+    Each event is named ``ineligible`` and its data is a notification. A
+    client reconnecting with the ``Last-Event-ID`` header gets the
+    notifications it missed. Once WATCHLIST_MAX_STREAMS streams are open in
+    the worker, new ones are refused with a 429.
+
+    Args:
+        jwt (str): the JSON Web Token used by the user.
+        id (int): Id of the watchlist.
+
+    Returns:
+        text/event-stream: the notifications, each one with the
+        following keys:
+            - id (int)
+            - watchlist_id (int)
+            - event (str): the write that made the company ineligible,
+              'sanction' or 'ownership'
+            - company_id (int)
+            - fiscal_number (str)
+            - eligibility (dict): as returned by
+              /companies/<id>/eligibility for the day of the notification
+            - created_at (str)
+    """
+    _get_watchlist(jwt, id)
+    last_id = request.headers.get('Last-Event-ID', 0, type=int)
+
+    notifier = current_app.extensions['notifications']
+    if not notifier.open_stream():
+        retry_after = float(
+            current_app.config.get('WATCHLIST_POLL_INTERVAL', 5))
+        raise RateLimitError(max(1, round(retry_after)),
+                             'Too many event streams, please retry later.')
+
+    response = current_app.response_class(
+        stream_with_context(event_stream(id, last_id)),
+        mimetype='text/event-stream')
+    # the slot is freed once the stream ends or the client leaves
+    response.call_on_close(notifier.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    # asks nginx style proxies not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
@@ -0,0 +1,118 @@
+"""Background job runner.
+
+``flask worker`` claims queued jobs and runs them in a pool of processes,
+each with its own application and database connections, so heavy work
+spreads across cores and never runs inside a request.
+
+The worker renews the heartbeat of its running jobs on every poll. Jobs
+whose heartbeat is older than JOBS_STALE_AFTER seconds, their worker having
+died or lost its host, are claimed and run again by another worker.
+"""
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from ..database.models import db, Job
+from .tasks import TASKS
+
+# application of the pool process, created by _init_process
+_app = None
+
+
+def _init_process(config):
+    global _app
+    from .. import create_app
+
+    _app = create_app(config)
+
+
+def run_job(job_id):
+    """Run a claimed job and record its outcome. Called in the pool."""
+    with _app.app_context():
+        job = db.session.get(Job, job_id)
+        try:
+            result = TASKS[job.kind](job, **job.params)
+        except Exception as error:
+            db.session.rollback()
+            job.status = Job.FAILED
+            job.error = f'{type(error).__name__}: {error}'
+        else:
+            job.status = Job.SUCCEEDED
+            job.result = result
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+        return job.status
+
+
+def _fail(job_id, error):
+    job = db.session.get(Job, job_id)
+    job.status = Job.FAILED
+    job.error = f'{type(error).__name__}: {error}'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def work(app, processes, burst=False, poll_interval=1.0, echo=print,
+         stale_after=None):
+    """Claim and run jobs until interrupted.
+
+    Args:
+        app (Flask): the application, whose config the pool processes use.
+        processes (int): number of jobs run at the same time.
+        burst (bool): return once the queue is empty instead of polling.
+        poll_interval (float): seconds between polls of an empty queue.
+        echo (callable): receives a line for every started and finished job.
+        stale_after (float): seconds without a heartbeat after which the
+            running jobs of other workers are claimed again.
+    """
+    name = f'{socket.gethostname()}:{os.getpid()}'
+    # spawned processes do not inherit the connections of this one
+    context = multiprocessing.get_context('spawn')
+    running = {}
+
+    with ProcessPoolExecutor(processes, mp_context=context,
+                             initializer=_init_process,
+                             initargs=(dict(app.config),)) as pool:
+        while True:
+            while len(running) < processes:
+                job = Job.claim(name, stale_after)
+                if job is None:
+                    break
+                running[pool.submit(run_job, job.id)] = job.id
+                echo(f'Job {job.id} ({job.kind}) started.')
+
+            if not running:
+                if burst:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(running, timeout=poll_interval,
+                           return_when=FIRST_COMPLETED)
+            alive = [job_id for future, job_id in running.items()
+                     if future not in done]
+            if alive:
+                Job.heartbeat(alive)
+            for future in done:
+                job_id = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    echo(f'Job {job_id} {future.result()}.')
+                    continue
+
+                # the pool process died, e.g. killed for using too much
+                # memory, before recording the outcome of the job
+                _fail(job_id, error)
+                echo(f'Job {job_id} failed: {error!r}')
+                if isinstance(error, BrokenProcessPool):
+                    # the other jobs of the pool died with it
+                    for job_id in running.values():
+                        _fail(job_id, error)
+                        echo(f'Job {job_id} failed: {error!r}')
+                    running.clear()
+                    raise error
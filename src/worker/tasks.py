@@ -0,0 +1,466 @@
+"""Jobs run by ``flask worker``.
+
+Each task receives the running job, to report its progress, plus the
+params the job was queued with, and returns the result stored in the job.
+Imports read CSV files (UTF-8, with a header line) from ``JOBS_DIR`` and
+write each batch as a unit of work, sending the same signals as the API
+once it is committed so caches and the screening filter follow the
+imported rows.
+"""
+import csv
+import itertools
+import json
+import os
+
+import cbor2
+import msgpack
+from flask import current_app
+from sqlalchemy.orm import selectinload
+
+from ..database.models import (
+    db,
+    unit_of_work,
+    Company,
+    Job,
+    Partner,
+    Sanction,
+    ownerships
+)
+from ..documents import parse_cnpj, parse_document, parse_masked_cpf
+from ..groups import rebuild_groups
+from ..index import build_screening_index, rebuild_screening_filter
+from ..index.mapped import atomic_write
+from ..notifications import deliver_notifications
+from ..read_model import mark_companies, mark_partners, refresh_documents
+from ..resolution import resolve_masked_cpfs, resolve_partners
+from ..statistics import rebuild_statistics, refresh_top_companies
+from ..ubo import compute_beneficial_owners
+from ..utils import parse_date, parse_share
+from .. import signals
+
+BATCH_SIZE = 1000
+# line numbers of the rejected rows kept in the result
+MAX_REJECTED_LINES = 100
+
+
+def jobs_dir():
+    return current_app.config.get('JOBS_DIR') or \
+        os.path.join(current_app.instance_path, 'jobs')
+
+
+def job_file(name):
+    """Path of a file in ``JOBS_DIR``.
+
+    Raises:
+        ValueError: when the name is not a plain file name.
+    """
+    if not isinstance(name, str) or not name or name.startswith('.') \
+            or os.path.basename(name) != name:
+        raise ValueError(f'invalid file name: {name!r}')
+
+    return os.path.join(jobs_dir(), name)
+
+
+class _Rows:
+    """Read a CSV file in batches, keeping count of the rejected rows."""
+
+    def __init__(self, job, name):
+        self.job = job
+        self.path = job_file(name)
+        self.done = 0
+        self.rejected = 0
+        self.rejected_lines = []
+
+        with open(self.path, newline='', encoding='utf-8-sig') as file:
+            total = max(sum(1 for _ in file) - 1, 0)
+        job.report(0, total)
+
+    def batches(self):
+        """Yield lists of (line number, row) tuples."""
+        with open(self.path, newline='', encoding='utf-8-sig') as file:
+            rows = enumerate(csv.DictReader(file), start=2)
+            while True:
+                batch = list(itertools.islice(rows, BATCH_SIZE))
+                if not batch:
+                    break
+                yield batch
+
+                self.done += len(batch)
+                self.job.report(self.done)
+
+    def reject(self, line):
+        self.rejected += 1
+        if len(self.rejected_lines) < MAX_REJECTED_LINES:
+            self.rejected_lines.append(line)
+
+    def result(self, **counts):
+        return dict(counts, rejected=self.rejected,
+                    rejected_lines=self.rejected_lines)
+
+
+def _company_ids(fiscal_numbers):
+    return dict(db.session.execute(
+        db.select(Company.fiscal_number, Company.id)
+        .where(Company.fiscal_number.in_(fiscal_numbers))
+    ).all())
+
+
+def _send(signal, **kwargs):
+    signal.send(current_app._get_current_object(), **kwargs)
+
+
+def import_companies(job, file):
+    """Create or rename companies from a CSV with fiscal_number and name."""
+    reader = _Rows(job, file)
+    created = updated = 0
+
+    for batch in reader.batches():
+        names = {}
+        for line, row in batch:
+            try:
+                name = row['name'].strip()
+                if not name:
+                    raise ValueError('missing name')
+                names[parse_cnpj(row['fiscal_number'])] = name
+            except (AttributeError, KeyError, ValueError):
+                reader.reject(line)
+
+        existing = _company_ids(names)
+        new = [{'fiscal_number': fiscal_number, 'name': name}
+               for fiscal_number, name in names.items()
+               if fiscal_number not in existing]
+        renamed = [{'id': existing[fiscal_number], 'name': name}
+                   for fiscal_number, name in names.items()
+                   if fiscal_number in existing]
+
+        with unit_of_work() as uow:
+            if new:
+                new_ids = set(db.session.execute(
+                    db.insert(Company).returning(Company.id), new).scalars())
+                mark_companies(new_ids)
+                uow.after_commit(_send, signals.companies_changed,
+                                 company_ids=new_ids, action='created')
+            if renamed:
+                db.session.execute(db.update(Company), renamed)
+                mark_companies({row['id'] for row in renamed})
+                uow.after_commit(_send, signals.companies_changed,
+                                 company_ids={row['id'] for row in renamed},
+                                 action='updated', columns={'name'})
+
+        created += len(new)
+        updated += len(renamed)
+
+    return reader.result(created=created, updated=updated)
+
+
+def _partner_document(value):
+    """Parse a CPF or CNPJ, or a masked CPF as (middle digits, None)."""
+    try:
+        return parse_document(value)
+    except ValueError:
+        return parse_masked_cpf(value), None
+
+
+def import_partners(job, file):
+    """Import the partners of companies (QSA) from a CSV.
+
+    The columns are fiscal_number (of the company), document (CPF or CNPJ of
+    the partner), name (of the partner) and the optional share (percentage
+    of the company held by the partner). Partners are created or renamed
+    and associated with the company, updating the share of existing
+    associations; rows of unknown companies are rejected.
+
+    A masked CPF (``***.456.789-**``) is resolved to the stored person
+    sharing its digits and a similar name, see ``src.resolution``; rows of
+    people not found are rejected. Once partners were created or renamed,
+    a ``resolve_partners`` job is queued.
+    """
+    reader = _Rows(job, file)
+    created = associated = reshared = matched = 0
+    changed = False
+
+    for batch in reader.batches():
+        parsed = []
+        for line, row in batch:
+            try:
+                name = row['name'].strip()
+                if not name:
+                    raise ValueError('missing name')
+                parsed.append((line, parse_cnpj(row['fiscal_number']),
+                               _partner_document(row['document']), name,
+                               parse_share(row.get('share'))))
+            except (AttributeError, KeyError, ValueError):
+                reader.reject(line)
+
+        companies = _company_ids({fiscal for _, fiscal, _, _, _ in parsed})
+        names = {}
+        masked = set()
+        for line, fiscal_number, document, name, _ in parsed:
+            if fiscal_number not in companies:
+                reader.reject(line)
+            elif document[1] is None:
+                masked.add((document[0], name))
+            else:
+                names[document] = name
+
+        partners = {
+            (document, person_type): id
+            for id, document, person_type in db.session.execute(
+                db.select(Partner.id, Partner.document, Partner.person_type)
+                .where(Partner.document.in_(
+                    {document for document, _ in names})))
+        }
+        new = [{'document': document, 'person_type': person_type,
+                'name': name}
+               for (document, person_type), name in names.items()
+               if (document, person_type) not in partners]
+        renamed = [{'id': partners[key], 'name': name}
+                   for key, name in names.items() if key in partners]
+
+        with unit_of_work() as uow:
+            if new:
+                rows = db.session.execute(
+                    db.insert(Partner).returning(
+                        Partner.id, Partner.document, Partner.person_type),
+                    new)
+                new_ids = set()
+                for id, document, person_type in rows:
+                    partners[document, person_type] = id
+                    new_ids.add(id)
+                mark_partners(new_ids)
+                uow.after_commit(_send, signals.partners_changed,
+                                 partner_ids=new_ids, action='created')
+            if renamed:
+                db.session.execute(db.update(Partner), renamed)
+                mark_partners({row['id'] for row in renamed})
+                uow.after_commit(_send, signals.partners_changed,
+                                 partner_ids={row['id'] for row in renamed},
+                                 action='updated', columns={'name'})
+
+            resolved = resolve_masked_cpfs(masked)
+            shares = {}
+            for line, fiscal_number, document, name, share in parsed:
+                if fiscal_number not in companies:
+                    continue
+                if document[1] is None:
+                    partner_id = resolved.get((document[0], name))
+                    if partner_id is None:
+                        reader.reject(line)
+                        continue
+                    matched += 1
+                else:
+                    partner_id = partners[document]
+                shares[companies[fiscal_number], partner_id] = share
+            existing = set()
+            if shares:
+                company_ids = {company_id for company_id, _ in shares}
+                partner_ids = {partner_id for _, partner_id in shares}
+                existing = set(db.session.execute(
+                    db.select(ownerships.c.company_id,
+                              ownerships.c.partner_id)
+                    .where(ownerships.c.company_id.in_(company_ids),
+                           ownerships.c.partner_id.in_(partner_ids))
+                ).all())
+            edges = set(shares) - existing
+            if edges:
+                db.session.execute(db.insert(ownerships), [
+                    {'company_id': company_id, 'partner_id': partner_id,
+                     'share': shares[company_id, partner_id]}
+                    for company_id, partner_id in edges
+                ])
+                mark_companies({company_id for company_id, _ in edges})
+                uow.after_commit(_send, signals.ownerships_changed,
+                                 edges=edges, action='created')
+            updated = {edge for edge in existing
+                       if shares[edge] is not None}
+            if updated:
+                db.session.execute(
+                    db.update(ownerships)
+                    .where(ownerships.c.company_id == db.bindparam('c_id'),
+                           ownerships.c.partner_id == db.bindparam('p_id'))
+                    .values(share=db.bindparam('new_share')),
+                    [{'c_id': company_id, 'p_id': partner_id,
+                      'new_share': shares[company_id, partner_id]}
+                     for company_id, partner_id in updated])
+                uow.after_commit(_send, signals.ownerships_changed,
+                                 edges=updated, action='updated')
+
+        created += len(new)
+        changed = changed or bool(new or renamed)
+        associated += len(edges)
+        reshared += len(updated)
+
+    if changed:
+        Job.enqueue('resolve_partners', unique=True)
+
+    return reader.result(created=created, associated=associated,
+                         reshared=reshared, resolved=matched)
+
+
+def import_sanctions(job, file):
+    """Import sanctions from a CSV.
+
+    The columns are fiscal_number, name, organization and the optional
+    start_date and end_date (YYYY-MM-DD). Rows of unknown companies are
+    rejected.
+    """
+    reader = _Rows(job, file)
+    created = 0
+
+    for batch in reader.batches():
+        parsed = []
+        for line, row in batch:
+            try:
+                name = row['name'].strip()
+                organization = row['organization'].strip()
+                start_date = parse_date(row.get('start_date') or None)
+                end_date = parse_date(row.get('end_date') or None)
+                if not name or not organization:
+                    raise ValueError('missing name or organization')
+                if start_date and end_date and start_date > end_date:
+                    raise ValueError('start_date must not be after end_date')
+                parsed.append((line, parse_cnpj(row['fiscal_number']), {
+                    'name': name,
+                    'organization': organization,
+                    'start_date': start_date,
+                    'end_date': end_date
+                }))
+            except (AttributeError, KeyError, ValueError):
+                reader.reject(line)
+
+        companies = _company_ids({fiscal for _, fiscal, _ in parsed})
+        sanctions = []
+        for line, fiscal_number, sanction in parsed:
+            if fiscal_number in companies:
+                sanctions.append(dict(sanction,
+                                      company_id=companies[fiscal_number]))
+            else:
+                reader.reject(line)
+
+        if sanctions:
+            with unit_of_work() as uow:
+                db.session.execute(db.insert(Sanction), sanctions)
+                mark_companies({row['company_id'] for row in sanctions})
+                uow.after_commit(
+                    _send, signals.sanctions_changed,
+                    company_ids={row['company_id'] for row in sanctions},
+                    action='created')
+
+        created += len(sanctions)
+
+    return reader.result(created=created)
+
+
+# encoders of the snapshot formats, each writing one company after the other:
+# JSON lines, a stream of MessagePack objects or a CBOR sequence
+SNAPSHOT_FORMATS = {
+    'jsonl': lambda company: json.dumps(company).encode() + b'\n',
+    'msgpack': msgpack.packb,
+    'cbor': cbor2.dumps,
+}
+
+
+def export_snapshot(job, format='jsonl'):
+    """Write every company, with its partners and sanctions, to JOBS_DIR.
+
+    The file holds the companies, in the format of /companies with every
+    partner, one after the other in one of the SNAPSHOT_FORMATS.
+    """
+    if format not in SNAPSHOT_FORMATS:
+        raise ValueError(f'unknown snapshot format: {format!r}')
+    encode = SNAPSHOT_FORMATS[format]
+
+    name = f'snapshot-{job.id}.{format}'
+    total = Company.query.count()
+    job.report(0, total)
+
+    def lines():
+        companies = db.session.scalars(
+            db.select(Company)
+            .options(selectinload(Company.partners),
+                     selectinload(Company.sanctions))
+            .order_by(Company.id)
+            .execution_options(yield_per=BATCH_SIZE))
+
+        for count, company in enumerate(companies, start=1):
+            yield encode(company.format(limit=None))
+            if count % BATCH_SIZE == 0:
+                job.report(count)
+
+    atomic_write(job_file(name), lines())
+    job.report(total)
+
+    return {'file': name, 'companies': total}
+
+
+def rebuild_documents(job):
+    """Rewrite the read model documents of every company and partner."""
+    ids = {
+        'company_ids': db.session.scalars(
+            db.select(Company.id).order_by(Company.id)).all(),
+        'partner_ids': db.session.scalars(
+            db.select(Partner.id).order_by(Partner.id)).all()
+    }
+    job.report(0, sum(len(value) for value in ids.values()))
+
+    done = 0
+    for key, value in ids.items():
+        for start in range(0, len(value), BATCH_SIZE):
+            batch = value[start:start + BATCH_SIZE]
+            with unit_of_work():
+                refresh_documents(**{key: batch})
+
+            done += len(batch)
+            job.report(done)
+
+    return {'companies': len(ids['company_ids']),
+            'partners': len(ids['partner_ids'])}
+
+
+def rebuild_filter(job):
+    return {'generation': rebuild_screening_filter()}
+
+
+def build_index(job):
+    return {'companies': build_screening_index()}
+
+
+def deliver_webhooks(job):
+    return deliver_notifications()
+
+
+def beneficial_owners(job):
+    return compute_beneficial_owners(job.report)
+
+
+def groups(job):
+    return rebuild_groups(job.report)
+
+
+def resolution(job):
+    return resolve_partners(job.report)
+
+
+def refresh_stats(job):
+    return refresh_top_companies()
+
+
+def rebuild_stats(job):
+    return rebuild_statistics()
+
+
+TASKS = {
+    'import_companies': import_companies,
+    'import_partners': import_partners,
+    'import_sanctions': import_sanctions,
+    'export_snapshot': export_snapshot,
+    'rebuild_documents': rebuild_documents,
+    'rebuild_screening_filter': rebuild_filter,
+    'build_screening_index': build_index,
+    'deliver_notifications': deliver_webhooks,
+    'compute_beneficial_owners': beneficial_owners,
+    'rebuild_groups': groups,
+    'resolve_partners': resolution,
+    'refresh_stats': refresh_stats,
+    'rebuild_stats': rebuild_stats,
+}
@@ -1,9 +1,96 @@
 import unittest
 import json
+import os
 import random
+import signal
+import socket
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import date, datetime
+
+import msgpack
+from sqlalchemy import event, inspect, text
 
 from src import create_app
-from src.database.models import db, Company, Partner, Sanction, ownerships
+from src.auth.ratelimit import LIST_COST
+from src.documents import cnpj_check_digits, cpf_check_digits, parse_cnpj
+from src.database.models import (
+    db,
+    unit_of_work,
+    NESTED_LIMIT,
+    Company,
+    CompanyStats,
+    Job,
+    Notification,
+    Partner,
+    PartnerMerge,
+    Sanction,
+    Watchlist,
+    ownerships
+)
+from src.index import get_screening_filter
+from src.index.sorted_index import SANCTIONED
+from src.groups import LOCK_KEY, company_group, rebuild_groups
+from src.prefork import after_fork, warm_up
+from src.resolution import resolve_masked_cpfs, resolve_partners
+from src.statistics import (
+    COUNTS,
+    rebuild_statistics,
+    refresh_top_companies
+)
+from src.ubo import compute_beneficial_owners, effective_ownership
+from src.worker import work
+from src.notifications import (
+    SIGNATURE_HEADER,
+    deliver_notifications,
+    post_webhook,
+    signature
+)
+
+
+def random_cnpj():
+    base = str(random.randint(1, 999999999999)).zfill(12)
+    return base + cnpj_check_digits(base)
+
+
+def random_cpf():
+    base = str(random.randint(1, 999999999)).zfill(9)
+    return base + cpf_check_digits(base)
+
+
+def kill_pool_process(job_id):
+    """Stand-in for run_job in the pool: dies as a process killed for
+    using too much memory."""
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class WebhookReceiver(HTTPServer):
+    """Local stand-in for the webhook of a client."""
+
+    def __init__(self):
+        self.requests = []
+
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                receiver.requests.append((dict(self.headers), body))
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}/hook'
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -60,6 +147,30 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], "not found")
 
+    def new_company(self, name):
+        res = self.client().post('/companies',
+                                 json={"fiscal_number": random_cnpj(),
+                                       "name": name},
+                                 headers=self.admin_headers)
+        company_id = json.loads(res.data)['created']
+        res = self.client().get(f'/companies/{company_id}',
+                                headers=self.admin_headers)
+
+        return json.loads(res.data)['company']
+
+    def new_partner(self, document, name):
+        res = self.client().post('/partners',
+                                 json={"document": document, "name": name},
+                                 headers=self.admin_headers)
+
+        return json.loads(res.data)['created']
+
+    def add_share(self, company_id, partner_id, share):
+        return self.client().put(
+            f'/companies/{company_id}/partners/{partner_id}',
+            json={"share": share},
+            headers=self.admin_headers)
+
     # COMPANIES
 
     def test_get_companies_with_normal_user_headers(self):
@@ -68,15 +179,75 @@ class CapstoneTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         with self.app.app_context():
-            companies_lst = [c.format() for c in Company.query.all()]
+            companies_lst = [c.format()
+                             for c in Company.query.order_by(Company.id)]
 
             self.assertEqual(res.status_code, 200)
             self.assertTrue(data['success'])
             self.assertListEqual(data['companies'], companies_lst)
 
+    def test_get_companies_columnar(self):
+        res = self.client().get(
+            '/companies',
+            headers=dict(self.normal_user_headers,
+                         Accept='application/vnd.capstone.columnar+json'))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['companies']['columns'][:3],
+                         ['id', 'fiscal_number', 'name'])
+        self.assertTrue(data['companies']['rows'])
+
+    def test_get_companies_msgpack(self):
+        res = self.client().get(
+            '/companies',
+            headers=dict(self.normal_user_headers,
+                         Accept='application/msgpack'))
+        data = msgpack.unpackb(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/msgpack')
+        self.assertTrue(data['success'])
+        self.assertTrue(data['companies'])
+
+    def test_get_company(self):
+        with self.app.app_context():
+            company = Company.query.order_by(Company.id).first()
+
+            res = self.client().get(f'/companies/{company.id}',
+                                    headers=self.normal_user_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertEqual(data['company'], company.format())
+
+    def test_company_document_follows_new_sanction(self):
+        with self.app.app_context():
+            company_id = Company.query.order_by(Company.id.desc()).first().id
+
+        res = self.client().post(f'/companies/{company_id}/sanctions',
+                                 json=self.new_santion,
+                                 headers=self.admin_headers)
+        sanction_id = json.loads(res.data)['created']
+
+        res = self.client().get(f'/companies/{company_id}',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertIn(sanction_id,
+                      [s['id'] for s in data['company']['sanctions']])
+
+    def test_error_404_get_non_existent_company(self):
+        res = self.client().get('/companies/100000',
+                                headers=self.normal_user_headers)
+
+        self.assert_error404(res)
+
     def test_create_company(self):
         new_company = {
-            "fiscal_number": str(random.randint(1, 99999999999999)).zfill(14),
+            "fiscal_number": random_cnpj(),
             "name": "INDELBROM DO BRASIL"
         }
 
@@ -98,9 +269,7 @@ class CapstoneTestCase(unittest.TestCase):
 
     def test_error_422_create_company_with_existent_fiscal_number(self):
         with self.app.app_context():
-            fiscal_number = Company.query \
-                .with_entities(Company.fiscal_number) \
-                .first()[0]
+            fiscal_number = Company.query.first().format()['fiscal_number']
 
             new_company = {
                 "fiscal_number": fiscal_number,
@@ -116,6 +285,41 @@ class CapstoneTestCase(unittest.TestCase):
             self.assertFalse(data['success'])
             self.assertEqual(data['message'], 'unprocessable')
 
+    def test_create_company_with_formatted_fiscal_number(self):
+        fiscal_number = random_cnpj()
+        formatted = '{}.{}.{}/{}-{}'.format(
+            fiscal_number[:2], fiscal_number[2:5], fiscal_number[5:8],
+            fiscal_number[8:12], fiscal_number[12:])
+
+        res = self.client().post('/companies',
+                                 json={"fiscal_number": formatted,
+                                       "name": "INDELBROM DO BRASIL"},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            self.assertEqual(res.status_code, 201)
+
+            # stored normalized and served without punctuation
+            company = Company.query.get(data['created'])
+            self.assertEqual(company.fiscal_number, int(fiscal_number))
+            self.assertEqual(company.format()['fiscal_number'], fiscal_number)
+
+    def test_error_422_create_company_with_invalid_check_digits(self):
+        fiscal_number = random_cnpj()
+        wrong_digit = str((int(fiscal_number[-1]) + 1) % 10)
+
+        res = self.client().post('/companies',
+                                 json={"fiscal_number":
+                                       fiscal_number[:-1] + wrong_digit,
+                                       "name": "INDELBROM DO BRASIL"},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'unprocessable')
+
     def test_update_company(self):
         with self.app.app_context():
             # get id from first company in db
@@ -172,6 +376,55 @@ class CapstoneTestCase(unittest.TestCase):
 
             self.assert_error404(res)
 
+    def test_del_companies(self):
+        with self.app.app_context():
+            # get ids of the two last companies in db
+            company_ids = [row[0] for row in Company.query
+                           .with_entities(Company.id)
+                           .order_by(Company.id.desc())
+                           .limit(2)
+                           .all()]
+
+            res = self.client().delete(
+                '/companies?ids=' + ','.join(map(str, company_ids)),
+                headers=self.admin_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertCountEqual(data['deleted'], company_ids)
+
+            company_count = Company.query\
+                .filter(Company.id.in_(company_ids))\
+                .count()
+            self.assertEqual(company_count, 0)
+
+            # ownerships and sanctions are removed by the database
+            ownerships_count = db.session.query(ownerships)\
+                .filter(ownerships.c.company_id.in_(company_ids))\
+                .count()
+            self.assertEqual(ownerships_count, 0)
+
+            sanction_count = Sanction.query\
+                .filter(Sanction.company_id.in_(company_ids))\
+                .count()
+            self.assertEqual(sanction_count, 0)
+
+    def test_error_404_del_non_existent_companies(self):
+        res = self.client().delete('/companies?ids=100000,100001',
+                                   headers=self.admin_headers)
+
+        self.assert_error404(res)
+
+    def test_error_400_del_companies_with_invalid_ids(self):
+        res = self.client().delete('/companies?ids=a,b',
+                                   headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'bad request')
+
     def test_add_partner_to_company(self):
         with self.app.app_context():
             # get id of first company in db
@@ -199,6 +452,28 @@ class CapstoneTestCase(unittest.TestCase):
                 .count()
             self.assertEqual(ownerships_count, 1)
 
+    def test_add_partner_to_company_twice(self):
+        company = self.new_company('ASSOCIADA LTDA')
+        partner_id = self.new_partner(random_cpf(), 'SOCIO')
+
+        self.assertEqual(self.add_share(company['id'], partner_id, 40)
+                         .status_code, 200)
+        self.assertEqual(self.add_share(company['id'], partner_id, 60)
+                         .status_code, 200)
+
+        res = self.client().get(f'/companies/{company["id"]}',
+                                headers=self.admin_headers)
+        data = json.loads(res.data)['company']
+        with self.app.app_context():
+            shares = db.session.scalars(
+                db.select(ownerships.c.share)
+                .where(ownerships.c.company_id == company['id'])).all()
+
+        # the stored document sees the ownership written with Core
+        self.assertEqual([p['id'] for p in data['partners']], [partner_id])
+        self.assertEqual(data['partners_total'], 1)
+        self.assertEqual(shares, [60])
+
     def test_error_404_add_partner_to_non_existent_company(self):
         with self.app.app_context():
             res = self.client().put(
@@ -207,6 +482,231 @@ class CapstoneTestCase(unittest.TestCase):
 
             self.assert_error404(res)
 
+    def test_company_beneficial_owners(self):
+        holding = self.new_company('HOLDING SA')
+        company = self.new_company('OPERADORA LTDA')
+        holding_partner = self.new_partner(holding['fiscal_number'],
+                                           'HOLDING SA')
+        direct, first, second = [self.new_partner(random_cpf(), name)
+                                 for name in ('ANA', 'BRUNO', 'CARLA')]
+
+        self.add_share(company['id'], holding_partner, 60)
+        self.add_share(company['id'], direct, 40)
+        self.add_share(holding['id'], first, 50)
+        self.add_share(holding['id'], second, 50)
+        with self.app.app_context():
+            result = compute_beneficial_owners()
+
+        self.assertTrue(result['converged'])
+
+        res = self.client().get(
+            f'/companies/{company["id"]}/beneficial-owners?min_share=0',
+            headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual({owner['partner']['id']: owner['share']
+                          for owner in data['beneficial_owners']['owners']},
+                         {direct: 40, first: 30, second: 30})
+        self.assertEqual(data['beneficial_owners']['owners'][0]
+                         ['direct_share'], 40)
+
+        res = self.client().get(
+            f'/companies/{company["id"]}/beneficial-owners?min_share=35',
+            headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual([owner['partner']['id']
+                          for owner in data['beneficial_owners']['owners']],
+                         [direct])
+
+    def test_beneficial_owners_of_companies_owning_each_other(self):
+        # companies 1 and 2 hold half of each other (partners 10 and 12)
+        fractions, iterations, converged = effective_ownership([
+            (1, 10, 50, 2), (1, 11, 50, None),
+            (2, 12, 50, 1), (2, 13, 50, None)
+        ])
+
+        self.assertTrue(converged)
+        self.assertAlmostEqual(fractions[1, 11], 2 / 3, places=5)
+        self.assertAlmostEqual(fractions[1, 13], 1 / 3, places=5)
+        self.assertAlmostEqual(fractions[2, 13], 2 / 3, places=5)
+
+    def test_error_422_add_partner_with_invalid_share(self):
+        company = self.new_company('OPERADORA LTDA')
+        partner_id = self.new_partner(random_cpf(), 'ANA')
+
+        res = self.add_share(company['id'], partner_id, 120)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_company_group(self):
+        company = self.new_company('OPERADORA LTDA')
+        holding = self.new_company('HOLDING SA')
+        other = self.new_company('OUTRA LTDA')
+        holding_partner = self.new_partner(holding['fiscal_number'],
+                                           'HOLDING SA')
+        person = self.new_partner(random_cpf(), 'ANA')
+
+        # the holding joins through the partner it is
+        self.add_share(company['id'], holding_partner, 60)
+        self.add_share(other['id'], person, 100)
+        self.add_share(holding['id'], person, 100)
+        self.client().post(f'/companies/{other["id"]}/sanctions',
+                           json={**self.new_santion,
+                                 "start_date": date.today().isoformat()},
+                           headers=self.admin_headers)
+
+        res = self.client().get(f'/companies/{company["id"]}/group',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([c['id'] for c in data['group']['companies']],
+                         sorted([company['id'], holding['id'], other['id']]))
+        self.assertEqual([p['id'] for p in data['group']['partners']],
+                         sorted([holding_partner, person]))
+        self.assertTrue(data['group']['sanctioned'])
+
+        res = self.client().get(
+            f'/companies/{company["id"]}/group?active_at=2000-01-01',
+            headers=self.normal_user_headers)
+
+        self.assertFalse(json.loads(res.data)['group']['sanctioned'])
+
+        # a rebuild finds the same group
+        with self.app.app_context():
+            rebuild_groups()
+        res = self.client().get(f'/companies/{holding["id"]}/group',
+                                headers=self.normal_user_headers)
+
+        self.assertEqual(json.loads(res.data)['group'], data['group'])
+
+    def test_groups_locked_queue_rebuild(self):
+        with self.app.app_context():
+            db.session.execute(db.delete(Job).where(
+                Job.kind == 'rebuild_groups', Job.status == Job.QUEUED))
+            db.session.commit()
+            # another transaction, such as a rebuild, writes the groups
+            locked = db.engine.connect()
+            locked.execute(db.select(db.func.pg_advisory_xact_lock(LOCK_KEY)))
+
+        try:
+            started = time.monotonic()
+            company = self.new_company('TRAVADA LTDA')
+            elapsed = time.monotonic() - started
+        finally:
+            locked.close()
+
+        res = self.client().get(f'/companies/{company["id"]}/group',
+                                headers=self.normal_user_headers)
+
+        self.assertLess(elapsed, 1)
+        self.assertEqual(res.status_code, 404)
+        with self.app.app_context():
+            self.assertEqual(Job.query.filter_by(kind='rebuild_groups',
+                                                 status=Job.QUEUED).count(),
+                             1)
+
+    def test_rename_company_keeps_groups(self):
+        company = self.new_company('ANTIGO NOME LTDA')
+        with self.app.app_context():
+            db.session.execute(db.delete(Job).where(
+                Job.kind == 'rebuild_groups', Job.status == Job.QUEUED))
+            db.session.commit()
+
+        res = self.client().patch(f'/companies/{company["id"]}',
+                                  json={'name': 'NOVO NOME LTDA'},
+                                  headers=self.admin_headers)
+
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Job.query.filter_by(kind='rebuild_groups',
+                                                 status=Job.QUEUED).count(),
+                             0)
+
+    def test_error_404_get_group_of_non_existing_company(self):
+        res = self.client().get('/companies/100000000/group',
+                                headers=self.normal_user_headers)
+
+        self.assert_error404(res)
+
+    def test_company_partners_pages(self):
+        with self.app.app_context():
+            with unit_of_work():
+                company = Company(fiscal_number=random_cnpj(), name='FUNDO')
+                company.partners = [
+                    Partner(document=random_cpf(), name=f'COTISTA {i}')
+                    for i in range(NESTED_LIMIT + 5)]
+                db.session.add(company)
+            company_id = company.id
+            partner_ids = sorted(partner.id for partner in company.partners)
+
+        res = self.client().get(f'/companies/{company_id}',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)['company']
+
+        # the document embeds the first partners only
+        self.assertEqual([p['id'] for p in data['partners']],
+                         partner_ids[:NESTED_LIMIT])
+        self.assertEqual(data['partners_total'], NESTED_LIMIT + 5)
+        self.assertEqual(data['partners_cursor'],
+                         partner_ids[NESTED_LIMIT - 1])
+
+        res = self.client().get(
+            f'/companies/{company_id}/partners'
+            f'?cursor={data["partners_cursor"]}',
+            headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([p['id'] for p in data['partners']],
+                         partner_ids[NESTED_LIMIT:])
+        self.assertEqual(data['total'], NESTED_LIMIT + 5)
+        self.assertIsNone(data['next_cursor'])
+
+        paged = []
+        cursor = 0
+        while cursor is not None:
+            res = self.client().get(
+                f'/companies/{company_id}/partners?cursor={cursor}&limit=40',
+                headers=self.normal_user_headers)
+            data = json.loads(res.data)
+            self.assertLessEqual(len(data['partners']), 40)
+            paged.extend(p['id'] for p in data['partners'])
+            cursor = data['next_cursor']
+
+        self.assertEqual(paged, partner_ids)
+
+        res = self.client().get(f'/partners/{partner_ids[0]}/companies',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual([c['id'] for c in data['companies']], [company_id])
+        self.assertEqual(data['total'], 1)
+        self.assertIn('sanctions', data['companies'][0])
+        self.assertIsNone(data['next_cursor'])
+
+        # format() reads the first page, not the whole collection
+        with self.app.app_context():
+            company = db.session.get(Company, company_id)
+            formatted = company.format()
+
+            self.assertIn('partners', inspect(company).unloaded)
+            self.assertEqual(len(formatted['partners']), NESTED_LIMIT)
+            self.assertEqual(formatted['partners_total'], NESTED_LIMIT + 5)
+            self.assertEqual(len(company.format(limit=None)['partners']),
+                             NESTED_LIMIT + 5)
+
+    def test_error_404_get_partners_of_non_existing_company(self):
+        res = self.client().get('/companies/100000000/partners',
+                                headers=self.normal_user_headers)
+
+        self.assert_error404(res)
+
     # # PARTNERS
 
     def test_get_partners(self):
@@ -215,15 +715,77 @@ class CapstoneTestCase(unittest.TestCase):
         data = json.loads(res.data)
 
         with self.app.app_context():
-            partners_lst = [p.format() for p in Partner.query.all()]
+            partners_lst = [p.format()
+                            for p in Partner.query.order_by(Partner.id)]
 
             self.assertEqual(res.status_code, 200)
             self.assertTrue(data['success'])
             self.assertListEqual(data['partners'], partners_lst)
 
+    def test_resolve_partners(self):
+        # people with the same middle digits of their CPF
+        middle = str(random.randint(100000, 999999))
+        cpfs = [prefix + middle + cpf_check_digits(prefix + middle)
+                for prefix in ('123', '456', '789')]
+        person = self.new_partner(cpfs[0], 'JOSÉ CARLOS DE SOUZA')
+        duplicate = self.new_partner(cpfs[1], 'Jose Carlos Sousa')
+        self.new_partner(cpfs[2], 'JOSE CARLOS PEREIRA')
+        # branches of a company
+        root = random_cnpj()[:8]
+        holding, branch = [
+            self.new_partner(root + order + cnpj_check_digits(root + order),
+                             'ACME SA') for order in ('0001', '0002')]
+
+        first = self.new_company('PRIMEIRA LTDA')
+        second = self.new_company('SEGUNDA LTDA')
+        self.add_share(first['id'], person, 50)
+        self.add_share(second['id'], duplicate, 50)
+
+        self.app.config['RESOLUTION_PROCESSES'] = 2
+        with self.app.app_context():
+            resolve_partners()
+            merges = {merge.partner_id: merge.canonical_id
+                      for merge in PartnerMerge.query.filter(
+                          PartnerMerge.canonical_id.in_([person, holding]))}
+            rebuild_groups()
+            group = company_group(first['id'])
+
+        # similar names, but different CPFs: two people
+        self.assertEqual(merges, {branch: holding})
+        self.assertNotIn(duplicate, merges)
+        self.assertNotIn(second['id'],
+                         [company['id'] for company in group['companies']])
+
+    def test_resolve_masked_cpfs(self):
+        middle = str(random.randint(100000, 999999))
+        person = self.new_partner(
+            '321' + middle + cpf_check_digits('321' + middle),
+            'MARIA APARECIDA DA SILVA')
+
+        with self.app.app_context():
+            resolved = resolve_masked_cpfs({
+                (int(middle), 'Maria Aparecida Silva'),
+                (int(middle), 'Paulo Roberto Lima')
+            })
+
+        self.assertEqual(resolved, {(int(middle), 'Maria Aparecida Silva'):
+                                    person})
+
+    def test_get_partner(self):
+        with self.app.app_context():
+            partner = Partner.query.order_by(Partner.id).first()
+
+            res = self.client().get(f'/partners/{partner.id}',
+                                    headers=self.admin_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertEqual(data['partner'], partner.format())
+
     def test_create_partner(self):
         new_partner = {
-            "document": str(random.randint(1, 99999999999)).zfill(11),
+            "document": random_cpf(),
             "name": "ROSELINO SILVA",
         }
 
@@ -246,9 +808,7 @@ class CapstoneTestCase(unittest.TestCase):
     def test_error_422_create_partner_with_existent_document(self):
 
         with self.app.app_context():
-            document = Partner.query \
-                .with_entities(Partner.document) \
-                .first()[0]
+            document = Partner.query.first().format()['document']
 
             new_partner = {
                 "document": document,
@@ -324,6 +884,47 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assert_error404(res)
 
+    def test_partner_exposure(self):
+        with self.app.app_context():
+            # get a partner that owns a sanctioned company
+            partner_id, company_id = db.session.query(
+                ownerships.c.partner_id, ownerships.c.company_id) \
+                .join(Sanction,
+                      Sanction.company_id == ownerships.c.company_id) \
+                .order_by(ownerships.c.partner_id) \
+                .first()
+
+            res = self.client().get(f'/partners/{partner_id}/exposure',
+                                    headers=self.normal_user_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertEqual(data['exposure']['depth'], 1)
+
+            exposed = {c['id']: c for c in data['exposure']['companies']}
+            self.assertIn(company_id, exposed)
+            self.assertEqual(exposed[company_id]['path'], [company_id])
+
+    def test_error_400_partner_exposure_with_invalid_depth(self):
+        with self.app.app_context():
+            partner_id = Partner.query \
+                .with_entities(Partner.id) \
+                .order_by(Partner.id) \
+                .first()[0]
+
+            res = self.client().get(
+                f'/partners/{partner_id}/exposure?depth=0',
+                headers=self.normal_user_headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_error_404_exposure_of_non_existing_partner(self):
+        res = self.client().get('/partners/100000/exposure',
+                                headers=self.normal_user_headers)
+
+        self.assert_error404(res)
+
     # # SANCTIONS
 
     def test_create_sanction(self):
@@ -349,6 +950,140 @@ class CapstoneTestCase(unittest.TestCase):
                 .count()
             self.assertEqual(sanction_count, 1)
 
+    def test_create_sanction_with_period(self):
+        with self.app.app_context():
+            # get id from last company in db
+            company_id = Company.query \
+                .with_entities(Company.id) \
+                .order_by(Company.id.desc()) \
+                .first()[0]
+
+            new_sanction = dict(self.new_santion,
+                                start_date='2020-01-01',
+                                end_date='2020-12-31')
+            res = self.client().post(f'/companies/{company_id}/sanctions',
+                                     json=new_sanction,
+                                     headers=self.admin_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 201)
+
+            res = self.client().get(
+                f'/companies/{company_id}/sanctions?active_at=2020-06-01',
+                headers=self.normal_user_headers)
+            ids = [s['id'] for s in json.loads(res.data)['sanctions']]
+            self.assertIn(data['created'], ids)
+
+            res = self.client().get(
+                f'/companies/{company_id}/sanctions?active_at=2021-01-01',
+                headers=self.normal_user_headers)
+            ids = [s['id'] for s in json.loads(res.data)['sanctions']]
+            self.assertNotIn(data['created'], ids)
+
+    def test_error_422_create_sanction_with_inverted_period(self):
+        with self.app.app_context():
+            company_id = Company.query \
+                .with_entities(Company.id) \
+                .order_by(Company.id.desc()) \
+                .first()[0]
+
+            new_sanction = dict(self.new_santion,
+                                start_date='2020-12-31',
+                                end_date='2020-01-01')
+            res = self.client().post(f'/companies/{company_id}/sanctions',
+                                     json=new_sanction,
+                                     headers=self.admin_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 422)
+            self.assertFalse(data['success'])
+
+    def test_get_sanctions_active_at(self):
+        res = self.client().get('/sanctions?active_at=2023-06-01',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        with self.app.app_context():
+            sanctions_lst = [
+                s.format() for s in Sanction.query
+                .filter(Sanction.active_at(date(2023, 6, 1)))
+                .order_by(Sanction.id)
+            ]
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertListEqual(data['sanctions'], sanctions_lst)
+
+    def test_error_400_get_sanctions_with_invalid_date(self):
+        res = self.client().get('/sanctions?active_at=01/06/2023',
+                                headers=self.normal_user_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_company_eligibility(self):
+        with self.app.app_context():
+            # get id from a company with a sanction
+            company_id = Sanction.query \
+                .with_entities(Sanction.company_id) \
+                .filter(Sanction.start_date.is_(None),
+                        Sanction.end_date.is_(None)) \
+                .order_by(Sanction.id) \
+                .first()[0]
+
+            res = self.client().get(
+                f'/companies/{company_id}/eligibility',
+                headers=self.normal_user_headers)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertFalse(data['eligibility']['eligible'])
+            self.assertTrue(data['eligibility']['sanctions'])
+
+    def test_company_eligibility_as_of(self):
+        res = self.client().post('/companies',
+                                 json={"fiscal_number": random_cnpj(),
+                                       "name": "HISTORICA LTDA"},
+                                 headers=self.admin_headers)
+        company_id = json.loads(res.data)['created']
+        res = self.client().post(f'/companies/{company_id}/sanctions',
+                                 json=self.new_santion,
+                                 headers=self.admin_headers)
+        sanction_id = json.loads(res.data)['created']
+
+        # a moment between the sanction and its removal
+        sanctioned_at = datetime.utcnow().isoformat()
+        self.client().delete(f'/sanctions/{sanction_id}',
+                             headers=self.admin_headers)
+
+        res = self.client().get(
+            f'/companies/{company_id}/eligibility?as_of={sanctioned_at}',
+            headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['eligibility']['eligible'])
+        self.assertEqual(data['eligibility']['sanctions'][0]['id'],
+                         sanction_id)
+
+        res = self.client().get(f'/companies/{company_id}/eligibility',
+                                headers=self.normal_user_headers)
+        self.assertTrue(json.loads(res.data)['eligibility']['eligible'])
+
+    def test_error_400_get_companies_with_invalid_as_of(self):
+        res = self.client().get('/companies?as_of=yesterday',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_error_404_eligibility_of_non_existing_company(self):
+        res = self.client().get('/companies/100000/eligibility',
+                                headers=self.normal_user_headers)
+
+        self.assert_error404(res)
+
     def test_error_404_create_sanction_for_non_existing_company(self):
         res = self.client().post('/companies/100000/sanctions',
                                  json=self.new_santion,
@@ -385,6 +1120,596 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assert_error404(res)
 
+    # # SCREENING
+
+    def test_screen_clean_company(self):
+        # a new company has no sanctions and no partners
+        fiscal_number = random_cnpj()
+        self.client().post('/companies',
+                           json={"fiscal_number": fiscal_number,
+                                 "name": "INDELBROM DO BRASIL"},
+                           headers=self.admin_headers)
+
+        res = self.client().get(f'/screening/{fiscal_number}',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertTrue(data['screening']['eligible'])
+
+    def test_screen_sanctioned_company(self):
+        with self.app.app_context():
+            company = Company.query \
+                .join(Sanction, Sanction.company_id == Company.id) \
+                .filter(Sanction.start_date.is_(None),
+                        Sanction.end_date.is_(None)) \
+                .first()
+            fiscal_number = company.format()['fiscal_number']
+
+        res = self.client().get(f'/screening/{fiscal_number}',
+                                headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(data['screening']['eligible'])
+        self.assertEqual(data['screening']['source'], 'database')
+
+    def test_error_400_screen_invalid_fiscal_number(self):
+        res = self.client().get('/screening/12345678901234',
+                                headers=self.normal_user_headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_download_screening_filter(self):
+        res = self.client().get('/screening/filter',
+                                headers=self.normal_user_headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/octet-stream')
+        self.assertEqual(res.data[:4], b'CPBF')
+
+        res = self.client().get(
+            '/screening/filter',
+            headers=dict(self.normal_user_headers,
+                         **{'If-None-Match': res.headers['ETag']}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_build_screening_index(self):
+        company = self.new_company('INDEXADA LTDA')
+        self.client().post(f'/companies/{company["id"]}/sanctions',
+                           json=self.new_santion,
+                           headers=self.admin_headers)
+
+        res = self.app.test_cli_runner().invoke(
+            args=['screening', 'build-index'])
+
+        self.assertEqual(res.exit_code, 0)
+
+        with self.app.app_context():
+            index = self.app.extensions['screening_index']
+            company_id, flags = index.lookup(
+                parse_cnpj(company['fiscal_number']),
+                get_screening_filter().generation)
+
+        self.assertEqual(company_id, company['id'])
+        self.assertTrue(flags & SANCTIONED)
+
+    # # logging
+
+    def test_request_is_logged(self):
+        with self.assertLogs('src.requests', 'INFO') as logs:
+            self.client().get('/companies', headers=self.normal_user_headers)
+
+        record = logs.records[0]
+        self.assertEqual(record.getMessage(), 'request')
+        self.assertEqual(record.status, 200)
+        self.assertGreater(record.sql_count, 0)
+
+    # # unit of work
+
+    def test_unit_of_work_rolls_back_every_write(self):
+        fiscal_number = random_cnpj()
+
+        with self.app.app_context():
+            with self.assertRaises(Exception):
+                with unit_of_work():
+                    company = Company(fiscal_number=fiscal_number,
+                                      name="INDELBROM DO BRASIL")
+                    company.insert()
+                    Sanction(name="CEIS", organization="CGU",
+                             company=company).insert()
+                    # same fiscal number, fails on commit
+                    Company(fiscal_number=fiscal_number,
+                            name="INDELBROM").insert()
+
+            company = Company.query \
+                .filter(Company.fiscal_number == int(fiscal_number)) \
+                .one_or_none()
+
+        self.assertIsNone(company)
+
+    # # jobs
+
+    def test_create_job(self):
+        res = self.client().post('/jobs',
+                                 json={"kind": "export_snapshot"},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(data['success'])
+
+        res = self.client().get(f'/jobs/{data["created"]}',
+                                headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['job']['kind'], 'export_snapshot')
+        self.assertIn(data['job']['status'], ('queued', 'running',
+                                              'succeeded'))
+
+    def test_jobs_failed_when_pool_process_dies(self):
+        with self.app.app_context():
+            db.session.execute(db.delete(Job).where(Job.status == Job.QUEUED))
+            db.session.commit()
+            job_ids = [Job.enqueue('export_snapshot').id for _ in range(2)]
+
+            with mock.patch('src.worker.run_job', kill_pool_process):
+                with self.assertRaises(BrokenProcessPool):
+                    work(self.app, 2, burst=True, poll_interval=0.1,
+                         echo=lambda line: None)
+
+            db.session.expire_all()
+            statuses = [db.session.get(Job, job_id).status
+                        for job_id in job_ids]
+
+        self.assertEqual(statuses, [Job.FAILED, Job.FAILED])
+
+    def test_claim_job_of_dead_worker(self):
+        with self.app.app_context():
+            db.session.execute(db.delete(Job).where(Job.status == Job.QUEUED))
+            long_ago = datetime(2000, 1, 1)
+            stale = Job(kind='export_snapshot', status=Job.RUNNING,
+                        worker='gone:1', started_at=long_ago,
+                        heartbeat_at=long_ago)
+            alive = Job(kind='export_snapshot', status=Job.RUNNING,
+                        worker='alive:1', started_at=long_ago,
+                        heartbeat_at=datetime.utcnow())
+            db.session.add_all([stale, alive])
+            db.session.commit()
+
+            self.assertIsNone(Job.claim('other:1'))
+            claimed = Job.claim('other:1', stale_after=60)
+            self.assertEqual(claimed.id, stale.id)
+            self.assertEqual(claimed.worker, 'other:1')
+            self.assertIsNone(Job.claim('other:1', stale_after=60))
+
+    def test_error_422_create_job_with_invalid_params(self):
+        res = self.client().post('/jobs',
+                                 json={"kind": "import_companies",
+                                       "params": {}},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_error_404_get_non_existing_job(self):
+        res = self.client().get('/jobs/100000',
+                                headers=self.admin_headers)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_error_403_normaluser_with_no_permission_to_create_job(self):
+        res = self.client().post('/jobs',
+                                 json={"kind": "export_snapshot"},
+                                 headers=self.normal_user_headers)
+
+        self.assertEqual(res.status_code, 403)
+
+    # # watchlists
+
+    def test_watchlist_notified_by_webhook(self):
+        self.app.config['WEBHOOK_ALLOW_PRIVATE'] = True
+        receiver = WebhookReceiver()
+        self.addCleanup(receiver.server_close)
+        self.addCleanup(receiver.shutdown)
+        company = self.new_company('VIGIADA LTDA')
+
+        res = self.client().post('/watchlists',
+                                 json={"name": "suppliers",
+                                       "fiscal_numbers":
+                                       [company['fiscal_number']],
+                                       "webhook_url": receiver.url,
+                                       "webhook_secret": "s3cr3t"},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 201)
+        watchlist_id = data['created']
+
+        self.client().post(f'/companies/{company["id"]}/sanctions',
+                           json=self.new_santion,
+                           headers=self.admin_headers)
+        with self.app.app_context():
+            result = deliver_notifications()
+
+        self.assertGreaterEqual(result['delivered'], 1)
+        headers, body = next(
+            (headers, body) for headers, body in receiver.requests
+            if json.loads(body)['watchlist_id'] == watchlist_id)
+        notification = json.loads(body)
+        self.assertEqual(headers[SIGNATURE_HEADER],
+                         signature('s3cr3t', body))
+        self.assertEqual(notification['event'], 'sanction')
+        self.assertEqual(notification['company_id'], company['id'])
+        self.assertFalse(notification['eligibility']['eligible'])
+
+    def test_watchlist_not_notified_again_while_ineligible(self):
+        company = self.new_company('VIGIADA LTDA')
+        res = self.client().post('/watchlists',
+                                 json={"name": "suppliers",
+                                       "fiscal_numbers":
+                                       [company['fiscal_number']]},
+                                 headers=self.admin_headers)
+        watchlist_id = json.loads(res.data)['created']
+
+        for _ in range(2):
+            self.client().post(f'/companies/{company["id"]}/sanctions',
+                               json=self.new_santion,
+                               headers=self.admin_headers)
+
+        with self.app.app_context():
+            notifications = Notification.query.filter_by(
+                watchlist_id=watchlist_id).all()
+
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(len(notifications[0].eligibility['sanctions']), 1)
+
+    def test_watchlist_events_of_new_ownership(self):
+        self.app.config['WATCHLIST_STREAM_TIMEOUT'] = 0
+        sanctioned = self.new_company('SANCIONADA LTDA')
+        watched = self.new_company('VIGIADA LTDA')
+        self.client().post(f'/companies/{sanctioned["id"]}/sanctions',
+                           json=self.new_santion,
+                           headers=self.admin_headers)
+        res = self.client().post('/partners',
+                                 json={"document": random_cpf(),
+                                       "name": "SOCIO COMUM"},
+                                 headers=self.admin_headers)
+        partner_id = json.loads(res.data)['created']
+        self.client().put(
+            f'/companies/{sanctioned["id"]}/partners/{partner_id}',
+            headers=self.admin_headers)
+
+        res = self.client().post('/watchlists',
+                                 json={"name": "suppliers",
+                                       "fiscal_numbers":
+                                       [watched['fiscal_number']]},
+                                 headers=self.admin_headers)
+        watchlist_id = json.loads(res.data)['created']
+
+        # the watched company now shares a partner with a sanctioned one
+        self.client().put(f'/companies/{watched["id"]}/partners/{partner_id}',
+                          headers=self.admin_headers)
+
+        res = self.client().get(f'/watchlists/{watchlist_id}/events',
+                                headers=self.admin_headers)
+        events = [json.loads(line[len('data: '):])
+                  for line in res.get_data(as_text=True).splitlines()
+                  if line.startswith('data: ')]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['event'], 'ownership')
+        self.assertEqual(events[0]['company_id'], watched['id'])
+
+        res = self.client().get(f'/watchlists/{watchlist_id}/events',
+                                headers=dict(self.admin_headers, **{
+                                    'Last-Event-ID': str(events[0]['id'])
+                                }))
+        self.assertNotIn('data: ', res.get_data(as_text=True))
+
+    def test_error_429_watchlist_streams_limit_reached(self):
+        client = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'WATCHLIST_MAX_STREAMS': 1,
+            'WATCHLIST_STREAM_TIMEOUT': 0
+        }).test_client()
+        res = client.post('/watchlists',
+                          json={"name": "suppliers",
+                                "fiscal_numbers": [random_cnpj()]},
+                          headers=self.admin_headers)
+        url = f'/watchlists/{json.loads(res.data)["created"]}/events'
+
+        stream = client.get(url, headers=self.admin_headers, buffered=False)
+        res = client.get(url, headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(stream.status_code, 200)
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+        stream.close()
+        res = client.get(url, headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+
+    def test_error_422_create_watchlist_with_invalid_fiscal_number(self):
+        res = self.client().post('/watchlists',
+                                 json={"name": "suppliers",
+                                       "fiscal_numbers": ["12345"]},
+                                 headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+
+    def test_error_422_create_watchlist_with_private_webhook(self):
+        for url in ('http://127.0.0.1:8080/hook', 'http://localhost/hook',
+                    'http://169.254.169.254/latest/meta-data',
+                    'http://10.0.0.1/hook', 'http://[::1]/hook'):
+            res = self.client().post('/watchlists',
+                                     json={"name": "suppliers",
+                                           "fiscal_numbers": [random_cnpj()],
+                                           "webhook_url": url},
+                                     headers=self.admin_headers)
+
+            self.assertEqual(res.status_code, 422, url)
+
+    def test_webhook_not_delivered_to_private_address(self):
+        self.app.config['WEBHOOK_ALLOW_PRIVATE'] = True
+        company = self.new_company('VIGIADA LTDA')
+        res = self.client().post('/watchlists',
+                                 json={"name": "suppliers",
+                                       "fiscal_numbers":
+                                       [company['fiscal_number']],
+                                       "webhook_url":
+                                       'http://127.0.0.1:9/hook'},
+                                 headers=self.admin_headers)
+        watchlist_id = json.loads(res.data)['created']
+        self.client().post(f'/companies/{company["id"]}/sanctions',
+                           json=self.new_santion,
+                           headers=self.admin_headers)
+
+        # the host is checked again when the notification is delivered
+        self.app.config['WEBHOOK_ALLOW_PRIVATE'] = False
+        with self.app.app_context():
+            deliver_notifications()
+            notification = Notification.query.filter_by(
+                watchlist_id=watchlist_id).one()
+
+            self.assertIsNone(notification.delivered_at)
+            self.assertIn('not public', notification.error)
+
+    def test_webhook_not_posted_when_host_rebinds(self):
+        receiver = WebhookReceiver()
+        getaddrinfo = socket.getaddrinfo
+        lookups = []
+
+        def rebinding(host, port, *args, **kwargs):
+            # public when checked, loopback when connected to
+            lookups.append(host)
+            address = '93.184.216.34' if len(lookups) == 1 else '127.0.0.1'
+            return getaddrinfo(address, port, *args, **kwargs)
+
+        url = f'http://hook.example.com:{receiver.server_port}/hook'
+        self.app.config['WEBHOOK_ALLOW_PRIVATE'] = False
+        try:
+            with self.app.app_context(), \
+                    mock.patch('socket.getaddrinfo', rebinding):
+                with self.assertRaisesRegex(ValueError, 'not public'):
+                    post_webhook(Watchlist(webhook_url=url), {'id': 1}, 5)
+        finally:
+            receiver.shutdown()
+
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(receiver.requests, [])
+
+    def test_error_404_get_non_existing_watchlist(self):
+        res = self.client().get('/watchlists/100000',
+                                headers=self.admin_headers)
+
+        self.assert_error404(res)
+
+    # # replicas
+
+    def test_reads_go_to_replica_until_client_writes(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'SQLALCHEMY_REPLICA_URIS': self.database_path
+        })
+        replica = app.extensions['replicas'].replicas[0]
+        self.addCleanup(replica.engine.dispose)
+        statements = []
+        event.listen(replica.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     statements.append(statement))
+        client = app.test_client()
+
+        res = client.get('/watchlists', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(any('FROM watchlists' in statement
+                            for statement in statements))
+
+        statements.clear()
+        res = client.post('/watchlists',
+                          json={"name": "primary",
+                                "fiscal_numbers": [random_cnpj()]},
+                          headers=self.admin_headers)
+        watchlist_id = json.loads(res.data)['created']
+        res = client.get('/watchlists', headers=self.admin_headers)
+        data = json.loads(res.data)
+
+        # the writer reads from the primary, where its write already is
+        self.assertEqual(statements, [])
+        self.assertIn(watchlist_id,
+                      [watchlist['id'] for watchlist in data['watchlists']])
+
+    # # stats
+
+    def get_stats(self):
+        res = self.client().get('/stats', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+
+        return json.loads(res.data)['stats']
+
+    def test_stats_follow_writes(self):
+        before = self.get_stats()
+
+        company = self.new_company('CONTADORA LTDA')
+        for name in ('ANA', 'BRUNO'):
+            self.add_share(company['id'],
+                           self.new_partner(random_cpf(), name), 50)
+        organization = f'TCU {random.randint(0, 999999)}'
+        self.client().post(f'/companies/{company["id"]}/sanctions',
+                           json=dict(self.new_santion,
+                                     organization=organization),
+                           headers=self.admin_headers)
+        stats = self.get_stats()
+
+        self.assertEqual({key: stats[key] - before[key] for key in COUNTS},
+                         {'companies': 1, 'partners': 2, 'ownerships': 2,
+                          'sanctions': 1, 'sanctioned_companies': 1})
+        self.assertEqual(stats['sanctions_by_organization'][organization], 1)
+
+        # ownerships and sanctions removed by the cascades are counted
+        self.client().delete(f'/companies/{company["id"]}',
+                             headers=self.admin_headers)
+        stats = self.get_stats()
+
+        self.assertEqual({key: stats[key] - before[key] for key in COUNTS},
+                         {'companies': 0, 'partners': 2, 'ownerships': 0,
+                          'sanctions': 0, 'sanctioned_companies': 0})
+        self.assertNotIn(organization, stats['sanctions_by_organization'])
+
+        with self.app.app_context():
+            rebuilt = rebuild_statistics()
+
+        self.assertEqual({key: rebuilt[key] for key in COUNTS},
+                         {key: stats[key] for key in COUNTS})
+
+    def test_top_companies(self):
+        with self.app.app_context():
+            refresh_top_companies()
+            most = db.session.scalar(db.select(
+                db.func.max(CompanyStats.partners)))
+
+        top = self.get_stats()['top_companies']
+        partners = [company['partners'] for company in top]
+
+        self.assertEqual(partners[0], most)
+        self.assertEqual(partners, sorted(partners, reverse=True))
+        self.assertIn('name', top[0]['company'])
+
+    # # prefork
+
+    def test_worker_forked_from_preloaded_app(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False
+        })
+        warm_up(app)
+        backend_pid = text('SELECT pg_backend_pid()')
+        with app.app_context():
+            # a connection left in the pool of the master
+            master_backend = db.session.scalar(backend_pid)
+            db.session.remove()
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                after_fork(app)
+                res = app.test_client().get('/companies/1',
+                                            headers=self.admin_headers)
+                with app.app_context():
+                    backend = db.session.scalar(backend_pid)
+                os.write(write, f'{res.status_code} {backend}'.encode())
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        status, worker_backend = os.read(read, 100).decode().split()
+        os.close(read)
+        os.close(write)
+
+        self.assertIn(status, ('200', '404'))
+        self.assertNotEqual(int(worker_backend), master_backend)
+        # the worker left the connection of the master open
+        with app.app_context():
+            self.assertEqual(db.session.scalar(backend_pid), master_backend)
+
+    # # timeouts
+
+    def _slow_app(self, **config):
+        app = create_app(dict({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False
+        }, **config))
+
+        @app.route('/sleep/<float:seconds>/<int:times>')
+        def sleep(seconds, times):
+            for _ in range(times):
+                db.session.execute(text('SELECT pg_sleep(:seconds)'),
+                                   {'seconds': seconds})
+            return {'success': True}
+
+        return app.test_client()
+
+    def test_error_504_statement_timeout(self):
+        client = self._slow_app(LOOKUP_STATEMENT_TIMEOUT=0.1)
+
+        res = client.get('/sleep/0.01/1')
+        self.assertEqual(res.status_code, 200)
+
+        res = client.get('/sleep/1.0/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'statement timeout')
+
+    def test_error_504_request_deadline_exceeded(self):
+        client = self._slow_app(LOOKUP_STATEMENT_TIMEOUT=1,
+                                REQUEST_DEADLINE=0.3)
+
+        # each statement fits its timeout, not all of them in the deadline
+        res = client.get('/sleep/0.2/3')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'request deadline exceeded')
+
+    def test_error_504_list_statement_timeout(self):
+        client = self._slow_app(LIST_STATEMENT_TIMEOUT=0.05)
+
+        # the documents are read along with a one second sleep
+        def slow_documents(conn, cursor, statement, parameters, *args):
+            return statement.replace('FROM company_documents',
+                                     'FROM pg_sleep(1), company_documents'), \
+                parameters
+
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', slow_documents,
+                     retval=True)
+        try:
+            res = client.get('/companies', headers=self.normal_user_headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', slow_documents)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 504)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'statement timeout')
+
     # # permission
 
     def test_error_401_no_authorization_header(self):
@@ -396,6 +1721,47 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['error'], '401')
         self.assertEqual(data['message'], 'Authorizarion header is necessary.')
 
+    def test_error_429_rate_limit_exceeded(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'RATELIMIT_CAPACITY': LIST_COST,
+            'RATELIMIT_REFILL_RATE': 0.01
+        })
+        client = app.test_client()
+
+        res = client.get('/companies', headers=self.normal_user_headers)
+        self.assertEqual(res.status_code, 200)
+
+        res = client.get('/companies', headers=self.normal_user_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 429)
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+    def test_error_429_concurrency_limit_reached(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+            'CONCURRENCY_LIMIT': 1
+        })
+        client = app.test_client()
+
+        # hold the only slot as if another request was running
+        slots = app.extensions['rate_limiter'].slots
+        slot = slots.acquire()
+        try:
+            res = client.get('/partners', headers=self.normal_user_headers)
+        finally:
+            slots.release(slot)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertIn('Retry-After', res.headers)
+
     def test_error_403_normaluser_with_no_permission_to_del_company(self):
         res = self.client().delete('/companies/1',
                                    headers=self.normal_user_headers)